@@ -0,0 +1,516 @@
+import io
+import os
+import re
+import csv
+import time
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import AsyncGenerator, List, Optional, Tuple, Union
+
+from aiogram import Bot, F, Router, types
+from aiogram.exceptions import TelegramAPIError
+from aiogram.filters import Command, CommandObject
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import CallbackQuery, Message
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from callbacks import CallbackData, CallbackTable
+from pricing import calculate_price
+from servers import server_registry
+from storage import storage
+from wireguard import rebalance_server
+
+# Список администраторов
+ADMIN_IDS = [int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()]
+
+# Подписок на одной странице списка
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "10"))
+
+CSV_HEADER = (
+    "id", "user_id", "username", "subscription_type", "is_trial",
+    "start_date", "end_date", "payment_id"
+)
+# Строк в одном фрагменте выгрузки, отправляемом в Telegram
+CSV_CHUNK_ROWS = 1000
+
+BULK_USAGE = (
+    "Массовые операции с активными подписками:\n"
+    "/bulk extend <дней> all|trials|users <id> <id> ...\n"
+    "/bulk deactivate all|trials|users <id> <id> ..."
+)
+# Сообщение о ходе массовой операции обновляется не чаще этого интервала
+BULK_PROGRESS_INTERVAL = 2
+
+SERVERS_USAGE = (
+    "Серверы WireGuard:\n"
+    "/servers - загрузка серверов\n"
+    "/server <имя> on|off - включить или вывести сервер из размещения\n"
+    "/rebalance <имя> [количество] - перенести клиентов на менее загруженные серверы"
+)
+
+# Период статистики по умолчанию, дней
+STATS_DAYS = int(os.getenv("STATS_DAYS", "30"))
+
+STATS_USAGE = (
+    "Статистика подписок:\n"
+    "/stats [дней] - выручка, конверсия и отток\n"
+    "/stats rebuild - пересчитать статистику по всем подпискам и платежам"
+)
+
+router = Router()
+router.message.filter(F.from_user.id.in_(ADMIN_IDS))
+router.callback_query.filter(F.from_user.id.in_(ADMIN_IDS))
+callbacks = CallbackTable(router)
+
+class AdminStates(StatesGroup):
+    deactivate = State()
+    extend = State()
+    bulk_confirm = State()
+
+PageKey = Tuple[str, int]
+
+@dataclass
+class SubscriptionsCallback(CallbackData, prefix="admin_subs"):
+    pass
+
+@dataclass
+class SubscriptionsPageCallback(CallbackData, prefix="admin_page"):
+    """Переход на соседнюю страницу; срок последним, так как содержит двоеточия"""
+    direction: str
+    id: int
+    end_date: str
+
+    @property
+    def page_key(self) -> PageKey:
+        return self.end_date, self.id
+
+@dataclass
+class ExportCallback(CallbackData, prefix="admin_export"):
+    pass
+
+@dataclass
+class DeactivateCallback(CallbackData, prefix="admin_deactivate"):
+    pass
+
+@dataclass
+class ExtendCallback(CallbackData, prefix="admin_extend"):
+    pass
+
+@dataclass
+class StatsCallback(CallbackData, prefix="admin_stats"):
+    pass
+
+@dataclass
+class BulkRunCallback(CallbackData, prefix="admin_bulk_run"):
+    pass
+
+@dataclass
+class BulkCancelCallback(CallbackData, prefix="admin_bulk_cancel"):
+    pass
+
+def page_callback(direction: str, key: PageKey) -> str:
+    """callback_data перехода на соседнюю страницу"""
+    return SubscriptionsPageCallback(direction, key[1], key[0]).pack()
+
+def format_subscriptions_page(rows: List[dict]) -> str:
+    """Текст страницы списка подписок"""
+    lines = ["📋 Активные подписки:", ""]
+    for row in rows:
+        end_date = datetime.fromisoformat(row["end_date"])
+        username = f"@{row['username']}" if row["username"] else "без username"
+        plan = "тестовый период" if row["is_trial"] else row["subscription_type"]
+        lines.append(
+            f"#{row['id']} · {row['user_id']} ({username}) · до {end_date:%d.%m.%Y} · {plan}"
+        )
+    return "\n".join(lines)
+
+def get_subscriptions_page_keyboard(
+    rows: List[dict],
+    has_prev: bool,
+    has_next: bool
+) -> types.InlineKeyboardMarkup:
+    """Кнопки перехода между страницами и выгрузки"""
+    navigation = []
+    if has_prev:
+        navigation.append(types.InlineKeyboardButton(
+            text="⬅️ Назад",
+            callback_data=page_callback("prev", (rows[0]["end_date"], rows[0]["id"]))
+        ))
+    if has_next:
+        navigation.append(types.InlineKeyboardButton(
+            text="Вперед ➡️",
+            callback_data=page_callback("next", (rows[-1]["end_date"], rows[-1]["id"]))
+        ))
+    builder = InlineKeyboardBuilder()
+    if navigation:
+        builder.row(*navigation)
+    builder.row(types.InlineKeyboardButton(text="📄 Выгрузить CSV", callback_data=ExportCallback().pack()))
+    return builder.as_markup()
+
+@callbacks(SubscriptionsCallback)
+@callbacks(SubscriptionsPageCallback)
+async def show_subscriptions(
+    callback: CallbackQuery, callback_data: Union[SubscriptionsCallback, SubscriptionsPageCallback]
+):
+    """Список активных подписок с постраничной навигацией"""
+    direction: Optional[str] = None
+    key: Optional[PageKey] = None
+    if isinstance(callback_data, SubscriptionsPageCallback):
+        direction, key = callback_data.direction, callback_data.page_key
+
+    # Запрашиваем на одну строку больше, чтобы узнать, есть ли следующая страница
+    if direction == "prev":
+        rows = await storage.get_active_subscriptions_page(before=key, limit=ADMIN_PAGE_SIZE + 1)
+        has_prev, has_next = len(rows) > ADMIN_PAGE_SIZE, True
+        rows = rows[-ADMIN_PAGE_SIZE:]
+    else:
+        rows = await storage.get_active_subscriptions_page(after=key, limit=ADMIN_PAGE_SIZE + 1)
+        has_prev, has_next = key is not None, len(rows) > ADMIN_PAGE_SIZE
+        rows = rows[:ADMIN_PAGE_SIZE]
+
+    if not rows:
+        await callback.answer("Активных подписок нет.", show_alert=True)
+        return
+
+    text = format_subscriptions_page(rows)
+    keyboard = get_subscriptions_page_keyboard(rows, has_prev, has_next)
+    if direction is None:
+        await callback.message.answer(text, reply_markup=keyboard)
+    else:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+class SubscriptionsCsvFile(types.InputFile):
+    """CSV с активными подписками, который формируется по мере отправки в Telegram"""
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        buffer = io.StringIO()
+        # BOM, чтобы Excel распознал кодировку UTF-8
+        buffer.write("\ufeff")
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_HEADER)
+        rows = 0
+        async for row in storage.iter_active_subscriptions():
+            writer.writerow(row)
+            rows += 1
+            if rows % CSV_CHUNK_ROWS == 0:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode("utf-8")
+
+@callbacks(ExportCallback)
+async def export_subscriptions(callback: CallbackQuery):
+    """Отправляет выгрузку активных подписок в CSV"""
+    await callback.answer("Формирую выгрузку...")
+    await callback.message.answer_document(
+        SubscriptionsCsvFile(filename=f"subscriptions_{datetime.now():%Y%m%d_%H%M}.csv"),
+        caption="📄 Активные подписки"
+    )
+
+@callbacks(DeactivateCallback)
+async def ask_deactivate(callback: CallbackQuery, state: FSMContext):
+    """Запрашивает пользователя, подписку которого нужно отключить"""
+    await state.set_state(AdminStates.deactivate)
+    await callback.message.answer("Отправьте ID пользователя, подписку которого нужно отключить.")
+    await callback.answer()
+
+@router.message(AdminStates.deactivate)
+async def process_deactivate(message: Message, state: FSMContext):
+    """Отключает активную подписку пользователя"""
+    try:
+        user_id = int((message.text or "").strip())
+    except ValueError:
+        await message.answer("Нужен числовой ID пользователя.")
+        return
+    await state.clear()
+
+    sub = await storage.get_active_subscription(user_id)
+    if not sub:
+        await message.answer(f"У пользователя {user_id} нет активной подписки.")
+        return
+
+    await storage.deactivate_subscription(sub["id"])
+    await message.answer(f"Подписка #{sub['id']} пользователя {user_id} отключена.")
+
+@callbacks(ExtendCallback)
+async def ask_extend(callback: CallbackQuery, state: FSMContext):
+    """Запрашивает пользователя и срок продления"""
+    await state.set_state(AdminStates.extend)
+    await callback.message.answer(
+        "Отправьте ID пользователя и количество месяцев через пробел, например: 123456789 1"
+    )
+    await callback.answer()
+
+@router.message(AdminStates.extend)
+async def process_extend(message: Message, state: FSMContext):
+    """Продлевает активную подписку пользователя"""
+    try:
+        user_id, months = map(int, (message.text or "").split())
+    except ValueError:
+        await message.answer("Нужны два числа: ID пользователя и количество месяцев.")
+        return
+    if months <= 0:
+        await message.answer("Количество месяцев должно быть положительным.")
+        return
+    await state.clear()
+
+    sub = await storage.get_active_subscription(user_id)
+    if not sub:
+        await message.answer(f"У пользователя {user_id} нет активной подписки.")
+        return
+
+    await storage.extend_subscription(sub["id"], months)
+    await message.answer(f"Подписка #{sub['id']} пользователя {user_id} продлена на {months} мес.")
+
+def parse_bulk_command(args: str) -> dict:
+    """Разбирает аргументы /bulk; ValueError, если они некорректны"""
+    words = args.split()
+    if not words or words[0] not in ("extend", "deactivate"):
+        raise ValueError(args)
+    action, words = words[0], words[1:]
+
+    days = None
+    if action == "extend":
+        if not words:
+            raise ValueError(args)
+        days = int(words.pop(0))
+        if days <= 0:
+            raise ValueError(args)
+
+    if not words or words[0] not in ("all", "trials", "users"):
+        raise ValueError(args)
+    user_ids = None
+    if words[0] == "users":
+        user_ids = sorted({int(user_id) for user_id in re.findall(r"\d+", " ".join(words[1:]))})
+        if not user_ids:
+            raise ValueError(args)
+    return {
+        "action": action,
+        "days": days,
+        "trial_only": words[0] == "trials",
+        "user_ids": user_ids,
+    }
+
+def describe_bulk_operation(operation: dict) -> str:
+    """Описание массовой операции для подтверждения и отчета"""
+    if operation["action"] == "extend":
+        action = f"Продление на {operation['days']} дн."
+    else:
+        action = "Отключение"
+    if operation["user_ids"] is not None:
+        target = f"подписок {len(operation['user_ids'])} пользователей"
+    elif operation["trial_only"]:
+        target = "тестовых подписок"
+    else:
+        target = "всех активных подписок"
+    return f"{action} {target}"
+
+@router.message(Command("bulk"))
+async def cmd_bulk(message: Message, command: CommandObject, state: FSMContext):
+    """Готовит массовую операцию и просит подтверждения"""
+    try:
+        operation = parse_bulk_command(command.args or "")
+    except ValueError:
+        await message.answer(BULK_USAGE)
+        return
+
+    total = await storage.count_subscriptions_for_bulk(operation["trial_only"], operation["user_ids"])
+    if not total:
+        await message.answer("Подходящих активных подписок нет.")
+        return
+
+    await state.set_state(AdminStates.bulk_confirm)
+    await state.update_data(bulk=operation)
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✅ Выполнить", callback_data=BulkRunCallback().pack())
+    builder.button(text="Отмена", callback_data=BulkCancelCallback().pack())
+    await message.answer(
+        f"{describe_bulk_operation(operation)}.\nБудет затронуто подписок: {total}. Выполнить?",
+        reply_markup=builder.as_markup()
+    )
+
+@callbacks(BulkCancelCallback, state=AdminStates.bulk_confirm)
+async def cancel_bulk(callback: CallbackQuery, state: FSMContext):
+    await state.clear()
+    await callback.message.edit_text("Массовая операция отменена.")
+    await callback.answer()
+
+@callbacks(BulkRunCallback, state=AdminStates.bulk_confirm)
+async def run_bulk(callback: CallbackQuery, state: FSMContext):
+    """Выполняет подтвержденную массовую операцию, показывая ход выполнения"""
+    operation = (await state.get_data())["bulk"]
+    await state.clear()
+    await callback.answer()
+    description = describe_bulk_operation(operation)
+    await callback.message.edit_text(f"⏳ {description}...")
+
+    last_update = time.monotonic()
+
+    async def on_progress(done: int, total: int):
+        nonlocal last_update
+        if time.monotonic() - last_update < BULK_PROGRESS_INTERVAL:
+            return
+        last_update = time.monotonic()
+        try:
+            await callback.message.edit_text(f"⏳ {description}: {done} из {total}")
+        except TelegramAPIError as e:
+            # Сбой отображения прогресса не должен прерывать операцию
+            logging.warning("Не удалось обновить ход массовой операции: %s", e)
+
+    if operation["action"] == "extend":
+        count = await storage.extend_subscriptions_bulk(
+            operation["days"], operation["trial_only"], operation["user_ids"], on_progress
+        )
+    else:
+        count = await storage.deactivate_subscriptions_bulk(
+            operation["trial_only"], operation["user_ids"], on_progress
+        )
+    await callback.message.edit_text(f"✅ {description} завершено, изменено подписок: {count}")
+
+@router.message(Command("servers"))
+async def cmd_servers(message: Message):
+    """Загрузка и состояние серверов WireGuard"""
+    await server_registry.refresh_load()
+    lines = ["🖥 Серверы WireGuard:", ""]
+    for server in server_registry.servers.values():
+        if not server.is_enabled:
+            status = "выключен"
+        elif not server.healthy:
+            status = "недоступен"
+        else:
+            status = "работает"
+        lines.append(
+            f"{server.name} · {server.load}/{server.capacity} ({server.load_ratio:.0%}) · {status}"
+        )
+    lines.extend(["", SERVERS_USAGE])
+    await message.answer("\n".join(lines))
+
+@router.message(Command("server"))
+async def cmd_server(message: Message, command: CommandObject):
+    """Включает сервер или выводит его из размещения новых клиентов"""
+    args = (command.args or "").split()
+    if len(args) != 2 or args[1] not in ("on", "off"):
+        await message.answer(SERVERS_USAGE)
+        return
+    server = server_registry.find(args[0])
+    if server is None:
+        await message.answer(f"Сервер {args[0]} не найден.")
+        return
+    await server_registry.set_enabled(server, args[1] == "on")
+    state = "включен" if server.is_enabled else "выведен из размещения новых клиентов"
+    await message.answer(f"Сервер {server.name} {state}.")
+
+@router.message(Command("rebalance"))
+async def cmd_rebalance(message: Message, command: CommandObject):
+    """Переносит клиентов с сервера пачками, перевыпуская им конфигурации"""
+    args = (command.args or "").split()
+    try:
+        name = args[0]
+        count = int(args[1]) if len(args) > 1 else None
+    except (IndexError, ValueError):
+        await message.answer(SERVERS_USAGE)
+        return
+    server = server_registry.find(name)
+    if server is None:
+        await message.answer(f"Сервер {name} не найден.")
+        return
+
+    progress = await message.answer(f"⏳ Перебалансировка {server.name}...")
+    last_update = time.monotonic()
+
+    async def on_progress(done: int, total: int):
+        nonlocal last_update
+        if time.monotonic() - last_update < BULK_PROGRESS_INTERVAL:
+            return
+        last_update = time.monotonic()
+        try:
+            await progress.edit_text(f"⏳ Перебалансировка {server.name}: {done} из {total}")
+        except TelegramAPIError as e:
+            logging.warning("Не удалось обновить ход перебалансировки: %s", e)
+
+    moved = await rebalance_server(server, count, on_progress)
+    await progress.edit_text(
+        f"✅ Перебалансировка {server.name} завершена, перенесено клиентов: {moved}\n"
+        f"Загрузка: {server.load}/{server.capacity}"
+    )
+
+def plan_months(plan: str) -> Optional[int]:
+    """Срок тарифа в месяцах для подписок вида <N>_months"""
+    months, _, suffix = plan.partition("_")
+    return int(months) if suffix == "months" and months.isdigit() else None
+
+def format_subscription_stats(rows: List[dict], days: int) -> str:
+    """Сводка по дневной статистике: выручка по тарифам, конверсия и отток"""
+    plans: dict = {}
+    for row in rows:
+        totals = plans.setdefault(
+            row["plan"], {"started": 0, "renewals": 0, "conversions": 0, "churned": 0, "extended": 0}
+        )
+        for column in totals:
+            totals[column] += row[column]
+
+    lines = [f"📊 Статистика за {days} дн.", "", "Выручка по тарифам (по текущим ценам):"]
+    revenue = Decimal(0)
+    paid = {plan: totals for plan, totals in plans.items() if plan_months(plan)}
+    for plan, totals in sorted(paid.items(), key=lambda item: plan_months(item[0])):
+        purchases = totals["started"] + totals["renewals"]
+        amount = calculate_price(plan_months(plan)) * purchases
+        revenue += amount
+        lines.append(
+            f"{plan_months(plan)} мес.: новых {totals['started']}, продлений {totals['renewals']} · {amount:.2f} руб."
+        )
+    if not paid:
+        lines.append("оплат не было")
+    lines.append(f"Итого: {revenue:.2f} руб.")
+
+    trial = plans.get("trial", {})
+    trials = trial.get("started", 0)
+    conversions = sum(totals["conversions"] for totals in paid.values())
+    conversion_rate = f" ({conversions / trials:.1%})" if trials else ""
+    paid_started = sum(totals["started"] for totals in paid.values())
+    paid_churned = sum(totals["churned"] for totals in paid.values())
+    lines.extend([
+        "",
+        f"Тестовых периодов: {trials}, оплатили после теста: {conversions}{conversion_rate}",
+        f"Отток: платных {paid_churned}, тестовых {trial.get('churned', 0)}",
+        f"Прирост платных подписок: {paid_started - paid_churned:+d}",
+        f"Продлений администратором (без оплаты, в выручку не входят): "
+        f"{sum(totals['extended'] for totals in plans.values())}",
+    ])
+    return "\n".join(lines)
+
+async def show_subscription_stats(message: Message, days: int):
+    since = (date.today() - timedelta(days=days - 1)).isoformat()
+    rows = await storage.get_subscription_stats(since)
+    await message.answer(format_subscription_stats(rows, days))
+
+@callbacks(StatsCallback)
+async def show_stats(callback: CallbackQuery):
+    """Статистика подписок за период по умолчанию"""
+    await show_subscription_stats(callback.message, STATS_DAYS)
+    await callback.answer()
+
+@router.message(Command("stats"))
+async def cmd_stats(message: Message, command: CommandObject):
+    """Статистика подписок по дневным сводкам или их пересчет"""
+    args = (command.args or "").split()
+    if args == ["rebuild"]:
+        progress = await message.answer("⏳ Пересчитываю статистику...")
+        started = time.monotonic()
+        rows = await storage.rebuild_subscription_stats()
+        await progress.edit_text(
+            f"✅ Статистика пересчитана: {rows} дневных строк за {time.monotonic() - started:.1f} с"
+        )
+        return
+    try:
+        days = int(args[0]) if args else STATS_DAYS
+    except ValueError:
+        days = 0
+    if days <= 0:
+        await message.answer(STATS_USAGE)
+        return
+    await show_subscription_stats(message, days)
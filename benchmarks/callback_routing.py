@@ -0,0 +1,140 @@
+"""Микробенчмарк выбора обработчика callback-запросов.
+
+Сравнивает цепочку фильтров aiogram (lambda c: c.data.startswith(...) на каждый
+обработчик) с таблицей CallbackTable при разном числе обработчиков: время
+полного прохода обновления через диспетчер и время одного только выбора
+обработчика.
+
+    python benchmarks/callback_routing.py --handlers 5 20 100 500 --updates 20000
+"""
+import os
+import sys
+import json
+import time
+import types
+import random
+import asyncio
+import argparse
+import dataclasses
+from typing import Callable, Dict, List, Tuple, Type
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import CallbackQuery, Update
+
+from callbacks import CallbackData, CallbackTable
+
+def make_schemas(count: int) -> List[Type[CallbackData]]:
+    """Схемы вида route<N>_<значение>, как у кнопок тарифов"""
+    schemas = []
+    for index in range(count):
+        schema = types.new_class(
+            f"Route{index}Callback", (CallbackData,), {"prefix": f"route{index}", "separator": "_"},
+            lambda namespace: namespace.update({"__annotations__": {"value": int}})
+        )
+        schemas.append(dataclasses.dataclass(schema))
+    return schemas
+
+def make_update(update_id: int, data: str) -> Update:
+    user = {"id": 1, "is_bot": False, "first_name": "Bench"}
+    return Update.model_validate({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": 1, "type": "private"},
+                "text": "bench"
+            }
+        }
+    })
+
+async def handle(callback: CallbackQuery):
+    pass
+
+def filter_chain_dispatcher(schemas: List[Type[CallbackData]]) -> Tuple[Dispatcher, Callable[[str], object]]:
+    """Прежний способ: по фильтру на каждый обработчик"""
+    dp = Dispatcher()
+    chain = []
+    for schema in schemas:
+        head = schema.key + schema.separator
+        check = lambda c, head=head: c.data.startswith(head)
+        dp.callback_query.register(handle, check)
+        chain.append(check)
+
+    def resolve(callback: CallbackQuery):
+        for check in chain:
+            if check(callback):
+                return check
+        return None
+    return dp, resolve
+
+def table_dispatcher(schemas: List[Type[CallbackData]]) -> Tuple[Dispatcher, Callable[[str], object]]:
+    dp = Dispatcher()
+    table = CallbackTable(dp)
+    for schema in schemas:
+        table.register(schema, handle)
+    return dp, lambda callback: table.resolve(callback.data)
+
+async def measure(dp: Dispatcher, resolve: Callable, bot: Bot, updates: List[Update]) -> Dict[str, float]:
+    started = time.perf_counter()
+    for update in updates:
+        resolve(update.callback_query)
+    resolve_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    dispatch_seconds = time.perf_counter() - started
+    return {
+        "resolve_us": resolve_seconds / len(updates) * 1e6,
+        "dispatch_us": dispatch_seconds / len(updates) * 1e6,
+    }
+
+async def run(args: argparse.Namespace) -> dict:
+    bot = Bot(token="123456:BENCHMARK")
+    rng = random.Random(1)
+    result = {"params": vars(args), "runs": []}
+    try:
+        for count in args.handlers:
+            schemas = make_schemas(count)
+            updates = [
+                make_update(update_id, rng.choice(schemas)(rng.randint(1, 12)).pack())
+                for update_id in range(args.updates)
+            ]
+            for name, build in (("filters", filter_chain_dispatcher), ("table", table_dispatcher)):
+                dp, resolve = build(schemas)
+                # Прогрев: первые вызовы заполняют кэши aiogram
+                await measure(dp, resolve, bot, updates[:100])
+                stats = await measure(dp, resolve, bot, updates)
+                result["runs"].append({"router": name, "handlers": count, **stats})
+    finally:
+        await bot.session.close()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--handlers", type=int, nargs="+", default=[5, 20, 100, 500])
+    parser.add_argument("--updates", type=int, default=20_000)
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(f"  {'router':8} {'handlers':>8} {'resolve':>12} {'dispatch':>12}")
+    for run_stats in result["runs"]:
+        print(
+            f"  {run_stats['router']:8} {run_stats['handlers']:>8} "
+            f"{run_stats['resolve_us']:>10.2f}us {run_stats['dispatch_us']:>10.2f}us"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Бенчмарк хранения конфигураций WireGuard.
+
+Сравнивает размер базы при хранении полного текста конфигурации в каждой
+строке и при хранении только данных клиента, а также скорость сборки текста:
+generate_config на каждый запрос, шаблон сервера и шаблон с LRU-кэшем готовых
+текстов при заданной доле повторных запросов (поиск в кэше дороже сборки,
+поэтому бот кэширует только шаблоны).
+
+    python benchmarks/config_storage.py --configs 100000 --renders 200000
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+import database
+from cache import TTLCache
+from ip_pool import AddressPool
+from peer_sync import PeerSync
+from servers import Server
+from wireguard import generate_config, render_config
+
+SERVER = {
+    "public_key": "gUeJZeLb2LLqGPa5nEBhJ1JyQmV+84ObsgxTodg9xwk=",
+    "endpoint": "203.0.113.10:51820",
+    "dns": "1.1.1.1,1.0.0.1",
+}
+
+def make_clients(count: int, rng: random.Random) -> List[Tuple[str, str, str]]:
+    """Тройки (приватный ключ, публичный ключ, IP) со случайными ключами"""
+    def key() -> str:
+        return base64.b64encode(rng.getrandbits(256).to_bytes(32, "big")).decode()
+    return [(key(), key(), f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}") for index in range(count)]
+
+def database_size(path: str) -> int:
+    db = sqlite3.connect(path)
+    db.execute("VACUUM")
+    db.close()
+    return os.path.getsize(path)
+
+async def measure_size(directory: str, clients: List[Tuple[str, str, str]]) -> Dict[str, int]:
+    compact = os.path.join(directory, "compact.db")
+    await database.init_db(compact)
+    await database.add_wireguard_configs([
+        (user_id, private_key, public_key, client_ip)
+        for user_id, (private_key, public_key, client_ip) in enumerate(clients, 1)
+    ])
+    await database.close_db()
+    size = database_size(compact)
+
+    # Прежний формат: полный текст конфигурации в каждой строке
+    full = os.path.join(directory, "full.db")
+    shutil.copy(compact, full)
+    db = sqlite3.connect(full)
+    with db:
+        db.executemany(
+            "UPDATE wireguard_configs SET config_text = ? WHERE id = ?",
+            (
+                (generate_config(private_key, SERVER["public_key"], SERVER["endpoint"], client_ip, SERVER["dns"]), config_id)
+                for config_id, (private_key, _, client_ip) in enumerate(clients, 1)
+            )
+        )
+    db.close()
+    return {"full_bytes": database_size(full), "compact_bytes": size}
+
+def measure_render(
+    clients: List[Tuple[str, str, str]], renders: int, repeat: float, cache_size: int, rng: random.Random
+) -> dict:
+    server = Server(
+        id=1, name="bench", endpoint=SERVER["endpoint"], public_key=SERVER["public_key"],
+        client_cidr="10.0.0.0/8", server_ip=None, dns=SERVER["dns"], capacity=len(clients),
+        is_enabled=True, pool=AddressPool("10.0.0.0/8", None), sync=PeerSync(1)
+    )
+    # Повторный запрос - та же конфигурация, что у одного из недавних клиентов
+    hot = clients[:max(1, cache_size // 2)]
+    requests = [rng.choice(hot) if rng.random() < repeat else rng.choice(clients) for _ in range(renders)]
+
+    result = {}
+    started = time.perf_counter()
+    for private_key, _, client_ip in requests:
+        generate_config(private_key, server.public_key, server.endpoint, client_ip, server.dns)
+    result["generate_config_us"] = (time.perf_counter() - started) / renders * 1e6
+
+    started = time.perf_counter()
+    for private_key, _, client_ip in requests:
+        render_config(server, private_key, client_ip)
+    result["template_us"] = (time.perf_counter() - started) / renders * 1e6
+
+    cache = TTLCache(cache_size, 3600)
+    started = time.perf_counter()
+    for private_key, _, client_ip in requests:
+        key = (private_key, client_ip)
+        config = cache.get(key, None)
+        if config is None:
+            cache.set(key, render_config(server, private_key, client_ip))
+    result["template_cache_us"] = (time.perf_counter() - started) / renders * 1e6
+    result["cache"] = cache.stats()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", type=int, default=100_000)
+    parser.add_argument("--renders", type=int, default=200_000)
+    parser.add_argument("--repeat", type=float, default=0.8, help="доля повторных запросов той же конфигурации")
+    parser.add_argument("--cache-size", type=int, default=1000, help="размер кэша готовых текстов")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    clients = make_clients(args.configs, rng)
+    with tempfile.TemporaryDirectory() as directory:
+        sizes = asyncio.run(measure_size(directory, clients))
+    render = measure_render(clients, args.renders, args.repeat, args.cache_size, rng)
+    result = {"params": vars(args), "size": sizes, "render": render}
+
+    print(f"  база, полный текст:     {sizes['full_bytes'] / 2**20:10.2f} МБ")
+    print(f"  база, данные клиента:   {sizes['compact_bytes'] / 2**20:10.2f} МБ")
+    print(f"  generate_config:        {render['generate_config_us']:10.2f}us")
+    print(f"  шаблон:                 {render['template_us']:10.2f}us")
+    print(f"  шаблон и кэш текстов:   {render['template_cache_us']:10.2f}us (попаданий {render['cache']['hit_ratio']:.0%})")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
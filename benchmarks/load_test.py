@@ -0,0 +1,401 @@
+"""Нагрузочный тест обработчиков бота и слоя базы данных.
+
+Запускает настоящий диспетчер aiogram из bot.py на синтетических обновлениях,
+подменяя Telegram Bot API и ЮKassa локальными фейковыми серверами, и
+сохраняет пропускную способность и перцентили задержек в JSON-файл:
+
+    python benchmarks/load_test.py --users 100000 --subscriptions 500000 \\
+        --requests 5000 --concurrency 200 --output bench_results.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import random
+import asyncio
+import argparse
+import sqlite3
+import subprocess
+import functools
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FAKE_TELEGRAM_PORT = 18181
+FAKE_YOOKASSA_PORT = 18182
+
+# Настройки должны попасть в окружение до импорта модулей бота
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("ADMIN_IDS", "1")
+os.environ.setdefault("YOOKASSA_API_URL", f"http://127.0.0.1:{FAKE_YOOKASSA_PORT}/v3")
+# Подсеть сервера по умолчанию должна вместить конфигурации всех пользователей
+os.environ.setdefault("WG_CLIENT_CIDR", "10.0.0.0/8")
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def summarize(samples: List[float], elapsed: float) -> dict:
+    return {
+        "count": len(samples),
+        "throughput": len(samples) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+    }
+
+class FakeTelegram:
+    """Минимальный Bot API: отвечает на методы, которые вызывают обработчики"""
+
+    def __init__(self):
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._message_id = 0
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        data = await request.post()
+        chat_id = int(data.get("chat_id", 0) or 0)
+        file_id = f"file{self._message_id}"
+
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "senddocument":
+            result = self._message(chat_id, document={"file_id": file_id, "file_unique_id": file_id})
+        elif method == "sendphoto":
+            result = self._message(chat_id, photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}
+            ])
+        elif method == "sendmessage":
+            result = self._message(chat_id, text=data.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+class FakeYooKassa:
+    """Минимальный API ЮKassa: создание и получение платежей"""
+
+    def __init__(self):
+        self.payments: Dict[str, dict] = {}
+
+    async def create(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        payment_id = f"bench-{len(self.payments) + 1}"
+        self.payments[payment_id] = {
+            "id": payment_id,
+            "status": "pending",
+            "amount": body["amount"],
+            "metadata": {key: str(value) for key, value in body["metadata"].items()},
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://pay.example/{payment_id}"}
+        }
+        return web.json_response(self.payments[payment_id])
+
+    async def get(self, request: web.Request) -> web.Response:
+        return web.json_response(self.payments[request.match_info["payment_id"]])
+
+async def start_server(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+def seed_rows(users: int, subscriptions: int, seed: int = 1) -> Tuple[Iterator, Iterator]:
+    """Строки пользователей и подписок для заполнения хранилища"""
+    rng = random.Random(seed)
+    now = datetime.now()
+
+    def subscription_rows():
+        for index in range(subscriptions):
+            user_id = index % users + 1
+            # Последняя подписка пользователя активна у ~60% пользователей,
+            # остальные давно истекли
+            latest = index + users >= subscriptions
+            if latest and rng.random() < 0.6:
+                start = now - timedelta(days=rng.randint(0, 25))
+                end, active = start + timedelta(days=30 * rng.choice((1, 3, 6, 12))), True
+            else:
+                start = now - timedelta(days=rng.randint(60, 900))
+                end, active = start + timedelta(days=30), False
+            months = rng.choice((1, 3, 6, 12))
+            is_trial = rng.random() < 0.3
+            yield (
+                user_id, start, end, "trial" if is_trial else f"{months}_months",
+                "trial" if is_trial else f"seed-{index}", is_trial, active
+            )
+
+    user_rows = ((user_id, f"user{user_id}") for user_id in range(1, users + 1))
+    return user_rows, subscription_rows()
+
+def seed_database(path: str, users: int, subscriptions: int, seed: int = 1) -> float:
+    """Заполняет базу SQLite пользователями и подписками"""
+    started = time.perf_counter()
+    user_rows, subscription_rows = seed_rows(users, subscriptions, seed)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = OFF")
+    with db:
+        db.executemany("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", user_rows)
+    with db:
+        db.executemany(
+            """
+            INSERT INTO subscriptions
+            (user_id, start_date, end_date, subscription_type, payment_id, is_trial, is_active)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            subscription_rows
+        )
+    db.execute("ANALYZE")
+    db.close()
+    return time.perf_counter() - started
+
+async def seed_storage(storage, users: int, subscriptions: int, seed: int = 1) -> float:
+    """Заполняет хранилище пользователями и подписками через его пакетные операции"""
+    started = time.perf_counter()
+    user_rows, subscription_rows = seed_rows(users, subscriptions, seed)
+    await storage.add_users(list(user_rows))
+    await storage.add_subscriptions(list(subscription_rows))
+    return time.perf_counter() - started
+
+async def seed_configs(storage, users: int) -> float:
+    """Выдает конфигурации пользователям так же, как бот: аренда адреса в пуле сервера и привязка к серверу"""
+    from servers import server_registry
+
+    started = time.perf_counter()
+    await server_registry.load()
+    server = next(iter(server_registry.servers.values()))
+    configs = [
+        (user_id, f"priv{user_id}", f"pub{user_id}", await server.pool.allocate())
+        for user_id in range(1, users + 1)
+    ]
+    await storage.add_wireguard_configs(configs)
+    # Импортированные конфигурации без записи пула остаются на первом сервере, как при запуске бота
+    await storage.assign_unplaced_to_server(server.id)
+    await server_registry.refresh_load()
+    return time.perf_counter() - started
+
+def instrument_storage(storage, samples: Dict[str, List[float]]):
+    """Оборачивает операции хранилища замером времени"""
+    from storage import OPERATIONS
+
+    def timed(name: str, func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                samples[name].append(time.perf_counter() - started)
+        return wrapper
+
+    for name in OPERATIONS:
+        func = getattr(storage, name)
+        if asyncio.iscoroutinefunction(func):
+            setattr(storage, name, timed(name, func))
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+def make_command(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": make_user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        }
+    }
+
+def make_callback(update_id: int, user_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": make_user(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "bench"
+            }
+        }
+    }
+
+def build_workload(requests: int, users: int, seed: int = 1) -> List[tuple]:
+    """Смесь обновлений: /start, пробный период, покупка и получение конфигурации"""
+    rng = random.Random(seed)
+    workload = []
+    next_new_user = users + 1
+    for update_id in range(1, requests + 1):
+        kind = rng.choices(("start", "trial", "buy", "config"), weights=(40, 15, 15, 30))[0]
+        if kind == "trial":
+            # Пробный период берут новые пользователи без подписки
+            user_id, next_new_user = next_new_user, next_new_user + 1
+            workload.append((kind, make_callback(update_id, user_id, "trial")))
+        elif kind == "start":
+            workload.append((kind, make_command(update_id, rng.randint(1, users), "/start")))
+        elif kind == "buy":
+            months = rng.choice((1, 3, 6, 12))
+            workload.append((kind, make_callback(update_id, rng.randint(1, users), f"buy_{months}")))
+        else:
+            user_id = rng.randint(1, users)
+            os_type = rng.choice(("windows", "macos", "linux", "ios", "android"))
+            workload.append((kind, make_callback(update_id, user_id, f"config_{os_type}_{user_id}")))
+    return workload
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def run(args: argparse.Namespace) -> dict:
+    # Хранилище выбирается при импорте модулей бота
+    os.environ["STORAGE_BACKEND"] = args.storage
+    os.environ["DATABASE_NAME"] = args.db
+
+    import bot as bot_module
+    import metrics
+    import payments
+    import wireguard
+    from storage import storage
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+
+    # Журнал каждого обновления и HTTP-запроса заметно искажает замеры
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+
+    telegram = FakeTelegram()
+    telegram_app = web.Application()
+    telegram_app.router.add_post("/bot{token}/{method}", telegram.handle)
+    yookassa = FakeYooKassa()
+    yookassa_app = web.Application()
+    yookassa_app.router.add_post("/v3/payments", yookassa.create)
+    yookassa_app.router.add_get("/v3/payments/{payment_id}", yookassa.get)
+    runners = [
+        await start_server(telegram_app, FAKE_TELEGRAM_PORT),
+        await start_server(yookassa_app, FAKE_YOOKASSA_PORT),
+    ]
+
+    bot, dp = bot_module.bot, bot_module.dp
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{FAKE_TELEGRAM_PORT}"))
+    session.middleware = bot.session.middleware
+    bot.session = session
+
+    result = {"revision": git_revision(), "started_at": datetime.now().isoformat(), "params": vars(args)}
+    db_samples: Dict[str, List[float]] = defaultdict(list)
+    handler_samples: Dict[str, List[float]] = defaultdict(list)
+    try:
+        if args.storage == "sqlite" and args.fresh and os.path.exists(args.db):
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(args.db + suffix):
+                    os.remove(args.db + suffix)
+        await storage.open()
+        await bot_module.outbox.start()
+
+        if await storage.count_users() < args.users:
+            if args.storage == "sqlite":
+                # Запись идет отдельным соединением sqlite3: пул в это время простаивает
+                result["seed_seconds"] = seed_database(args.db, args.users, args.subscriptions)
+            else:
+                result["seed_seconds"] = await seed_storage(storage, args.users, args.subscriptions)
+            result["seed_seconds"] += await seed_configs(storage, args.users)
+
+        workload = build_workload(args.requests, args.users)
+        trials = sum(1 for kind, _ in workload if kind == "trial")
+        started = time.perf_counter()
+        await wireguard.refill_identity_pool(trials)
+        result["pool_refill_seconds"] = time.perf_counter() - started
+
+        instrument_storage(storage, db_samples)
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def feed(kind: str, raw: dict):
+            update = Update.model_validate(raw, context={"bot": bot})
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                finally:
+                    handler_samples[kind].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(feed(kind, raw) for kind, raw in workload))
+        elapsed = time.perf_counter() - started
+
+        result["elapsed_seconds"] = elapsed
+        result["throughput"] = len(workload) / elapsed
+        result["handlers"] = {kind: summarize(samples, elapsed) for kind, samples in handler_samples.items()}
+        result["database"] = {name: summarize(samples, elapsed) for name, samples in db_samples.items()}
+        result["telegram_calls"] = dict(telegram.calls)
+        if args.metrics:
+            with open(args.metrics, "w") as f:
+                f.write(await metrics.collect())
+    finally:
+        await bot_module.outbox.stop()
+        await payments.yookassa.close()
+        await bot.session.close()
+        wireguard.shutdown_keygen_executor()
+        await storage.close()
+        for runner in runners:
+            await runner.cleanup()
+    return result
+
+def print_report(result: dict):
+    print(f"Ревизия {result['revision']}: {result['throughput']:.1f} обновлений/с")
+    for section in ("handlers", "database"):
+        print(f"\n{section}:")
+        print(f"  {'name':32} {'count':>8} {'rps':>9} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for name, stats in sorted(result[section].items()):
+            print(
+                f"  {name:32} {stats['count']:>8} {stats['throughput']:>9.1f} "
+                f"{stats['p50_ms']:>7.2f}ms {stats['p95_ms']:>7.2f}ms {stats['p99_ms']:>7.2f}ms"
+            )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=os.path.join(ROOT, "benchmarks", "bench.db"))
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--fresh", action="store_true", help="удалить базу перед запуском")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--subscriptions", type=int, default=500_000)
+    parser.add_argument("--requests", type=int, default=5_000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--metrics", help="сохранить снимок /metrics после прогона")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,8 @@
 import os
 import asyncio
 import logging
+from dataclasses import dataclass
 from datetime import datetime
-from decimal import Decimal
 from typing import Dict, Optional
 
 from aiogram import Bot, Dispatcher, types
@@ -11,18 +11,35 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
 
-from database import (
-    init_db, add_user, get_user, add_subscription,
-    get_active_subscription, save_wireguard_config,
-    get_expired_subscriptions, deactivate_subscription,
-    extend_subscription
-)
-from wireguard import create_client_config
-from yookassa import Configuration, Payment
-
-# Загрузка переменных окружения
+# Загрузка переменных окружения до импорта модулей, читающих настройки
 load_dotenv()
 
+from admin_handlers import (
+    ADMIN_IDS, DeactivateCallback, ExtendCallback, StatsCallback, SubscriptionsCallback,
+    router as admin_router
+)
+from callbacks import CallbackData, CallbackTable
+from config_handlers import ConfigCallback, router as config_router
+from metrics import Counter, queue_depth
+from middlewares import (
+    HandlerTimingMiddleware, InFlightMiddleware, TelegramRequestTimingMiddleware, ThrottlingMiddleware
+)
+from notifier import MessageQueue
+from peer_sync import WG_PEER_SYNC
+from pricing import calculate_price
+from scheduler import expiry_scheduler
+from servers import NoServerAvailableError, server_registry
+from storage import storage
+from traffic import WG_TRAFFIC_ACCOUNTING, format_traffic, traffic_collector
+from payments import create_subscription_payment, yookassa
+from webapp import (
+    BOT_MODE, UpdateWorkerPool, create_app, set_telegram_webhook,
+    setup_update_routes, start_app
+)
+from wireguard import (
+    create_client_config, run_identity_pool_refiller, shutdown_keygen_executor
+)
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
@@ -30,58 +47,93 @@ logging.basicConfig(level=logging.INFO)
 bot = Bot(token=os.getenv("BOT_TOKEN"))
 dp = Dispatcher()
 
-# Настройка YooKassa
-Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
-Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
-
-# Константы для цен и скидок
-PRICE_MONTH = Decimal(os.getenv("PRICE_MONTH", "399"))
-DISCOUNT_3_MONTHS = Decimal(os.getenv("DISCOUNT_3_MONTHS", "5"))
-DISCOUNT_6_MONTHS = Decimal(os.getenv("DISCOUNT_6_MONTHS", "10"))
-DISCOUNT_12_MONTHS = Decimal(os.getenv("DISCOUNT_12_MONTHS", "20"))
-
-# Список администраторов
-ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(",")))
-
-def calculate_price(months: int) -> Decimal:
-    """Рассчитывает цену с учетом скидки"""
-    base_price = PRICE_MONTH * months
-    if months >= 12:
-        discount = DISCOUNT_12_MONTHS
-    elif months >= 6:
-        discount = DISCOUNT_6_MONTHS
-    elif months >= 3:
-        discount = DISCOUNT_3_MONTHS
-    else:
-        discount = 0
-    
-    return base_price * (1 - discount / 100)
+# Частота обновлений от одного пользователя; администраторы не ограничиваются
+throttling = ThrottlingMiddleware(exempt=ADMIN_IDS)
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+# Повторные нажатия кнопки, пока первое обрабатывается, ждут его результата:
+# иначе каждое нажатие создает свой платеж или генерирует ключи заново
+dp.callback_query.middleware(InFlightMiddleware())
+
+# Время обработчиков и исходящих запросов к Bot API для /metrics
+dp.message.middleware(HandlerTimingMiddleware())
+dp.callback_query.middleware(HandlerTimingMiddleware())
+bot.session.middleware(TelegramRequestTimingMiddleware())
+
+dp.include_router(admin_router)
+dp.include_router(config_router)
+callbacks = CallbackTable(dp)
+
+@dataclass
+class TrialCallback(CallbackData, prefix="trial"):
+    pass
+
+@dataclass
+class PlansCallback(CallbackData, prefix="show_plans"):
+    pass
+
+# Разделитель "_" сохраняет формат кнопок в уже отправленных сообщениях
+@dataclass
+class BuyCallback(CallbackData, prefix="buy", separator="_"):
+    months: int
+
+trials_issued = Counter("vpn_bot_trials_issued_total", "Выданные тестовые периоды")
+
+# Все исходящие уведомления и рассылки идут через очередь с ограничением частоты
+outbox = MessageQueue(bot)
+queue_depth.labels("outbox").set_function(lambda: outbox.depth)
 
 def get_subscription_keyboard() -> types.InlineKeyboardMarkup:
     """Создает клавиатуру с тарифами"""
     builder = InlineKeyboardBuilder()
     
     plans = [
-        ("1 месяц", "buy_1"),
-        ("3 месяца (-5%)", "buy_3"),
-        ("6 месяцев (-10%)", "buy_6"),
-        ("12 месяцев (-20%)", "buy_12")
+        ("1 месяц", 1),
+        ("3 месяца (-5%)", 3),
+        ("6 месяцев (-10%)", 6),
+        ("12 месяцев (-20%)", 12)
     ]
     
-    for label, callback_data in plans:
-        builder.button(text=label, callback_data=callback_data)
+    for label, months in plans:
+        builder.button(text=label, callback_data=BuyCallback(months).pack())
     
     builder.adjust(1)
     return builder.as_markup()
 
+def get_config_keyboard(user_id: int) -> types.InlineKeyboardMarkup:
+    """Создает клавиатуру выбора операционной системы"""
+    builder = InlineKeyboardBuilder()
+    systems = [
+        ("Windows", "windows"),
+        ("MacOS", "macos"),
+        ("Linux", "linux"),
+        ("iOS", "ios"),
+        ("Android", "android")
+    ]
+    
+    for label, os_type in systems:
+        builder.button(text=label, callback_data=ConfigCallback(os_type, user_id).pack())
+    
+    builder.adjust(2)
+    return builder.as_markup()
+
+_return_url: Optional[str] = None
+
+async def get_return_url() -> str:
+    """Возвращает ссылку на бота для возврата после оплаты"""
+    global _return_url
+    if _return_url is None:
+        _return_url = f"https://t.me/{(await bot.me()).username}"
+    return _return_url
+
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     """Обработчик команды /start"""
-    user = await get_user(message.from_user.id)
+    user = await storage.get_user(message.from_user.id)
     if not user:
-        await add_user(message.from_user.id, message.from_user.username)
+        await storage.add_user(message.from_user.id, message.from_user.username)
         
-    active_sub = await get_active_subscription(message.from_user.id)
+    active_sub = await storage.get_active_subscription(message.from_user.id)
     
     if not active_sub:
         text = (
@@ -90,35 +142,56 @@ async def cmd_start(message: Message):
             "или выберите один из тарифов:"
         )
         builder = InlineKeyboardBuilder()
-        builder.button(text="🎁 Получить тестовый период", callback_data="trial")
-        builder.button(text="💳 Выбрать тариф", callback_data="show_plans")
+        builder.button(text="🎁 Получить тестовый период", callback_data=TrialCallback().pack())
+        builder.button(text="💳 Выбрать тариф", callback_data=PlansCallback().pack())
         builder.adjust(1)
         await message.answer(text, reply_markup=builder.as_markup())
     else:
         await show_subscription_status(message.from_user.id)
 
-@dp.callback_query(lambda c: c.data == "trial")
+async def cancel_trial(user_id: int):
+    """Отключает только что выданный тестовый период, если конфигурацию выдать не удалось"""
+    trial = await storage.get_active_subscription(user_id)
+    if trial is not None and trial["is_trial"]:
+        await storage.deactivate_subscriptions([trial["id"]])
+
+@callbacks(TrialCallback)
 async def process_trial(callback: CallbackQuery):
     """Обработка запроса на тестовый период"""
     user_id = callback.from_user.id
-    active_sub = await get_active_subscription(user_id)
+    active_sub = await storage.get_active_subscription(user_id)
     
     if active_sub:
         await callback.answer("У вас уже есть активная подписка!", show_alert=True)
         return
     
-    # Создаем тестовую подписку
-    await add_subscription(
+    # Создаем тестовую подписку; база не допустит второй активный тестовый период,
+    # даже если нажатия пришли в разные процессы бота
+    created = await storage.add_subscription(
         user_id=user_id,
         subscription_type="trial",
         duration_months=1,
         payment_id="trial",
         is_trial=True
     )
+    if not created:
+        await callback.answer("У вас уже есть активная подписка!", show_alert=True)
+        return
     
     # Генерируем конфигурацию WireGuard
-    private_key, public_key, config, qr_config = await create_client_config(user_id)
-    await save_wireguard_config(user_id, private_key, public_key, config)
+    try:
+        private_key, public_key, client_ip = await create_client_config(user_id)
+        await storage.save_wireguard_config(user_id, private_key, public_key, client_ip)
+    except NoServerAvailableError:
+        # Без конфигурации тестовый период бесполезен, а второй база уже не выдаст:
+        # отключаем его, чтобы пользователь мог попробовать позже
+        await cancel_trial(user_id)
+        await callback.answer("Свободных мест на серверах сейчас нет, попробуйте позже.", show_alert=True)
+        return
+    except Exception:
+        await cancel_trial(user_id)
+        raise
+    trials_issued.inc()
     
     # Отправляем конфигурацию
     text = (
@@ -126,56 +199,33 @@ async def process_trial(callback: CallbackQuery):
         "📱 Выберите вашу операционную систему для получения инструкций:"
     )
     
-    builder = InlineKeyboardBuilder()
-    systems = [
-        ("Windows", "config_windows"),
-        ("MacOS", "config_macos"),
-        ("Linux", "config_linux"),
-        ("iOS", "config_ios"),
-        ("Android", "config_android")
-    ]
-    
-    for label, callback_data in systems:
-        builder.button(text=label, callback_data=f"{callback_data}_{user_id}")
-    
-    builder.adjust(2)
-    await callback.message.answer(text, reply_markup=builder.as_markup())
+    await callback.message.answer(text, reply_markup=get_config_keyboard(user_id))
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "show_plans")
+@callbacks(PlansCallback)
 async def show_plans(callback: CallbackQuery):
     """Показывает доступные тарифы"""
     text = "Выберите подходящий тариф:"
     await callback.message.answer(text, reply_markup=get_subscription_keyboard())
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("buy_"))
-async def process_buy(callback: CallbackQuery):
+@callbacks(BuyCallback)
+async def process_buy(callback: CallbackQuery, callback_data: BuyCallback):
     """Обработка покупки подписки"""
-    months = int(callback.data.split("_")[1])
+    months = callback_data.months
     price = calculate_price(months)
     
-    payment = Payment.create({
-        "amount": {
-            "value": str(price),
-            "currency": "RUB"
-        },
-        "confirmation": {
-            "type": "redirect",
-            "return_url": f"https://t.me/{(await bot.me()).username}"
-        },
-        "capture": True,
-        "description": f"VPN подписка на {months} мес.",
-        "metadata": {
-            "user_id": callback.from_user.id,
-            "months": months
-        }
-    })
+    confirmation_url = await create_subscription_payment(
+        user_id=callback.from_user.id,
+        months=months,
+        price=price,
+        return_url=await get_return_url()
+    )
     
     builder = InlineKeyboardBuilder()
     builder.button(
         text="Оплатить",
-        url=payment.confirmation.confirmation_url
+        url=confirmation_url
     )
     
     text = (
@@ -189,7 +239,7 @@ async def process_buy(callback: CallbackQuery):
 
 async def show_subscription_status(user_id: int):
     """Показывает статус подписки"""
-    sub = await get_active_subscription(user_id)
+    sub = await storage.get_active_subscription(user_id)
     if not sub:
         text = "У вас нет активной подписки."
     else:
@@ -198,8 +248,13 @@ async def show_subscription_status(user_id: int):
             f"Ваша подписка активна до: {end_date.strftime('%d.%m.%Y')}\n"
             f"Тип подписки: {'Тестовый период' if sub['is_trial'] else 'Платная подписка'}"
         )
+        if WG_TRAFFIC_ACCOUNTING:
+            start_date = datetime.fromisoformat(sub["start_date"])
+            rx, tx = await storage.get_traffic_usage(user_id, int(start_date.timestamp()))
+            # rx/tx считаются со стороны сервера: rx - отправлено клиентом
+            text += f"\nТрафик за период: ↓ {format_traffic(tx)} ↑ {format_traffic(rx)}"
     
-    await bot.send_message(user_id, text)
+    await outbox.send(user_id, text)
 
 @dp.message(Command("status"))
 async def cmd_status(message: Message):
@@ -213,36 +268,105 @@ async def cmd_admin(message: Message):
         await message.answer("У вас нет доступа к админ-панели.")
         return
     
-    text = "Админ-панель:"
+    text = "Админ-панель:\n\nМассовые операции: /bulk\nСерверы: /servers, /rebalance\nСтатистика: /stats"
     builder = InlineKeyboardBuilder()
-    builder.button(text="Список активных подписок", callback_data="admin_subs")
-    builder.button(text="Отключить подписку", callback_data="admin_deactivate")
-    builder.button(text="Продлить подписку", callback_data="admin_extend")
+    builder.button(text="Список активных подписок", callback_data=SubscriptionsCallback().pack())
+    builder.button(text="Отключить подписку", callback_data=DeactivateCallback().pack())
+    builder.button(text="Продлить подписку", callback_data=ExtendCallback().pack())
+    builder.button(text="📊 Статистика", callback_data=StatsCallback().pack())
     builder.adjust(1)
     
     await message.answer(text, reply_markup=builder.as_markup())
 
-async def check_expired_subscriptions():
-    """Проверяет и отключает истекшие подписки"""
-    while True:
-        expired = await get_expired_subscriptions()
-        for user_id, sub_type in expired:
-            await deactivate_subscription(user_id)
-            await bot.send_message(
-                user_id,
-                "⚠️ Ваша подписка истекла. Для продления выберите новый тариф."
-            )
-        await asyncio.sleep(3600)  # Проверка каждый час
+async def notify_expired_subscriptions(expired):
+    """Уведомляет пользователей об истекших подписках"""
+    for user_id in {user_id for _, user_id in expired}:
+        # Пользователь мог уже оформить новую подписку
+        if await storage.get_active_subscription(user_id):
+            continue
+        await outbox.send(
+            user_id,
+            "⚠️ Ваша подписка истекла. Для продления выберите новый тариф.",
+            wait=False,
+            bulk=True
+        )
+
+async def notify_config_reissued(user_ids):
+    """Сообщает пользователям, что их конфигурация перевыпущена на другом сервере"""
+    for user_id in user_ids:
+        await outbox.send(
+            user_id,
+            "🔄 Ваш VPN перенесен на другой сервер. Старая конфигурация больше не работает, "
+            "скачайте новую:",
+            reply_markup=get_config_keyboard(user_id),
+            wait=False,
+            bulk=True
+        )
+
+async def notify_payment_activated(user_id: int, months: int):
+    """Сообщает пользователю об успешной оплате"""
+    text = (
+        f"✅ Оплата получена! Подписка на {months} мес. активирована.\n\n"
+        "📱 Выберите вашу операционную систему для получения инструкций:"
+    )
+    await outbox.send(user_id, text, reply_markup=get_config_keyboard(user_id))
 
 async def main():
     """Запуск бота"""
-    await init_db()
+    await storage.open()
+    try:
+        await run_bot()
+    finally:
+        # Пул закрывается и при ошибке запуска: его потоки не дают процессу завершиться
+        await storage.close()
+
+async def run_bot():
+    """Запускает фоновые задачи, HTTP-сервер и получение обновлений"""
+    await outbox.start()
+    
+    # Запуск отключения истекших подписок
+    expiry_scheduler.on_expired = notify_expired_subscriptions
+    asyncio.create_task(expiry_scheduler.run())
+    
+    # Запуск пополнения пула готовых конфигураций WireGuard
+    asyncio.create_task(run_identity_pool_refiller())
+    
+    # Реестр серверов WireGuard; при WG_PEER_SYNC он же синхронизирует пиров на серверах
+    await server_registry.load()
+    server_registry.on_reissued = notify_config_reissued
+    asyncio.create_task(server_registry.run(peer_sync=WG_PEER_SYNC))
+    
+    # Запуск учета трафика пользователей
+    if WG_TRAFFIC_ACCOUNTING:
+        asyncio.create_task(traffic_collector.run())
     
-    # Запуск проверки истекших подписок
-    asyncio.create_task(check_expired_subscriptions())
+    # HTTP-сервер: уведомления об оплате и, в режиме webhook, обновления Telegram
+    app = create_app(on_payment_activated=notify_payment_activated)
+    updates = None
+    if BOT_MODE == "webhook":
+        updates = UpdateWorkerPool(dp, bot)
+        setup_update_routes(app, updates)
+        await updates.start()
+    runner = await start_app(app)
     
     # Запуск бота
-    await dp.start_polling(bot)
+    try:
+        if updates is not None:
+            await dp.emit_startup(bot=bot)
+            await set_telegram_webhook(bot, dp)
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if updates is not None:
+            # Сначала дорабатываем принятые обновления, затем закрываем сервер
+            await updates.stop()
+            await dp.emit_shutdown(bot=bot)
+        await runner.cleanup()
+        await yookassa.close()
+        await outbox.stop()
+        shutdown_keygen_executor()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
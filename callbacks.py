@@ -0,0 +1,149 @@
+import logging
+import dataclasses
+from typing import Any, Callable, ClassVar, Dict, Optional, Tuple, Type, TypeVar, Union, get_type_hints
+
+from aiogram import Router
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.types import CallbackQuery
+
+# Ограничение Telegram на длину callback_data в байтах
+CALLBACK_DATA_LIMIT = 64
+
+# Типы полей, которые умеет упаковывать CallbackData
+FIELD_TYPES = (int, str)
+
+CallbackT = TypeVar("CallbackT", bound="CallbackData")
+
+class CallbackData:
+    """Типизированные данные кнопки: <ключ><разделитель><поле><разделитель><поле>...
+
+    Подклассы объявляются как dataclass с полями int и str. Ключ - префикс схемы,
+    начиная со второй версии к нему добавляется .v<версия>: кнопки в уже отправленных
+    сообщениях продолжают разбираться старой версией схемы, пока она зарегистрирована.
+    Последнее поле может содержать разделитель.
+    """
+    prefix: ClassVar[str]
+    version: ClassVar[int]
+    separator: ClassVar[str]
+    key: ClassVar[str]
+    field_types: ClassVar[Tuple[Tuple[str, type], ...]]
+
+    def __init_subclass__(cls, prefix: str, version: int = 1, separator: str = ":", **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not prefix or separator in prefix:
+            raise ValueError(f"Некорректный префикс callback_data: {prefix!r}")
+        cls.prefix = prefix
+        cls.version = version
+        cls.separator = separator
+        cls.key = prefix if version == 1 else f"{prefix}.v{version}"
+
+    @classmethod
+    def _fields(cls) -> Tuple[Tuple[str, type], ...]:
+        # Поля появляются после применения @dataclass, поэтому разбираются при первом обращении
+        if "field_types" not in cls.__dict__:
+            hints = get_type_hints(cls)
+            cls.field_types = tuple((field.name, hints[field.name]) for field in dataclasses.fields(cls))
+            for name, field_type in cls.field_types:
+                if field_type not in FIELD_TYPES:
+                    raise TypeError(f"{cls.__name__}.{name}: неподдерживаемый тип {field_type!r}")
+        return cls.field_types
+
+    def pack(self) -> str:
+        fields = self._fields()
+        values = [str(getattr(self, name)) for name, _ in fields]
+        for value in values[:-1]:
+            if self.separator in value:
+                raise ValueError(f"{type(self).__name__}: значение {value!r} содержит разделитель")
+        data = self.separator.join([self.key, *values])
+        if len(data.encode("utf-8")) > CALLBACK_DATA_LIMIT:
+            raise ValueError(f"{type(self).__name__}: callback_data длиннее {CALLBACK_DATA_LIMIT} байт")
+        return data
+
+    @classmethod
+    def unpack(cls: Type[CallbackT], data: str) -> CallbackT:
+        """Разбирает callback_data этой схемы; ValueError, если формат не совпадает"""
+        fields = cls._fields()
+        if not fields:
+            if data != cls.key:
+                raise ValueError(f"Лишние данные в {data!r}")
+            return cls()
+        head = cls.key + cls.separator
+        if not data.startswith(head):
+            raise ValueError(f"{data!r} не относится к {cls.__name__}")
+        values = data[len(head):].split(cls.separator, len(fields) - 1)
+        if len(values) != len(fields):
+            raise ValueError(f"Неверное число полей в {data!r}")
+        return cls(**{name: field_type(value) for (name, field_type), value in zip(fields, values)})
+
+@dataclasses.dataclass
+class CallbackRoute:
+    schema: Type[CallbackData]
+    handler: HandlerObject
+    state: Optional[State] = None
+
+class CallbackTable:
+    """Обработчики callback-запросов роутера, выбираемые по ключу схемы
+
+    На роутер регистрируется один обработчик aiogram; нужная схема находится
+    обращением к словарю по началу callback_data, поэтому стоимость выбора
+    не зависит от числа обработчиков. Обработчик схемы получает разобранные
+    данные в аргументе callback_data, а также все обычные аргументы aiogram.
+    """
+
+    def __init__(self, router: Router):
+        # Разделитель -> ключ схемы -> обработчик
+        self._routes: Dict[str, Dict[str, CallbackRoute]] = {}
+        router.callback_query.register(self._dispatch, self._match)
+
+    def __call__(
+        self, schema: Type[CallbackData], state: Optional[State] = None
+    ) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+        """Декоратор обработчика схемы; state ограничивает обработчик состоянием FSM"""
+        def decorator(callback: Callable[..., Any]) -> Callable[..., Any]:
+            self.register(schema, callback, state)
+            return callback
+        return decorator
+
+    def register(self, schema: Type[CallbackData], callback: Callable[..., Any], state: Optional[State] = None):
+        schema._fields()
+        for separator, routes in self._routes.items():
+            for key, route in routes.items():
+                # Ключи не должны перекрываться: иначе данные одной схемы найдут другую
+                if key == schema.key or schema.key.split(separator, 1)[0] == key \
+                        or key.split(schema.separator, 1)[0] == schema.key:
+                    raise ValueError(f"Ключ {schema.key!r} пересекается с {route.schema.__name__}")
+        self._routes.setdefault(schema.separator, {})[schema.key] = CallbackRoute(
+            schema, HandlerObject(callback=callback), state
+        )
+
+    def resolve(self, data: str) -> Optional[CallbackRoute]:
+        """Обработчик для callback_data или None"""
+        for separator, routes in self._routes.items():
+            route = routes.get(data.split(separator, 1)[0])
+            if route is not None:
+                return route
+        return None
+
+    async def _match(
+        self, callback: CallbackQuery, state: Optional[FSMContext] = None
+    ) -> Union[bool, Dict[str, Any]]:
+        route = self.resolve(callback.data or "")
+        if route is None:
+            return False
+        if route.state is not None and (state is None or await state.get_state() != route.state.state):
+            return False
+        try:
+            callback_data = route.schema.unpack(callback.data)
+        except ValueError as e:
+            logging.info("Некорректные данные кнопки %r: %s", callback.data, e)
+            callback_data = None
+        # Подмена handler: middleware и флаги видят обработчик схемы, а не диспетчер таблицы
+        return {"handler": route.handler, "callback_data": callback_data}
+
+    async def _dispatch(self, callback: CallbackQuery, **kwargs) -> Any:
+        if kwargs["callback_data"] is None:
+            await callback.answer("Кнопка устарела, откройте меню заново.", show_alert=True)
+            return None
+        return await kwargs["handler"].call(callback, **kwargs)
@@ -1,8 +1,24 @@
+import hashlib
+import logging
+from dataclasses import dataclass
+
 from aiogram import Router, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import CallbackQuery
-from database import get_active_subscription
+
+from callbacks import CallbackData, CallbackTable
+from servers import NoServerAvailableError
+from storage import storage
+from wireguard import get_config_text, get_qr_png
 
 router = Router()
+callbacks = CallbackTable(router)
+
+# Разделитель "_" сохраняет формат кнопок в уже отправленных сообщениях
+@dataclass
+class ConfigCallback(CallbackData, prefix="config", separator="_"):
+    os_type: str
+    user_id: int
 
 INSTRUCTIONS = {
     "windows": """
@@ -97,17 +113,16 @@ INSTRUCTIONS = {
 """
 }
 
-@router.callback_query(lambda c: c.data.startswith("config_"))
-async def send_config(callback: CallbackQuery):
+@callbacks(ConfigCallback)
+async def send_config(callback: CallbackQuery, callback_data: ConfigCallback):
     """Отправляет конфигурацию и инструкции для выбранной ОС"""
-    os_type, user_id = callback.data.split("_")[1:]
-    user_id = int(user_id)
+    os_type, user_id = callback_data.os_type, callback_data.user_id
     
     if callback.from_user.id != user_id:
         await callback.answer("Это не ваша конфигурация!", show_alert=True)
         return
     
-    sub = await get_active_subscription(user_id)
+    sub = await storage.get_active_subscription(user_id)
     if not sub:
         await callback.answer("У вас нет активной подписки!", show_alert=True)
         return
@@ -118,24 +133,74 @@ async def send_config(callback: CallbackQuery):
         await callback.answer("Неподдерживаемая операционная система!", show_alert=True)
         return
     
+    config = await storage.get_wireguard_config(user_id)
+    if not config:
+        await callback.answer("Конфигурация не найдена, обратитесь в поддержку.", show_alert=True)
+        return
+    
+    try:
+        config_text = await get_config_text(config)
+    except (NoServerAvailableError, ValueError):
+        logging.exception("Не удалось собрать конфигурацию пользователя %s", user_id)
+        await callback.answer("Конфигурация недоступна, обратитесь в поддержку.", show_alert=True)
+        return
+    
     # Отправляем инструкции
     await callback.message.answer(instructions)
     
     # Отправляем файл конфигурации
-    config_file = f"wireguard_{user_id}.conf"
-    with open(config_file, "w") as f:
-        f.write(sub["config"])
-    
-    await callback.message.answer_document(
-        types.FSInputFile(config_file),
-        caption="📝 Ваш файл конфигурации WireGuard"
-    )
+    await send_config_document(callback.message, config, config_text)
     
     # Если это мобильная ОС, отправляем QR-код
     if os_type.lower() in ["ios", "android"]:
-        await callback.message.answer_photo(
-            types.FSInputFile(f"qr_{user_id}.png"),
-            caption="📱 QR-код для быстрой настройки"
-        )
+        await send_config_qr(callback.message, config, config_text)
     
-    await callback.answer() 
\ No newline at end of file
+    await callback.answer()
+
+def config_hash(config_text: str) -> str:
+    """Версия конфигурации: file_id действителен, пока текст не изменился"""
+    return hashlib.sha256(config_text.encode("utf-8")).hexdigest()
+
+async def send_config_document(message: types.Message, config: dict, config_text: str):
+    """Отправляет файл конфигурации, повторно используя загруженный file_id"""
+    caption = "📝 Ваш файл конфигурации WireGuard"
+    content_hash = config_hash(config_text)
+    
+    file_id = await storage.get_telegram_file_id(config["id"], "document", content_hash)
+    if file_id:
+        try:
+            await message.answer_document(file_id, caption=caption)
+            return
+        except TelegramBadRequest:
+            # file_id больше не принимается: загружаем файл заново
+            pass
+    
+    # Файл формируется в памяти, без записи на диск
+    sent = await message.answer_document(
+        types.BufferedInputFile(
+            config_text.encode("utf-8"),
+            filename=f"wireguard_{config['user_id']}.conf"
+        ),
+        caption=caption
+    )
+    await storage.save_telegram_file_id(config["id"], "document", content_hash, sent.document.file_id) 
+
+async def send_config_qr(message: types.Message, config: dict, config_text: str):
+    """Отправляет QR-код конфигурации, повторно используя загруженный file_id"""
+    caption = "📱 QR-код для быстрой настройки"
+    content_hash = config_hash(config_text)
+    
+    file_id = await storage.get_telegram_file_id(config["id"], "qr", content_hash)
+    if file_id:
+        try:
+            await message.answer_photo(file_id, caption=caption)
+            return
+        except TelegramBadRequest:
+            pass
+    
+    png = await get_qr_png(config_text)
+    sent = await message.answer_photo(
+        types.BufferedInputFile(png, filename=f"qr_{config['user_id']}.png"),
+        caption=caption
+    )
+    await storage.save_telegram_file_id(config["id"], "qr", content_hash, sent.photo[-1].file_id)
\ No newline at end of file
@@ -1,50 +1,515 @@
+import os
+import asyncio
 import aiosqlite
 import datetime
-from typing import Optional, List, Tuple
-
-DATABASE_NAME = "vpn_bot.db"
-
-async def init_db():
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT TRUE
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                start_date TIMESTAMP,
-                end_date TIMESTAMP,
-                subscription_type TEXT,
-                payment_id TEXT,
-                is_trial BOOLEAN DEFAULT FALSE,
-                is_active BOOLEAN DEFAULT TRUE,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS wireguard_configs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                private_key TEXT,
-                public_key TEXT,
-                config_text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-        
-        await db.commit()
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, List, Set, Tuple
+
+from cache import TTLCache
+from events import notify
+from metrics import Counter, Gauge, Histogram, add_collector, timed
+
+DATABASE_NAME = os.getenv("DATABASE_NAME", "vpn_bot.db")
+
+# Подписок, изменяемых одной транзакцией при массовых операциях
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+
+# Разрешение хранения трафика: интервалы сборщика сворачиваются в часы, часы - в сутки
+TRAFFIC_RAW = 600
+TRAFFIC_HOURLY = 3600
+TRAFFIC_DAILY = 86400
+
+# Настройки пула соединений
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+# Кэш активных подписок по user_id
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "10000"))
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "300"))
+
+# Применяются к каждому соединению пула при открытии
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+)
+
+class StorageConflictError(Exception):
+    """Данные нарушают ограничение уникальности хранилища"""
+
+class ConnectionPool:
+    """Пул долгоживущих соединений с SQLite"""
+
+    def __init__(self, database: str, size: int = DB_POOL_SIZE):
+        self.database = database
+        self.size = size
+        self._connections: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    async def open(self):
+        """Открывает соединения и применяет PRAGMA-настройки"""
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            # sqlite3 кэширует подготовленные выражения по тексту запроса,
+            # поэтому все запросы ниже записаны строковыми константами
+            db = await aiosqlite.connect(
+                self.database,
+                cached_statements=DB_STATEMENT_CACHE_SIZE
+            )
+            for pragma in PRAGMAS:
+                await db.execute(pragma)
+            self._connections.append(db)
+            self._idle.put_nowait(db)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Выдает свободное соединение и возвращает его в пул после использования"""
+        db = await self._idle.get()
+        try:
+            yield db
+        finally:
+            # Незавершенная транзакция удерживала бы блокировку на запись
+            if db.in_transaction:
+                await db.rollback()
+            self._idle.put_nowait(db)
+
+    @property
+    def idle(self) -> int:
+        """Количество свободных соединений"""
+        return self._idle.qsize() if self._idle is not None else 0
+
+    async def close(self):
+        """Закрывает все соединения пула"""
+        for db in self._connections:
+            await db.close()
+        self._connections.clear()
+        self._idle = None
+
+_pool: Optional[ConnectionPool] = None
+
+# Записи сбрасываются при добавлении, продлении и отключении подписок
+# и истекают не позже end_date подписки
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL)
+
+db_query_seconds = Histogram(
+    "vpn_bot_db_query_seconds", "Время выполнения функций базы данных", ["function"]
+)
+db_pool_idle = Gauge("vpn_bot_db_pool_idle_connections", "Свободные соединения пула")
+db_pool_idle.set_function(lambda: _pool.idle if _pool is not None else 0)
+subscription_cache_requests = Counter(
+    "vpn_bot_subscription_cache_total", "Обращения к кэшу подписок и вытеснения", ["event"]
+)
+subscription_cache_size = Gauge("vpn_bot_subscription_cache_entries", "Записи в кэше подписок")
+
+async def _collect_cache_metrics():
+    # Счетчики ведет сам кэш, здесь они только переносятся в метрики
+    stats = subscription_cache.stats()
+    for event, key in (("hit", "hits"), ("miss", "misses"), ("eviction", "evictions")):
+        subscription_cache_requests.labels(event).value = stats[key]
+    subscription_cache_size.set(stats["size"])
+
+add_collector(_collect_cache_metrics)
+
+def _connection():
+    """Возвращает контекст с соединением из общего пула"""
+    if _pool is None:
+        raise RuntimeError("База данных не инициализирована: вызовите init_db()")
+    return _pool.acquire()
+
+async def close_db():
+    """Закрывает пул соединений при остановке бота"""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+    subscription_cache.clear()
+
+# Миграции схемы: (версия, описание, SQL-выражения). Применяются по порядку
+# при запуске, каждая в своей транзакции. Новые миграции добавляются в конец.
+MIGRATIONS = [
+    (1, "Базовые таблицы", (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            start_date TIMESTAMP,
+            end_date TIMESTAMP,
+            subscription_type TEXT,
+            payment_id TEXT,
+            is_trial BOOLEAN DEFAULT FALSE,
+            is_active BOOLEAN DEFAULT TRUE,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS wireguard_configs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            private_key TEXT,
+            public_key TEXT,
+            config_text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+    )),
+    (2, "Индексы для поиска активных и истекших подписок", (
+        # Условие частичного индекса должно дословно совпадать с условием
+        # в запросах, иначе планировщик SQLite его не использует
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active
+        ON subscriptions (user_id, end_date) WHERE is_active = TRUE
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_active_end
+        ON subscriptions (end_date) WHERE is_active = TRUE
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_wireguard_configs_user
+        ON wireguard_configs (user_id)
+        """,
+    )),
+    (3, "Пул заранее подготовленных клиентских ключей и адресов", (
+        """
+        CREATE TABLE IF NOT EXISTS client_identities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            private_key TEXT NOT NULL,
+            public_key TEXT NOT NULL UNIQUE,
+            client_ip TEXT NOT NULL UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            claimed_by INTEGER,
+            claimed_at TIMESTAMP
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_client_identities_free
+        ON client_identities (id) WHERE claimed_by IS NULL
+        """,
+    )),
+    (4, "Аренда IP-адресов клиентов", (
+        "ALTER TABLE wireguard_configs ADD COLUMN client_ip TEXT",
+        "ALTER TABLE wireguard_configs ADD COLUMN is_active BOOLEAN DEFAULT TRUE",
+        """
+        CREATE TABLE IF NOT EXISTS ip_leases (
+            address TEXT PRIMARY KEY,
+            leased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+        """,
+        "INSERT OR IGNORE INTO ip_leases (address) SELECT client_ip FROM client_identities",
+    )),
+    (5, "Платежи ЮKassa", (
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            months INTEGER,
+            amount TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+    )),
+    (6, "Кэш file_id загруженных в Telegram файлов конфигураций", (
+        """
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            config_id INTEGER,
+            kind TEXT,
+            content_hash TEXT,
+            file_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (config_id, kind),
+            FOREIGN KEY (config_id) REFERENCES wireguard_configs (id)
+        )
+        """,
+    )),
+    (7, "Учет трафика пользователей", (
+        # resolution - длина интервала в секундах, bucket - его начало (unix time)
+        """
+        CREATE TABLE IF NOT EXISTS traffic_usage (
+            user_id INTEGER,
+            resolution INTEGER,
+            bucket INTEGER,
+            rx INTEGER,
+            tx INTEGER,
+            PRIMARY KEY (user_id, resolution, bucket)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_traffic_usage_bucket ON traffic_usage (resolution, bucket)",
+        # До какого момента данные уже свернуты в интервалы resolution
+        """
+        CREATE TABLE IF NOT EXISTS traffic_rollups (
+            resolution INTEGER PRIMARY KEY,
+            rolled_up_to INTEGER
+        )
+        """,
+    )),
+    (8, "Реестр серверов WireGuard", (
+        """
+        CREATE TABLE IF NOT EXISTS servers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            endpoint TEXT,
+            public_key TEXT,
+            client_cidr TEXT NOT NULL UNIQUE,
+            server_ip TEXT,
+            dns TEXT,
+            capacity INTEGER NOT NULL,
+            wg_interface TEXT DEFAULT 'wg0',
+            wg_command TEXT,
+            is_enabled BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Существующие записи без сервера привязываются к первому серверу при запуске
+        "ALTER TABLE wireguard_configs ADD COLUMN server_id INTEGER REFERENCES servers (id)",
+        "ALTER TABLE client_identities ADD COLUMN server_id INTEGER REFERENCES servers (id)",
+        "DROP INDEX IF EXISTS idx_client_identities_free",
+        """
+        CREATE INDEX IF NOT EXISTS idx_client_identities_free
+        ON client_identities (server_id, id) WHERE claimed_by IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_wireguard_configs_server
+        ON wireguard_configs (server_id) WHERE is_active = TRUE
+        """,
+    )),
+    (9, "Не больше одного активного тестового периода на пользователя", (
+        # Из уже выданных повторных тестовых периодов остается действовать последний
+        """
+        UPDATE subscriptions SET is_active = FALSE
+        WHERE is_trial = TRUE AND is_active = TRUE AND id NOT IN (
+            SELECT MAX(id) FROM subscriptions
+            WHERE is_trial = TRUE AND is_active = TRUE
+            GROUP BY user_id
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_subscriptions_active_trial
+        ON subscriptions (user_id) WHERE is_trial = TRUE AND is_active = TRUE
+        """,
+    )),
+    (10, "Дневная статистика подписок по тарифам", (
+        # plan - тип подписки: trial или <N>_months. started - новые подписки,
+        # renewals - оплаченные продления, conversions - первые оплаты после
+        # тестового периода, churned - отключенные подписки
+        """
+        CREATE TABLE IF NOT EXISTS subscription_stats (
+            day TEXT,
+            plan TEXT,
+            started INTEGER NOT NULL DEFAULT 0,
+            renewals INTEGER NOT NULL DEFAULT 0,
+            conversions INTEGER NOT NULL DEFAULT 0,
+            churned INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, plan)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_user_trial
+        ON subscriptions (user_id) WHERE is_trial = TRUE
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_payments_user ON payments (user_id, status)",
+    )),
+    (11, "Конфигурации хранят только данные клиента", (
+        # У конфигураций, выданных до аренды адресов, адрес есть только в тексте
+        """
+        UPDATE wireguard_configs
+        SET client_ip = substr(
+            config_text,
+            instr(config_text, 'Address = ') + 10,
+            instr(substr(config_text, instr(config_text, 'Address = ') + 10), '/') - 1
+        )
+        WHERE client_ip IS NULL AND instr(config_text, 'Address = ') > 0
+            AND instr(substr(config_text, instr(config_text, 'Address = ') + 10), '/') > 0
+        """,
+        """
+        INSERT OR IGNORE INTO ip_leases (address)
+        SELECT client_ip FROM wireguard_configs WHERE is_active = TRUE AND client_ip IS NOT NULL
+        """,
+        # Текст конфигурации собирается из записи и настроек сервера при отправке.
+        # Столбец остается: DROP COLUMN нет в SQLite до 3.35
+        "UPDATE wireguard_configs SET config_text = NULL WHERE client_ip IS NOT NULL",
+    )),
+    (12, "Отметка о применении оплаты к подписке", (
+        # Подписка меняется в одной транзакции с отметкой: повторная обработка
+        # платежа после сбоя не продлевает подписку второй раз
+        "ALTER TABLE payments ADD COLUMN applied_at TIMESTAMP",
+        "UPDATE payments SET applied_at = updated_at WHERE status = 'succeeded'",
+    )),
+    (13, "Поиск выданных ботом ключей", (
+        # Синхронизация удаляет с интерфейса только пиров, выданных ботом
+        "CREATE INDEX IF NOT EXISTS idx_wireguard_configs_public_key ON wireguard_configs (public_key)",
+    )),
+    (14, "Продления администратором в статистике", (
+        # extended - продления без оплаты (/extend, /bulk); в выручку не входят
+        "ALTER TABLE subscription_stats ADD COLUMN extended INTEGER NOT NULL DEFAULT 0",
+    )),
+]
+
+# После этой миграции статистика восстанавливается по уже накопленным данным
+STATS_MIGRATION = 10
+# После этой миграции файл базы сжимается: освобождаются страницы текстов конфигураций
+COMPACT_CONFIGS_MIGRATION = 11
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    """Возвращает номер последней примененной миграции"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    async with db.execute("SELECT MAX(version) FROM schema_version") as cursor:
+        result = await cursor.fetchone()
+        return result[0] or 0
+
+async def apply_migrations(db: aiosqlite.Connection) -> List[int]:
+    """Применяет непримененные миграции и возвращает их номера"""
+    current = await get_schema_version(db)
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                await db.execute(statement)
+            await db.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+GET_ACTIVE_SUBSCRIPTION_SQL = """
+    SELECT * FROM subscriptions
+    WHERE user_id = ? AND is_active = TRUE AND end_date > datetime('now')
+    ORDER BY end_date DESC LIMIT 1
+"""
+
+GET_EXPIRED_SUBSCRIPTIONS_SQL = """
+    SELECT user_id, subscription_type FROM subscriptions
+    WHERE is_active = TRUE AND end_date < datetime('now')
+"""
+
+GET_SUBSCRIPTION_DEADLINES_SQL = """
+    SELECT id, user_id, end_date FROM subscriptions
+    WHERE is_active = TRUE AND end_date <= ?
+    ORDER BY end_date
+"""
+
+# Постраничный просмотр по ключу (end_date, id): страница начинается сразу
+# после последней строки предыдущей, без OFFSET и пересчета пропущенных строк
+ACTIVE_SUBSCRIPTIONS_AFTER_SQL = """
+    SELECT s.id, s.user_id, u.username, s.subscription_type, s.is_trial, s.end_date
+    FROM subscriptions AS s LEFT JOIN users AS u ON u.user_id = s.user_id
+    WHERE s.is_active = TRUE AND (s.end_date, s.id) > (?, ?)
+    ORDER BY s.end_date, s.id LIMIT ?
+"""
+
+ACTIVE_SUBSCRIPTIONS_BEFORE_SQL = """
+    SELECT s.id, s.user_id, u.username, s.subscription_type, s.is_trial, s.end_date
+    FROM subscriptions AS s LEFT JOIN users AS u ON u.user_id = s.user_id
+    WHERE s.is_active = TRUE AND (s.end_date, s.id) < (?, ?)
+    ORDER BY s.end_date DESC, s.id DESC LIMIT ?
+"""
+
+EXPORT_ACTIVE_SUBSCRIPTIONS_SQL = """
+    SELECT s.id, s.user_id, u.username, s.subscription_type, s.is_trial,
+           s.start_date, s.end_date, s.payment_id
+    FROM subscriptions AS s LEFT JOIN users AS u ON u.user_id = s.user_id
+    WHERE s.is_active = TRUE
+    ORDER BY s.end_date, s.id
+"""
+
+# Первая оплата пользователя, у которого был тестовый период; текущий платеж
+# в это время еще в статусе processing
+FIRST_PAYMENT_AFTER_TRIAL_SQL = """
+    SELECT 1 FROM subscriptions
+    WHERE user_id = ? AND is_trial = TRUE
+        AND NOT EXISTS (SELECT 1 FROM payments WHERE user_id = ? AND applied_at IS NOT NULL)
+    LIMIT 1
+"""
+
+# Счетчики дневной статистики в порядке столбцов subscription_stats
+STATS_COLUMNS = ("started", "renewals", "conversions", "churned", "extended")
+
+SUBSCRIPTION_STATS_SQL = """
+    SELECT day, plan, started, renewals, conversions, churned, extended
+    FROM subscription_stats
+    WHERE day >= ?
+    ORDER BY day, plan
+"""
+
+# Горячие запросы, которые обязаны использовать индексы: имя -> (SQL, параметры)
+HOT_QUERIES = {
+    "get_active_subscription": (GET_ACTIVE_SUBSCRIPTION_SQL, (0,)),
+    "get_expired_subscriptions": (GET_EXPIRED_SUBSCRIPTIONS_SQL, ()),
+    "get_subscription_deadlines": (GET_SUBSCRIPTION_DEADLINES_SQL, ("",)),
+    "active_subscriptions_after": (ACTIVE_SUBSCRIPTIONS_AFTER_SQL, ("", 0, 1)),
+    "active_subscriptions_before": (ACTIVE_SUBSCRIPTIONS_BEFORE_SQL, ("", 0, 1)),
+    "first_payment_after_trial": (FIRST_PAYMENT_AFTER_TRIAL_SQL, (0, 0)),
+    "subscription_stats": (SUBSCRIPTION_STATS_SQL, ("",)),
+}
+
+async def check_query_plans(db: aiosqlite.Connection) -> dict:
+    """Проверяет, что горячие запросы не деградировали до полного сканирования"""
+    plans = {}
+    for name, (query, params) in HOT_QUERIES.items():
+        async with db.execute(f"EXPLAIN QUERY PLAN {query}", params) as cursor:
+            details = [row[3] for row in await cursor.fetchall()]
+        plans[name] = details
+        scans = [detail for detail in details if detail.startswith("SCAN")]
+        if scans:
+            raise RuntimeError(
+                f"Запрос {name} выполняется полным сканированием: {'; '.join(scans)}"
+            )
+    return plans
+
+async def init_db(database: Optional[str] = None):
+    global _pool
+    path = database or DATABASE_NAME
+    # Миграции и проверка планов идут на отдельном соединении до открытия пула:
+    # EXPLAIN на соединении, прочитавшем схему раньше, не видит новых индексов
+    async with aiosqlite.connect(path) as db:
+        for pragma in PRAGMAS:
+            await db.execute(pragma)
+        applied = await apply_migrations(db)
+        if COMPACT_CONFIGS_MIGRATION in applied:
+            await db.execute("VACUUM")
+        await check_query_plans(db)
 
+    if _pool is None:
+        _pool = ConnectionPool(path)
+        await _pool.open()
+    if STATS_MIGRATION in applied:
+        try:
+            await rebuild_subscription_stats()
+        except Exception:
+            await close_db()
+            raise
+
+@timed(db_query_seconds)
 async def add_user(user_id: int, username: str) -> bool:
-    async with aiosqlite.connect(DATABASE_NAME) as db:
+    async with _connection() as db:
         try:
             await db.execute(
                 "INSERT INTO users (user_id, username) VALUES (?, ?)",
@@ -53,10 +518,29 @@ async def add_user(user_id: int, username: str) -> bool:
             await db.commit()
             return True
         except aiosqlite.IntegrityError:
+            await db.rollback()
             return False
 
+@timed(db_query_seconds)
+async def add_users(users: List[Tuple[int, str]]) -> int:
+    """Добавляет пользователей (user_id, username) одной транзакцией, пропуская существующих"""
+    async with _connection() as db:
+        cursor = await db.executemany(
+            "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", users
+        )
+        await db.commit()
+        return cursor.rowcount
+
+@timed(db_query_seconds)
+async def count_users() -> int:
+    """Возвращает количество пользователей"""
+    async with _connection() as db:
+        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
+            return (await cursor.fetchone())[0]
+
+@timed(db_query_seconds)
 async def get_user(user_id: int) -> Optional[dict]:
-    async with aiosqlite.connect(DATABASE_NAME) as db:
+    async with _connection() as db:
         async with db.execute(
             "SELECT * FROM users WHERE user_id = ?", (user_id,)
         ) as cursor:
@@ -70,6 +554,7 @@ async def get_user(user_id: int) -> Optional[dict]:
                 }
             return None
 
+@timed(db_query_seconds)
 async def add_subscription(
     user_id: int,
     subscription_type: str,
@@ -77,28 +562,716 @@ async def add_subscription(
     payment_id: str,
     is_trial: bool = False
 ) -> bool:
+    """Добавляет подписку; False, если у пользователя уже есть активный тестовый период"""
     start_date = datetime.datetime.now()
     end_date = start_date + datetime.timedelta(days=30 * duration_months)
     
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute(
+    async with _connection() as db:
+        # Второй активный тестовый период отсекает уникальный индекс idx_subscriptions_active_trial
+        cursor = await db.execute(
             """
             INSERT INTO subscriptions 
             (user_id, start_date, end_date, subscription_type, payment_id, is_trial)
             VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT DO NOTHING
             """,
             (user_id, start_date, end_date, subscription_type, payment_id, is_trial)
         )
+        if cursor.rowcount:
+            day = start_date.date().isoformat()
+            await _add_stats(db, day, subscription_type, "started")
+            if not is_trial:
+                await _record_conversion(db, day, subscription_type, user_id)
         await db.commit()
-        return True
+    if not cursor.rowcount:
+        return False
+    
+    subscription_cache.invalidate(user_id)
+    notify("subscription_changed", cursor.lastrowid, user_id, end_date)
+    return True
 
+@timed(db_query_seconds)
+async def add_subscriptions(subscriptions: List[tuple]) -> int:
+    """Импортирует подписки одной транзакцией без уведомлений
+
+    Строка: (user_id, start_date, end_date, subscription_type, payment_id, is_trial, is_active).
+    """
+    async with _connection() as db:
+        try:
+            cursor = await db.executemany(
+                """
+                INSERT INTO subscriptions
+                (user_id, start_date, end_date, subscription_type, payment_id, is_trial, is_active)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                subscriptions
+            )
+        except aiosqlite.IntegrityError as e:
+            raise StorageConflictError("У пользователя может быть только один активный тестовый период") from e
+        await db.commit()
+    subscription_cache.clear()
+    return cursor.rowcount
+
+@timed(db_query_seconds)
 async def get_active_subscription(user_id: int) -> Optional[dict]:
-    async with aiosqlite.connect(DATABASE_NAME) as db:
+    cached = subscription_cache.get(user_id, False)
+    if cached is not False:
+        return dict(cached) if cached else None
+    
+    generation = subscription_cache.generation
+    async with _connection() as db:
+        async with db.execute(GET_ACTIVE_SUBSCRIPTION_SQL, (user_id,)) as cursor:
+            result = await cursor.fetchone()
+    
+    if not result:
+        subscription_cache.set(user_id, None, generation)
+        return None
+    sub = {
+        "id": result[0],
+        "user_id": result[1],
+        "start_date": result[2],
+        "end_date": result[3],
+        "subscription_type": result[4],
+        "payment_id": result[5],
+        "is_trial": result[6],
+        "is_active": result[7]
+    }
+    subscription_cache.set(
+        user_id, sub, generation,
+        expires=datetime.datetime.fromisoformat(sub["end_date"])
+    )
+    return dict(sub)
+
+@timed(db_query_seconds)
+async def save_wireguard_config(
+    user_id: int,
+    private_key: str,
+    public_key: str,
+    client_ip: Optional[str] = None
+) -> bool:
+    """Сохраняет данные клиента; текст конфигурации собирается при отправке"""
+    async with _connection() as db:
+        await db.execute(
+            """
+            INSERT INTO wireguard_configs 
+            (user_id, private_key, public_key, client_ip, server_id)
+            VALUES (?, ?, ?, ?, (SELECT server_id FROM client_identities WHERE client_ip = ?))
+            """,
+            (user_id, private_key, public_key, client_ip, client_ip)
+        )
+        await db.commit()
+    
+    notify("config_saved", user_id)
+    return True
+
+@timed(db_query_seconds)
+async def add_wireguard_configs(configs: List[Tuple[int, str, str, Optional[str]]]) -> int:
+    """Импортирует конфигурации одной транзакцией без уведомлений
+
+    Строка: (user_id, private_key, public_key, client_ip).
+    """
+    async with _connection() as db:
+        cursor = await db.executemany(
+            """
+            INSERT INTO wireguard_configs
+            (user_id, private_key, public_key, client_ip, server_id)
+            VALUES (?, ?, ?, ?, (SELECT server_id FROM client_identities WHERE client_ip = ?))
+            """,
+            [config + (config[3],) for config in configs]
+        )
+        await db.commit()
+        return cursor.rowcount
+
+@timed(db_query_seconds)
+async def get_expired_subscriptions() -> List[Tuple[int, str]]:
+    async with _connection() as db:
+        async with db.execute(GET_EXPIRED_SUBSCRIPTIONS_SQL) as cursor:
+            return await cursor.fetchall()
+
+# Максимальное число параметров в одном запросе с IN (...)
+BATCH_CHUNK_SIZE = 500
+
+async def _release_user_addresses(db: aiosqlite.Connection, user_ids: List[int]) -> List[str]:
+    """Освобождает IP-адреса пользователей, у которых не осталось активных подписок"""
+    addresses = []
+    for start in range(0, len(user_ids), BATCH_CHUNK_SIZE):
+        chunk = user_ids[start:start + BATCH_CHUNK_SIZE]
+        placeholders = ", ".join("?" * len(chunk))
         async with db.execute(
+            f"""
+            SELECT client_ip FROM wireguard_configs AS wc
+            WHERE user_id IN ({placeholders}) AND is_active = TRUE AND client_ip IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM subscriptions
+                WHERE user_id = wc.user_id AND is_active = TRUE AND end_date > datetime('now')
+            )
+            """,
+            chunk
+        ) as cursor:
+            addresses.extend(row[0] for row in await cursor.fetchall())
+    
+    await _release_addresses(db, addresses)
+    return addresses
+
+async def _release_addresses(db: aiosqlite.Connection, addresses: List[str]):
+    """Отключает конфигурации с этими адресами и удаляет аренду и записи пула"""
+    if addresses:
+        params = [(address,) for address in addresses]
+        await db.executemany(
             """
-            SELECT * FROM subscriptions 
-            WHERE user_id = ? AND is_active = TRUE AND end_date > datetime('now')
-            ORDER BY end_date DESC LIMIT 1
+            DELETE FROM telegram_files WHERE config_id IN (
+                SELECT id FROM wireguard_configs WHERE client_ip = ? AND is_active = TRUE
+            )
+            """,
+            params
+        )
+        await db.executemany(
+            "UPDATE wireguard_configs SET is_active = FALSE WHERE client_ip = ? AND is_active = TRUE",
+            params
+        )
+        await db.executemany("DELETE FROM ip_leases WHERE address = ?", params)
+        await db.executemany(
+            "DELETE FROM client_identities WHERE client_ip = ? AND claimed_by IS NOT NULL",
+            params
+        )
+
+async def _add_stats(db: aiosqlite.Connection, day: str, plan: str, column: str, count: int = 1):
+    """Увеличивает счетчик дневной статистики тарифа"""
+    await db.execute(
+        f"""
+        INSERT INTO subscription_stats (day, plan, {column}) VALUES (?, ?, ?)
+        ON CONFLICT (day, plan) DO UPDATE SET {column} = {column} + excluded.{column}
+        """,
+        (day, plan, count)
+    )
+
+async def _record_conversion(db: aiosqlite.Connection, day: str, plan: str, user_id: int):
+    """Учитывает оплату как конверсию, если это первая оплата после тестового периода"""
+    async with db.execute(FIRST_PAYMENT_AFTER_TRIAL_SQL, (user_id, user_id)) as cursor:
+        if await cursor.fetchone():
+            await _add_stats(db, day, plan, "conversions")
+
+async def _record_by_plan(db: aiosqlite.Connection, column: str, plans: List[str]):
+    """Учитывает подписки в сегодняшнем счетчике column по их тарифам"""
+    day = datetime.date.today().isoformat()
+    counts: Dict[str, int] = {}
+    for plan in plans:
+        counts[plan] = counts.get(plan, 0) + 1
+    for plan, count in counts.items():
+        await _add_stats(db, day, plan, column, count)
+
+# Через сколько секунд незавершенную обработку платежа можно начать заново
+PAYMENT_CLAIM_TIMEOUT = 600
+
+@timed(db_query_seconds)
+async def deactivate_subscriptions(subscription_ids: List[int]) -> List[Tuple[int, int]]:
+    """Отключает подписки одной транзакцией и возвращает пары (id, user_id)"""
+    deactivated = []
+    async with _connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        for start in range(0, len(subscription_ids), BATCH_CHUNK_SIZE):
+            chunk = subscription_ids[start:start + BATCH_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            async with db.execute(
+                f"""
+                UPDATE subscriptions SET is_active = FALSE
+                WHERE is_active = TRUE AND id IN ({placeholders})
+                RETURNING id, user_id, subscription_type
+                """,
+                chunk
+            ) as cursor:
+                rows = await cursor.fetchall()
+            deactivated.extend((row[0], row[1]) for row in rows)
+            await _record_by_plan(db, "churned", [row[2] for row in rows])
+        released = await _release_user_addresses(db, list({user_id for _, user_id in deactivated}))
+        await db.commit()
+    
+    if deactivated:
+        subscription_cache.invalidate(*{user_id for _, user_id in deactivated})
+        notify("subscriptions_deactivated", deactivated)
+    if released:
+        notify("addresses_released", released)
+    return deactivated
+
+@timed(db_query_seconds)
+async def deactivate_subscription(subscription_id: int) -> bool:
+    await deactivate_subscriptions([subscription_id])
+    return True
+
+@timed(db_query_seconds)
+async def extend_subscription(subscription_id: int, months: int) -> bool:
+    """Продлевает подписку без оплаты; учитывается в статистике как extended"""
+    async with _connection() as db:
+        async with db.execute(
+            """
+            UPDATE subscriptions 
+            SET end_date = datetime(end_date, '+' || ? || ' months')
+            WHERE id = ?
+            RETURNING user_id, end_date, subscription_type
+            """,
+            (months, subscription_id)
+        ) as cursor:
+            result = await cursor.fetchone()
+        if result:
+            await _record_by_plan(db, "extended", [result[2]])
+        await db.commit()
+    
+    if result:
+        user_id, end_date, _ = result
+        subscription_cache.invalidate(user_id)
+        notify(
+            "subscription_changed",
+            subscription_id, user_id, datetime.datetime.fromisoformat(end_date)
+        )
+    return True
+
+@timed(db_query_seconds)
+async def apply_payment(payment_id: str, user_id: int, months: int) -> bool:
+    """Продлевает активную подписку или создает новую по оплате
+
+    Подписка, статистика и отметка applied_at меняются одной транзакцией.
+    False, если платеж уже применен.
+    """
+    now = datetime.datetime.now()
+    day, plan = now.date().isoformat(), f"{months}_months"
+    async with _connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            async with db.execute(
+                "SELECT applied_at FROM payments WHERE payment_id = ?", (payment_id,)
+            ) as cursor:
+                payment = await cursor.fetchone()
+            if payment is not None and payment[0] is not None:
+                await db.rollback()
+                return False
+
+            # Конверсия проверяется до отметки: она ищет ранее примененные оплаты
+            await _record_conversion(db, day, plan, user_id)
+            async with db.execute(GET_ACTIVE_SUBSCRIPTION_SQL, (user_id,)) as cursor:
+                sub = await cursor.fetchone()
+            if sub:
+                subscription_id = sub[0]
+                async with db.execute(
+                    """
+                    UPDATE subscriptions
+                    SET end_date = datetime(end_date, '+' || ? || ' months')
+                    WHERE id = ?
+                    RETURNING end_date
+                    """,
+                    (months, subscription_id)
+                ) as cursor:
+                    end_date = datetime.datetime.fromisoformat((await cursor.fetchone())[0])
+                await _add_stats(db, day, plan, "renewals")
+            else:
+                end_date = now + datetime.timedelta(days=30 * months)
+                cursor = await db.execute(
+                    """
+                    INSERT INTO subscriptions
+                    (user_id, start_date, end_date, subscription_type, payment_id, is_trial)
+                    VALUES (?, ?, ?, ?, ?, FALSE)
+                    """,
+                    (user_id, now, end_date, plan, payment_id)
+                )
+                subscription_id = cursor.lastrowid
+                await _add_stats(db, day, plan, "started")
+            await db.execute(
+                "UPDATE payments SET applied_at = CURRENT_TIMESTAMP WHERE payment_id = ?",
+                (payment_id,)
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+    subscription_cache.invalidate(user_id)
+    notify("subscription_changed", subscription_id, user_id, end_date)
+    return True
+
+# Вызывается после каждой части массовой операции: (обработано, всего)
+BulkProgressCallback = Callable[[int, int], Awaitable[None]]
+
+def _bulk_filters(trial_only: bool, user_ids: Optional[List[int]]) -> List[Tuple[str, list]]:
+    """Условия отбора активных подписок; список пользователей делится на части"""
+    condition = "is_active = TRUE"
+    if trial_only:
+        condition += " AND is_trial = TRUE"
+    if user_ids is None:
+        return [(condition, [])]
+    return [
+        (
+            f"{condition} AND user_id IN ({', '.join('?' * len(chunk))})",
+            chunk
+        )
+        for chunk in (
+            user_ids[start:start + BATCH_CHUNK_SIZE]
+            for start in range(0, len(user_ids), BATCH_CHUNK_SIZE)
+        )
+    ]
+
+@timed(db_query_seconds)
+async def count_subscriptions_for_bulk(
+    trial_only: bool = False,
+    user_ids: Optional[List[int]] = None
+) -> int:
+    """Количество активных подписок, которые затронет массовая операция"""
+    total = 0
+    async with _connection() as db:
+        for condition, params in _bulk_filters(trial_only, user_ids):
+            async with db.execute(
+                f"SELECT COUNT(*) FROM subscriptions WHERE {condition}", params
+            ) as cursor:
+                total += (await cursor.fetchone())[0]
+    return total
+
+async def _bulk_update(
+    update_sql: str,
+    update_params: tuple,
+    trial_only: bool,
+    user_ids: Optional[List[int]],
+    on_progress: Optional[BulkProgressCallback],
+    stats_column: str,
+    deactivating: bool = False
+) -> Tuple[List[tuple], List[str]]:
+    """Применяет UPDATE ... RETURNING к отобранным подпискам частями по BULK_CHUNK_SIZE
+
+    Возвращает строки (id, user_id, end_date, subscription_type) и освобожденные адреса.
+    Измененные подписки учитываются в счетчике статистики stats_column той же транзакцией.
+
+    Каждая часть - отдельная короткая транзакция, чтобы не держать блокировку
+    на запись все время операции; части перебираются по возрастанию id.
+    """
+    total = await count_subscriptions_for_bulk(trial_only, user_ids)
+    updated = []
+    released = []
+    for condition, params in _bulk_filters(trial_only, user_ids):
+        last_id = 0
+        while True:
+            async with _connection() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                async with db.execute(
+                    f"""
+                    {update_sql}
+                    WHERE id IN (
+                        SELECT id FROM subscriptions
+                        WHERE {condition} AND id > ?
+                        ORDER BY id LIMIT ?
+                    )
+                    RETURNING id, user_id, end_date, subscription_type
+                    """,
+                    (*update_params, *params, last_id, BULK_CHUNK_SIZE)
+                ) as cursor:
+                    rows = [tuple(row) for row in await cursor.fetchall()]
+                if deactivating and rows:
+                    released.extend(
+                        await _release_user_addresses(db, list({row[1] for row in rows}))
+                    )
+                await _record_by_plan(db, stats_column, [row[3] for row in rows])
+                await db.commit()
+            if not rows:
+                break
+            updated.extend(rows)
+            last_id = max(row[0] for row in rows)
+            if on_progress:
+                await on_progress(len(updated), total)
+    return updated, released
+
+@timed(db_query_seconds)
+async def extend_subscriptions_bulk(
+    days: int,
+    trial_only: bool = False,
+    user_ids: Optional[List[int]] = None,
+    on_progress: Optional[BulkProgressCallback] = None
+) -> int:
+    """Продлевает активные подписки на days дней и возвращает их количество"""
+    updated, _ = await _bulk_update(
+        "UPDATE subscriptions SET end_date = datetime(end_date, '+' || ? || ' days')",
+        (days,),
+        trial_only, user_ids, on_progress,
+        stats_column="extended"
+    )
+    if updated:
+        # Один сброс кэша и одно уведомление на всю операцию
+        subscription_cache.clear()
+        notify(
+            "subscriptions_extended",
+            [
+                (subscription_id, user_id, datetime.datetime.fromisoformat(end_date))
+                for subscription_id, user_id, end_date, _ in updated
+            ]
+        )
+    return len(updated)
+
+@timed(db_query_seconds)
+async def deactivate_subscriptions_bulk(
+    trial_only: bool = False,
+    user_ids: Optional[List[int]] = None,
+    on_progress: Optional[BulkProgressCallback] = None
+) -> int:
+    """Отключает активные подписки и возвращает их количество"""
+    updated, released = await _bulk_update(
+        "UPDATE subscriptions SET is_active = FALSE",
+        (),
+        trial_only, user_ids, on_progress,
+        stats_column="churned",
+        deactivating=True
+    )
+    if updated:
+        subscription_cache.clear()
+        notify("subscriptions_deactivated", [(row[0], row[1]) for row in updated])
+    if released:
+        notify("addresses_released", released)
+    return len(updated)
+
+@timed(db_query_seconds)
+async def get_subscription_deadlines(until: datetime.datetime) -> List[Tuple[int, int, str]]:
+    """Возвращает (id, user_id, end_date) активных подписок, истекающих до until"""
+    async with _connection() as db:
+        async with db.execute(GET_SUBSCRIPTION_DEADLINES_SQL, (until,)) as cursor:
+            return [tuple(row) for row in await cursor.fetchall()] 
+
+@timed(db_query_seconds)
+async def get_active_subscriptions_page(
+    after: Optional[Tuple[str, int]] = None,
+    before: Optional[Tuple[str, int]] = None,
+    limit: int = 10
+) -> List[dict]:
+    """Возвращает страницу активных подписок по возрастанию (end_date, id)
+
+    after - ключ последней строки предыдущей страницы, before - ключ первой
+    строки следующей; без ключей возвращается первая страница.
+    """
+    if before is not None:
+        query, params = ACTIVE_SUBSCRIPTIONS_BEFORE_SQL, (*before, limit)
+    else:
+        query, params = ACTIVE_SUBSCRIPTIONS_AFTER_SQL, (*(after or ("", 0)), limit)
+    async with _connection() as db:
+        async with db.execute(query, params) as cursor:
+            rows = [
+                {
+                    "id": row[0],
+                    "user_id": row[1],
+                    "username": row[2],
+                    "subscription_type": row[3],
+                    "is_trial": row[4],
+                    "end_date": row[5]
+                }
+                for row in await cursor.fetchall()
+            ]
+    if before is not None:
+        rows.reverse()
+    return rows
+
+async def iter_active_subscriptions(batch_size: int = 1000) -> AsyncIterator[tuple]:
+    """Построчно выдает активные подписки для выгрузки, читая их пачками
+
+    Соединение пула занято, пока итерация не завершится.
+    """
+    async with _connection() as db:
+        async with db.execute(EXPORT_ACTIVE_SUBSCRIPTIONS_SQL) as cursor:
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield tuple(row)
+
+@timed(db_query_seconds)
+async def get_subscription_stats(since: str) -> List[dict]:
+    """Дневная статистика по тарифам начиная с дня since (YYYY-MM-DD)"""
+    async with _connection() as db:
+        async with db.execute(SUBSCRIPTION_STATS_SQL, (since,)) as cursor:
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in await cursor.fetchall()]
+
+@timed(db_query_seconds)
+async def rebuild_subscription_stats(batch_size: int = 1000) -> int:
+    """Пересчитывает дневную статистику за все время и возвращает число строк
+
+    Подписки читаются одним проходом курсора, оплаты агрегируются запросом.
+    Дата отключения подписки не хранится, поэтому отток относится ко дню ее
+    окончания; продления - это оплаты, не создавшие новую подписку. Продления
+    администратором нигде, кроме сводки, не записаны и переносятся из нее как есть.
+    """
+    stats: Dict[Tuple[str, str], Dict[str, int]] = {}
+
+    def add(day: str, plan: str, column: str, count: int = 1):
+        row = stats.setdefault((day, plan), dict.fromkeys(STATS_COLUMNS, 0))
+        row[column] += count
+
+    now = str(datetime.datetime.now())
+    async with _connection() as db:
+        # Изменения подписок ждут окончания пересчета, иначе их учет потеряется
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            async with db.execute(
+                "SELECT start_date, end_date, subscription_type, is_active FROM subscriptions"
+            ) as cursor:
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for start_date, end_date, plan, is_active in rows:
+                        add(str(start_date)[:10], plan, "started")
+                        if not is_active:
+                            add(min(str(end_date), now)[:10], plan, "churned")
+
+            async with db.execute(
+                """
+                SELECT date(applied_at, 'localtime'), months, COUNT(*) FROM payments
+                WHERE applied_at IS NOT NULL
+                GROUP BY 1, 2
+                """
+            ) as cursor:
+                for day, months, count in await cursor.fetchall():
+                    plan = f"{months}_months"
+                    started = stats.get((day, plan), {}).get("started", 0)
+                    if count > started:
+                        add(day, plan, "renewals", count - started)
+
+            # Первая оплата каждого пользователя с тестовым периодом
+            async with db.execute(
+                """
+                SELECT date(MIN(applied_at), 'localtime'), months FROM payments
+                WHERE applied_at IS NOT NULL AND user_id IN (
+                    SELECT user_id FROM subscriptions WHERE is_trial = TRUE
+                )
+                GROUP BY user_id
+                """
+            ) as cursor:
+                for day, months in await cursor.fetchall():
+                    add(day, f"{months}_months", "conversions")
+
+            async with db.execute(
+                "SELECT day, plan, extended FROM subscription_stats WHERE extended > 0"
+            ) as cursor:
+                for day, plan, count in await cursor.fetchall():
+                    add(day, plan, "extended", count)
+
+            await db.execute("DELETE FROM subscription_stats")
+            await db.executemany(
+                f"""
+                INSERT INTO subscription_stats (day, plan, {', '.join(STATS_COLUMNS)})
+                VALUES (?, ?, {', '.join('?' * len(STATS_COLUMNS))})
+                """,
+                [(day, plan, *row.values()) for (day, plan), row in stats.items()]
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    return len(stats)
+
+@timed(db_query_seconds)
+async def add_client_identities(
+    identities: List[Tuple[str, str, str]],
+    server_id: int,
+    claimed_by: Optional[int] = None
+) -> int:
+    """Добавляет в пул сервера готовые тройки (приватный ключ, публичный ключ, IP)"""
+    claimed_at = datetime.datetime.now() if claimed_by is not None else None
+    async with _connection() as db:
+        try:
+            await db.executemany(
+                """
+                INSERT INTO client_identities
+                (private_key, public_key, client_ip, server_id, claimed_by, claimed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                [identity + (server_id, claimed_by, claimed_at) for identity in identities]
+            )
+        except aiosqlite.IntegrityError as e:
+            raise StorageConflictError("Ключ или адрес уже есть в пуле клиентов") from e
+        await db.commit()
+        return len(identities)
+
+@timed(db_query_seconds)
+async def claim_client_identity(user_id: int, server_id: int) -> Optional[Tuple[str, str, str]]:
+    """Атомарно закрепляет за пользователем свободную запись из пула сервера"""
+    async with _connection() as db:
+        # Один UPDATE под блокировкой на запись: запись не может достаться
+        # двум пользователям, в том числе после перезапуска
+        async with db.execute(
+            """
+            UPDATE client_identities
+            SET claimed_by = ?, claimed_at = CURRENT_TIMESTAMP
+            WHERE claimed_by IS NULL AND id = (
+                SELECT id FROM client_identities
+                WHERE server_id = ? AND claimed_by IS NULL ORDER BY id LIMIT 1
+            )
+            RETURNING private_key, public_key, client_ip
+            """,
+            (user_id, server_id)
+        ) as cursor:
+            result = await cursor.fetchone()
+        await db.commit()
+        return tuple(result) if result else None
+
+@timed(db_query_seconds)
+async def count_active_subscriptions() -> int:
+    """Возвращает количество активных подписок"""
+    async with _connection() as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM subscriptions WHERE is_active = TRUE"
+        ) as cursor:
+            result = await cursor.fetchone()
+            return result[0]
+
+@timed(db_query_seconds)
+async def count_free_client_identities(server_id: Optional[int] = None) -> int:
+    """Возвращает количество свободных записей в пуле сервера или во всех пулах"""
+    async with _connection() as db:
+        if server_id is None:
+            query, params = "SELECT COUNT(*) FROM client_identities WHERE claimed_by IS NULL", ()
+        else:
+            query = "SELECT COUNT(*) FROM client_identities WHERE server_id = ? AND claimed_by IS NULL"
+            params = (server_id,)
+        async with db.execute(query, params) as cursor:
+            result = await cursor.fetchone()
+            return result[0]
+
+@timed(db_query_seconds)
+async def add_ip_lease(address: str) -> bool:
+    """Сохраняет аренду IP-адреса; False, если адрес уже занят"""
+    async with _connection() as db:
+        try:
+            await db.execute("INSERT INTO ip_leases (address) VALUES (?)", (address,))
+            await db.commit()
+            return True
+        except aiosqlite.IntegrityError:
+            await db.rollback()
+            return False
+
+@timed(db_query_seconds)
+async def get_ip_leases() -> List[str]:
+    """Возвращает все арендованные IP-адреса"""
+    async with _connection() as db:
+        async with db.execute("SELECT address FROM ip_leases") as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+@timed(db_query_seconds)
+async def release_ip_leases(addresses: List[str]) -> int:
+    """Удаляет аренду IP-адресов и возвращает их в пул"""
+    if not addresses:
+        return 0
+    async with _connection() as db:
+        await db.executemany(
+            "DELETE FROM ip_leases WHERE address = ?",
+            [(address,) for address in addresses]
+        )
+        await db.commit()
+    notify("addresses_released", addresses)
+    return len(addresses)
+
+@timed(db_query_seconds)
+async def get_wireguard_config(user_id: int) -> Optional[dict]:
+    """Возвращает действующую конфигурацию WireGuard пользователя"""
+    async with _connection() as db:
+        async with db.execute(
+            """
+            SELECT id, user_id, private_key, public_key, client_ip, server_id, created_at, config_text
+            FROM wireguard_configs
+            WHERE user_id = ? AND is_active = TRUE
+            ORDER BY id DESC LIMIT 1
             """,
             (user_id,)
         ) as cursor:
@@ -107,61 +1280,365 @@ async def get_active_subscription(user_id: int) -> Optional[dict]:
                 return {
                     "id": result[0],
                     "user_id": result[1],
-                    "start_date": result[2],
-                    "end_date": result[3],
-                    "subscription_type": result[4],
-                    "payment_id": result[5],
-                    "is_trial": result[6],
-                    "is_active": result[7]
+                    "private_key": result[2],
+                    "public_key": result[3],
+                    "client_ip": result[4],
+                    "server_id": result[5],
+                    "created_at": result[6],
+                    # Хранится только у старых конфигураций без адреса клиента
+                    "config_text": result[7]
                 }
             return None
 
-async def save_wireguard_config(
-    user_id: int,
-    private_key: str,
-    public_key: str,
-    config_text: str
-) -> bool:
-    async with aiosqlite.connect(DATABASE_NAME) as db:
+@timed(db_query_seconds)
+async def add_payment(payment_id: str, user_id: int, months: int, amount: str) -> bool:
+    """Сохраняет созданный платеж со статусом pending"""
+    async with _connection() as db:
         await db.execute(
             """
-            INSERT INTO wireguard_configs 
-            (user_id, private_key, public_key, config_text)
+            INSERT OR IGNORE INTO payments (payment_id, user_id, months, amount)
             VALUES (?, ?, ?, ?)
             """,
-            (user_id, private_key, public_key, config_text)
+            (payment_id, user_id, months, amount)
         )
         await db.commit()
         return True
 
-async def get_expired_subscriptions() -> List[Tuple[int, str]]:
-    async with aiosqlite.connect(DATABASE_NAME) as db:
+@timed(db_query_seconds)
+async def claim_payment(payment_id: str, user_id: int, months: int, amount: str) -> bool:
+    """Переводит платеж в обработку; False, если он уже обработан или обрабатывается"""
+    async with _connection() as db:
+        # Зависшая обработка (например, после падения процесса) может быть
+        # подхвачена повторным уведомлением через PAYMENT_CLAIM_TIMEOUT
         async with db.execute(
             """
-            SELECT user_id, subscription_type FROM subscriptions
-            WHERE is_active = TRUE AND end_date < datetime('now')
-            """
+            INSERT INTO payments (payment_id, user_id, months, amount, status)
+            VALUES (?, ?, ?, ?, 'processing')
+            ON CONFLICT (payment_id) DO UPDATE
+            SET status = 'processing', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'pending' OR (
+                status = 'processing'
+                AND updated_at < datetime('now', '-' || ? || ' seconds')
+            )
+            RETURNING payment_id
+            """,
+            (payment_id, user_id, months, amount, PAYMENT_CLAIM_TIMEOUT)
         ) as cursor:
-            return await cursor.fetchall()
+            result = await cursor.fetchone()
+        await db.commit()
+        return result is not None
 
-async def deactivate_subscription(subscription_id: int) -> bool:
-    async with aiosqlite.connect(DATABASE_NAME) as db:
+@timed(db_query_seconds)
+async def set_payment_status(payment_id: str, status: str) -> bool:
+    """Меняет статус платежа"""
+    async with _connection() as db:
         await db.execute(
-            "UPDATE subscriptions SET is_active = FALSE WHERE id = ?",
-            (subscription_id,)
+            """
+            UPDATE payments SET status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE payment_id = ?
+            """,
+            (status, payment_id)
         )
         await db.commit()
         return True
 
-async def extend_subscription(subscription_id: int, months: int) -> bool:
-    async with aiosqlite.connect(DATABASE_NAME) as db:
+@timed(db_query_seconds)
+async def get_telegram_file_id(config_id: int, kind: str, content_hash: str) -> Optional[str]:
+    """Возвращает file_id, если он загружен для этой версии конфигурации"""
+    async with _connection() as db:
+        async with db.execute(
+            """
+            SELECT file_id FROM telegram_files
+            WHERE config_id = ? AND kind = ? AND content_hash = ?
+            """,
+            (config_id, kind, content_hash)
+        ) as cursor:
+            result = await cursor.fetchone()
+            return result[0] if result else None
+
+@timed(db_query_seconds)
+async def save_telegram_file_id(config_id: int, kind: str, content_hash: str, file_id: str) -> bool:
+    """Сохраняет file_id, заменяя запись для прежней версии конфигурации"""
+    async with _connection() as db:
         await db.execute(
             """
-            UPDATE subscriptions 
-            SET end_date = datetime(end_date, '+' || ? || ' months')
-            WHERE id = ?
+            INSERT INTO telegram_files (config_id, kind, content_hash, file_id)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (config_id, kind) DO UPDATE
+            SET content_hash = excluded.content_hash,
+                file_id = excluded.file_id,
+                created_at = CURRENT_TIMESTAMP
             """,
-            (months, subscription_id)
+            (config_id, kind, content_hash, file_id)
         )
         await db.commit()
-        return True 
\ No newline at end of file
+        return True
+
+@timed(db_query_seconds)
+async def get_active_peers(server_id: int) -> List[Tuple[str, str]]:
+    """Возвращает (public_key, client_ip) конфигураций сервера с активной подпиской"""
+    async with _connection() as db:
+        async with db.execute(
+            """
+            SELECT public_key, client_ip FROM wireguard_configs AS wc
+            WHERE server_id = ? AND is_active = TRUE AND client_ip IS NOT NULL
+            AND EXISTS (
+                SELECT 1 FROM subscriptions
+                WHERE user_id = wc.user_id AND is_active = TRUE AND end_date > datetime('now')
+            )
+            """,
+            (server_id,)
+        ) as cursor:
+            return [tuple(row) for row in await cursor.fetchall()]
+
+@timed(db_query_seconds)
+async def get_public_key_owners() -> Dict[str, int]:
+    """Возвращает public_key -> user_id действующих конфигураций"""
+    async with _connection() as db:
+        async with db.execute(
+            "SELECT public_key, user_id FROM wireguard_configs WHERE is_active = TRUE"
+        ) as cursor:
+            return {public_key: user_id for public_key, user_id in await cursor.fetchall()}
+
+# Ключей в одном запросе IN: старые SQLite ограничивают число параметров 999
+PUBLIC_KEY_BATCH_SIZE = 500
+
+@timed(db_query_seconds)
+async def get_issued_public_keys(public_keys: List[str]) -> Set[str]:
+    """Ключи из списка, которые бот когда-либо выдавал клиентам"""
+    issued = set()
+    async with _connection() as db:
+        for start in range(0, len(public_keys), PUBLIC_KEY_BATCH_SIZE):
+            batch = public_keys[start:start + PUBLIC_KEY_BATCH_SIZE]
+            async with db.execute(
+                f"""
+                SELECT DISTINCT public_key FROM wireguard_configs
+                WHERE public_key IN ({', '.join('?' * len(batch))})
+                """,
+                batch
+            ) as cursor:
+                issued.update(public_key for public_key, in await cursor.fetchall())
+    return issued
+
+@timed(db_query_seconds)
+async def record_traffic(bucket: int, usage: Dict[int, Tuple[int, int]]) -> int:
+    """Добавляет трафик пользователей user_id -> (rx, tx) в интервал bucket"""
+    if not usage:
+        return 0
+    async with _connection() as db:
+        await db.executemany(
+            """
+            INSERT INTO traffic_usage (user_id, resolution, bucket, rx, tx)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, resolution, bucket)
+            DO UPDATE SET rx = rx + excluded.rx, tx = tx + excluded.tx
+            """,
+            [
+                (user_id, TRAFFIC_RAW, bucket - bucket % TRAFFIC_RAW, rx, tx)
+                for user_id, (rx, tx) in usage.items()
+            ]
+        )
+        await db.commit()
+    return len(usage)
+
+async def _get_rollup_watermarks(db: aiosqlite.Connection) -> Dict[int, int]:
+    async with db.execute("SELECT resolution, rolled_up_to FROM traffic_rollups") as cursor:
+        return {resolution: rolled_up_to for resolution, rolled_up_to in await cursor.fetchall()}
+
+@timed(db_query_seconds)
+async def rollup_traffic(now: int, retention: Dict[int, int]) -> Dict[int, int]:
+    """Сворачивает завершенные интервалы в более крупные и удаляет устаревшие
+
+    retention - сколько секунд хранить записи каждого разрешения.
+    Возвращает количество удаленных записей по разрешениям.
+    """
+    deleted = {}
+    async with _connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        watermarks = await _get_rollup_watermarks(db)
+        for source, target in ((TRAFFIC_RAW, TRAFFIC_HOURLY), (TRAFFIC_HOURLY, TRAFFIC_DAILY)):
+            # Сворачиваем только полностью завершенные интервалы target
+            start = watermarks.get(target, 0)
+            end = now - now % target
+            if end <= start:
+                continue
+            await db.execute(
+                """
+                INSERT INTO traffic_usage (user_id, resolution, bucket, rx, tx)
+                SELECT user_id, ?, bucket - bucket % ?, SUM(rx), SUM(tx)
+                FROM traffic_usage
+                WHERE resolution = ? AND bucket >= ? AND bucket < ?
+                GROUP BY user_id, bucket - bucket % ?
+                ON CONFLICT (user_id, resolution, bucket)
+                DO UPDATE SET rx = rx + excluded.rx, tx = tx + excluded.tx
+                """,
+                (target, target, source, start, end, target)
+            )
+            await db.execute(
+                "INSERT OR REPLACE INTO traffic_rollups (resolution, rolled_up_to) VALUES (?, ?)",
+                (target, end)
+            )
+        for resolution, keep in retention.items():
+            cursor = await db.execute(
+                "DELETE FROM traffic_usage WHERE resolution = ? AND bucket < ?",
+                (resolution, now - keep)
+            )
+            deleted[resolution] = cursor.rowcount
+        await db.commit()
+    return deleted
+
+@timed(db_query_seconds)
+async def get_traffic_usage(user_id: int, since: int) -> Tuple[int, int]:
+    """Возвращает (rx, tx) пользователя с момента since (unix time)
+
+    Каждый отрезок времени берется из одного разрешения: сутки - до границы
+    свертки в сутки, часы - до границы свертки в часы, дальше - сырые интервалы.
+    """
+    async with _connection() as db:
+        watermarks = await _get_rollup_watermarks(db)
+        hourly_end = watermarks.get(TRAFFIC_HOURLY, 0)
+        daily_end = watermarks.get(TRAFFIC_DAILY, 0)
+        async with db.execute(
+            """
+            SELECT COALESCE(SUM(rx), 0), COALESCE(SUM(tx), 0) FROM traffic_usage
+            WHERE user_id = ? AND (
+                (resolution = ? AND bucket + ? > ? AND bucket < ?)
+                OR (resolution = ? AND bucket + ? > ? AND bucket >= ? AND bucket < ?)
+                OR (resolution = ? AND bucket + ? > ? AND bucket >= ?)
+            )
+            """,
+            (
+                user_id,
+                TRAFFIC_DAILY, TRAFFIC_DAILY, since, daily_end,
+                TRAFFIC_HOURLY, TRAFFIC_HOURLY, since, daily_end, hourly_end,
+                TRAFFIC_RAW, TRAFFIC_RAW, since, hourly_end
+            )
+        ) as cursor:
+            rx, tx = await cursor.fetchone()
+            return rx, tx
+
+SERVER_COLUMNS = (
+    "id", "name", "endpoint", "public_key", "client_cidr", "server_ip",
+    "dns", "capacity", "wg_interface", "wg_command", "is_enabled"
+)
+
+@timed(db_query_seconds)
+async def get_servers() -> List[dict]:
+    """Возвращает все серверы WireGuard из реестра"""
+    async with _connection() as db:
+        async with db.execute(
+            f"SELECT {', '.join(SERVER_COLUMNS)} FROM servers ORDER BY id"
+        ) as cursor:
+            return [dict(zip(SERVER_COLUMNS, row)) for row in await cursor.fetchall()]
+
+@timed(db_query_seconds)
+async def upsert_server(server: dict) -> int:
+    """Добавляет сервер или обновляет его параметры по имени; признак is_enabled не меняется"""
+    columns = [column for column in SERVER_COLUMNS if column not in ("id", "is_enabled")]
+    async with _connection() as db:
+        try:
+            async with db.execute(
+                f"""
+                INSERT INTO servers ({', '.join(columns)})
+                VALUES ({', '.join('?' * len(columns))})
+                ON CONFLICT (name) DO UPDATE SET
+                {', '.join(f'{column} = excluded.{column}' for column in columns[1:])}
+                RETURNING id
+                """,
+                [server.get(column) for column in columns]
+            ) as cursor:
+                server_id = (await cursor.fetchone())[0]
+        except aiosqlite.IntegrityError as e:
+            raise StorageConflictError(f"Подсеть {server.get('client_cidr')} уже занята другим сервером") from e
+        await db.commit()
+        return server_id
+
+@timed(db_query_seconds)
+async def set_server_enabled(server_id: int, is_enabled: bool) -> bool:
+    """Включает или выводит сервер из размещения новых клиентов"""
+    async with _connection() as db:
+        cursor = await db.execute(
+            "UPDATE servers SET is_enabled = ? WHERE id = ?", (is_enabled, server_id)
+        )
+        await db.commit()
+        return cursor.rowcount > 0
+
+@timed(db_query_seconds)
+async def assign_unplaced_to_server(server_id: int) -> int:
+    """Привязывает конфигурации и записи пула, созданные до реестра серверов"""
+    async with _connection() as db:
+        configs = await db.execute(
+            "UPDATE wireguard_configs SET server_id = ? WHERE server_id IS NULL", (server_id,)
+        )
+        identities = await db.execute(
+            "UPDATE client_identities SET server_id = ? WHERE server_id IS NULL", (server_id,)
+        )
+        await db.commit()
+        return configs.rowcount + identities.rowcount
+
+@timed(db_query_seconds)
+async def count_configs_by_server() -> Dict[int, int]:
+    """Количество действующих конфигураций на каждом сервере"""
+    async with _connection() as db:
+        async with db.execute(
+            """
+            SELECT server_id, COUNT(*) FROM wireguard_configs
+            WHERE is_active = TRUE GROUP BY server_id
+            """
+        ) as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+@timed(db_query_seconds)
+async def get_user_server_id(user_id: int) -> Optional[int]:
+    """Сервер последней конфигурации пользователя"""
+    async with _connection() as db:
+        async with db.execute(
+            "SELECT server_id FROM wireguard_configs WHERE user_id = ? ORDER BY id DESC LIMIT 1",
+            (user_id,)
+        ) as cursor:
+            result = await cursor.fetchone()
+            return result[0] if result else None
+
+@timed(db_query_seconds)
+async def get_server_configs(server_id: int, after_id: int, limit: int) -> List[Tuple[int, int]]:
+    """Следующая пачка (config_id, user_id) действующих конфигураций сервера"""
+    async with _connection() as db:
+        async with db.execute(
+            """
+            SELECT id, user_id FROM wireguard_configs
+            WHERE server_id = ? AND is_active = TRUE AND id > ?
+            ORDER BY id LIMIT ?
+            """,
+            (server_id, after_id, limit)
+        ) as cursor:
+            return [tuple(row) for row in await cursor.fetchall()]
+
+@timed(db_query_seconds)
+async def deactivate_wireguard_configs(config_ids: List[int]) -> List[str]:
+    """Отключает перевыпущенные конфигурации и освобождает их адреса"""
+    addresses = []
+    async with _connection() as db:
+        for start in range(0, len(config_ids), BATCH_CHUNK_SIZE):
+            chunk = config_ids[start:start + BATCH_CHUNK_SIZE]
+            async with db.execute(
+                f"""
+                SELECT client_ip FROM wireguard_configs
+                WHERE id IN ({', '.join('?' * len(chunk))})
+                AND is_active = TRUE AND client_ip IS NOT NULL
+                """,
+                chunk
+            ) as cursor:
+                addresses.extend(row[0] for row in await cursor.fetchall())
+        await _release_addresses(db, addresses)
+        # Старые конфигурации без адреса отключаются по id
+        await db.executemany(
+            "UPDATE wireguard_configs SET is_active = FALSE WHERE id = ? AND is_active = TRUE",
+            [(config_id,) for config_id in config_ids]
+        )
+        await db.commit()
+
+    if addresses:
+        notify("addresses_released", addresses)
+    if config_ids:
+        notify("configs_deactivated", config_ids)
+    return addresses
\ No newline at end of file
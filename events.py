@@ -0,0 +1,14 @@
+from typing import Callable, Dict, List
+
+# Подписчики на события хранилища: событие -> список обработчиков.
+# Вызываются после фиксации изменений, например "addresses_released"
+_listeners: Dict[str, List[Callable]] = {}
+
+def add_listener(event: str, callback: Callable):
+    """Подписывает обработчик на событие хранилища"""
+    _listeners.setdefault(event, []).append(callback)
+
+def notify(event: str, *args):
+    """Вызывает обработчики события"""
+    for callback in _listeners.get(event, ()):
+        callback(*args)
@@ -0,0 +1,133 @@
+import os
+import asyncio
+import ipaddress
+from typing import Iterable, List, Optional
+
+from storage import storage
+
+# Подсеть, из которой выдаются адреса клиентов
+WG_CLIENT_CIDR = os.getenv("WG_CLIENT_CIDR", "10.0.0.0/16")
+# Адрес сервера внутри подсети; по умолчанию первый адрес хоста
+WG_SERVER_IP = os.getenv("WG_SERVER_IP")
+
+class AddressPool:
+    """Распределитель IP-адресов подсети с выдачей и возвратом за O(1)"""
+
+    def __init__(self, cidr: str = WG_CLIENT_CIDR, server_ip: Optional[str] = WG_SERVER_IP):
+        self.network = ipaddress.ip_network(cidr)
+        self.size = self.network.num_addresses
+        base = int(self.network.network_address)
+        server_offset = int(ipaddress.ip_address(server_ip)) - base if server_ip else 1
+        # Адрес сети, адрес сервера и широковещательный адрес не выдаются
+        self._reserved = {0, server_offset, self.size - 1}
+        # Бит на каждый адрес подсети: /16 занимает 8 КБ
+        self._bitmap = bytearray((self.size + 7) // 8)
+        # Смещения освобожденных адресов и указатель на еще не выданную часть
+        self._free: List[int] = []
+        self._next = 0
+        self._used = 0
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    def _is_used(self, offset: int) -> bool:
+        return bool(self._bitmap[offset >> 3] & (1 << (offset & 7)))
+
+    def _mark(self, offset: int, used: bool):
+        if used == self._is_used(offset):
+            return
+        if used:
+            self._bitmap[offset >> 3] |= 1 << (offset & 7)
+            self._used += 1
+        else:
+            self._bitmap[offset >> 3] &= ~(1 << (offset & 7))
+            self._used -= 1
+
+    def __contains__(self, address: str) -> bool:
+        return ipaddress.ip_address(address) in self.network
+
+    def _offset(self, address: str) -> int:
+        offset = int(ipaddress.ip_address(address)) - int(self.network.network_address)
+        if not 0 <= offset < self.size:
+            raise ValueError(f"Адрес {address} не принадлежит подсети {self.network}")
+        return offset
+
+    def _address(self, offset: int) -> str:
+        return str(self.network.network_address + offset)
+
+    def load_leases(self, addresses: Iterable[str]):
+        """Восстанавливает состояние по списку арендованных адресов; чужие подсети пропускаются"""
+        self._bitmap = bytearray(len(self._bitmap))
+        self._used = 0
+        for offset in self._reserved:
+            self._mark(offset, True)
+        highest = 0
+        for address in addresses:
+            if address not in self:
+                continue
+            offset = self._offset(address)
+            self._mark(offset, True)
+            highest = max(highest, offset)
+        # Дыры ниже последнего занятого адреса попадают в список свободных
+        self._free = [
+            offset for offset in range(highest, 0, -1)
+            if not self._is_used(offset)
+        ]
+        self._next = highest + 1
+        self._loaded = True
+
+    async def load(self):
+        """Загружает арендованные адреса из базы данных"""
+        async with self._load_lock:
+            if not self._loaded:
+                self.load_leases(await storage.get_ip_leases())
+
+    def _take(self) -> int:
+        """Выбирает свободное смещение без обращения к базе данных"""
+        if self._free:
+            offset = self._free.pop()
+        else:
+            while self._next < self.size and self._is_used(self._next):
+                self._next += 1
+            if self._next >= self.size:
+                raise RuntimeError(f"Свободные адреса в подсети {self.network} закончились")
+            offset = self._next
+            self._next += 1
+        self._mark(offset, True)
+        return offset
+
+    async def allocate(self) -> str:
+        """Выдает свободный IP-адрес и сохраняет его аренду"""
+        if not self._loaded:
+            await self.load()
+        while True:
+            # Выбор адреса синхронный, поэтому конкурентные активации
+            # в одном процессе не получат одинаковый адрес; первичный
+            # ключ ip_leases защищает от гонки между процессами
+            offset = self._take()
+            address = self._address(offset)
+            try:
+                leased = await storage.add_ip_lease(address)
+            except BaseException:
+                # Аренда не сохранена (ошибка базы или отмена): адрес снова свободен
+                self._mark(offset, False)
+                self._free.append(offset)
+                raise
+            if leased:
+                return address
+
+    def release(self, addresses: Iterable[str]):
+        """Возвращает адреса в пул после удаления аренды из базы данных"""
+        for address in addresses:
+            # Событие об освобождении получают пулы всех серверов
+            if address not in self:
+                continue
+            offset = self._offset(address)
+            if offset in self._reserved or not self._is_used(offset):
+                continue
+            self._mark(offset, False)
+            self._free.append(offset)
+
+    @property
+    def available(self) -> int:
+        """Количество адресов, которые еще можно выдать"""
+        return self.size - self._used
@@ -0,0 +1,197 @@
+import time
+import bisect
+import asyncio
+import logging
+import functools
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Границы корзин гистограмм задержек, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Все зарегистрированные метрики и асинхронные сборщики значений,
+# которые вызываются перед каждой выдачей /metrics
+_metrics: List["Metric"] = []
+_collectors: List[Callable[[], Awaitable[None]]] = []
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(ABC):
+    """Метрика в формате Prometheus с необязательными метками"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], "Metric"] = {}
+        self._function: Optional[Callable[[], float]] = None
+        _metrics.append(self)
+
+    def _new_child(self) -> "Metric":
+        child = object.__new__(type(self))
+        child.__dict__.update(self.__dict__)
+        child._children = {}
+        child._function = None
+        child._reset()
+        return child
+
+    def _reset(self):
+        pass
+
+    def labels(self, *values) -> "Metric":
+        """Возвращает метрику для конкретного набора значений меток"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+            child = self._children[key] = self._new_child()
+        return child
+
+    def set_function(self, function: Callable[[], float]):
+        """Берет значение из функции в момент выдачи метрик"""
+        self._function = function
+
+    @abstractmethod
+    def _samples(self, labels: Tuple[str, ...]) -> List[str]:
+        """Строки значений метрики с данным набором меток"""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        if self.labelnames:
+            for labels, child in list(self._children.items()):
+                lines.extend(child._samples(labels))
+        else:
+            lines.extend(self._samples(()))
+        return lines
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._reset()
+
+    def _reset(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _samples(self, labels: Tuple[str, ...]) -> List[str]:
+        value = self._function() if self._function else self.value
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"]
+
+class Gauge(Counter):
+    """Значение, которое может расти и уменьшаться"""
+
+    type = "gauge"
+
+    def set(self, value: float):
+        self.value = value
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+class Histogram(Metric):
+    """Распределение значений по корзинам"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+        self._reset()
+
+    def _reset(self):
+        # Последняя корзина соответствует +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "_Timer":
+        """Контекстный менеджер, измеряющий время выполнения блока"""
+        return _Timer(self)
+
+    def _samples(self, labels: Tuple[str, ...]) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = f'le="{_format_value(float(bound))}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+        label_text = _format_labels(self.labelnames, labels)
+        lines.append(f"{self.name}_sum{label_text} {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count{label_text} {self.count}")
+        return lines
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+def timed(histogram: Histogram):
+    """Декоратор: время выполнения корутины с меткой по имени функции"""
+    def decorator(func):
+        child = histogram.labels(func.__name__)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+# Глубина внутренних очередей: исходящие сообщения, входящие обновления
+queue_depth = Gauge("vpn_bot_queue_depth", "Элементы, ожидающие обработки в очереди", ["queue"])
+
+def add_collector(collector: Callable[[], Awaitable[None]]):
+    """Регистрирует корутину, обновляющую метрики перед выдачей"""
+    _collectors.append(collector)
+
+async def collect() -> str:
+    """Обновляет значения и возвращает все метрики в текстовом формате Prometheus"""
+    results = await asyncio.gather(*(collector() for collector in _collectors), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning("Не удалось собрать метрики: %s", result)
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,148 @@
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import CallbackQuery, TelegramObject
+
+from metrics import Counter, Histogram
+from notifier import TokenBucket
+
+# Ограничение частоты обновлений от одного пользователя: THROTTLE_RATE в секунду,
+# не больше THROTTLE_BURST подряд; 0 отключает ограничение
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "2"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "5"))
+# Полные корзины удаляются, когда их число дорастает до этого порога
+THROTTLE_CLEANUP_SIZE = 10000
+
+handler_seconds = Histogram(
+    "vpn_bot_handler_seconds", "Время выполнения обработчиков обновлений", ["handler"]
+)
+handler_errors = Counter(
+    "vpn_bot_handler_errors_total", "Исключения в обработчиках обновлений", ["handler"]
+)
+telegram_request_seconds = Histogram(
+    "vpn_bot_telegram_request_seconds", "Время запросов к Telegram Bot API", ["method"]
+)
+telegram_request_errors = Counter(
+    "vpn_bot_telegram_request_errors_total", "Неудачные запросы к Telegram Bot API", ["method"]
+)
+updates_throttled = Counter(
+    "vpn_bot_updates_throttled_total", "Обновления, отброшенные ограничением частоты", ["event"]
+)
+callbacks_coalesced = Counter(
+    "vpn_bot_callbacks_coalesced_total",
+    "Повторные нажатия, дождавшиеся результата уже выполняемого обработчика",
+    ["handler"]
+)
+
+def handler_name(data: Dict[str, Any]) -> str:
+    """Имя функции обработчика, выбранного для обновления"""
+    handler_object = data.get("handler")
+    return handler_object.callback.__name__ if handler_object else "unknown"
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Замеряет время каждого обработчика; метка - имя функции обработчика"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        name = handler_name(data)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.labels(name).inc()
+            raise
+        finally:
+            handler_seconds.labels(name).observe(time.perf_counter() - started)
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отбрасывает обновления пользователя сверх его токенов (token bucket на пользователя)"""
+
+    def __init__(self, rate: float = THROTTLE_RATE, burst: float = THROTTLE_BURST, exempt: Iterable[int] = ()):
+        self.rate = rate
+        self.burst = burst
+        self.exempt = set(exempt)
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._cleanup_at = THROTTLE_CLEANUP_SIZE
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self._cleanup_at:
+                for idle_user in [user for user, other in self._buckets.items() if other.idle]:
+                    del self._buckets[idle_user]
+                self._cleanup_at = max(THROTTLE_CLEANUP_SIZE, 2 * len(self._buckets))
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if self.rate <= 0 or user is None or user.id in self.exempt or self._bucket(user.id).try_acquire():
+            return await handler(event, data)
+
+        updates_throttled.labels(type(event).__name__).inc()
+        if isinstance(event, CallbackQuery):
+            # Без ответа у пользователя будет крутиться индикатор загрузки на кнопке
+            await event.answer("Слишком много запросов, подождите немного.")
+        return None
+
+class InFlightMiddleware(BaseMiddleware):
+    """Объединяет одновременные одинаковые нажатия кнопки одним пользователем
+
+    Пока обработчик нажатия выполняется, повторные нажатия той же кнопки не запускают
+    его снова, а дожидаются и возвращают его результат.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Tuple[int, str], asyncio.Future] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        key = (event.from_user.id, event.data)
+        running = self._in_flight.get(key)
+        if running is not None:
+            callbacks_coalesced.labels(handler_name(data)).inc()
+            result = await asyncio.shield(running)
+            await event.answer()
+            return result
+
+        future = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        result: Optional[Any] = None
+        try:
+            result = await handler(event, data)
+            return result
+        finally:
+            # Ожидающие получают None, если обработчик завершился исключением
+            future.set_result(result)
+            del self._in_flight[key]
+
+class TelegramRequestTimingMiddleware(BaseRequestMiddleware):
+    """Замеряет время исходящих запросов к Bot API по методам"""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            telegram_request_errors.labels(name).inc()
+            raise
+        finally:
+            telegram_request_seconds.labels(name).observe(time.perf_counter() - started)
@@ -0,0 +1,303 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError,
+    TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+
+from metrics import Counter
+
+# Ограничения Telegram: около 30 сообщений в секунду на бота
+# и около одного сообщения в секунду в один чат
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "8"))
+# Ограничение длины относится только к массовым сообщениям
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "10000"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))
+SEND_REPORT_INTERVAL = 60
+DEAD_LETTER_LIMIT = 1000
+
+# Ответы пользователю обгоняют массовые уведомления в общей очереди
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+outbox_messages = Counter(
+    "vpn_bot_outbox_messages_total", "Исходящие сообщения очереди по результату", ["result"]
+)
+
+class MessageQueueStoppedError(Exception):
+    """Очередь остановлена раньше, чем сообщение удалось отправить"""
+
+class TokenBucket:
+    """Ограничитель частоты по алгоритму token bucket"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Через сколько секунд появится свободный токен"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def try_acquire(self) -> bool:
+        """Забирает токен, если он есть, не дожидаясь"""
+        if self.delay() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    def pause(self, seconds: float):
+        """Запрещает выдачу токенов на заданное время"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        """Корзина полна, и ее можно удалить без потери состояния"""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and time.monotonic() >= self.paused_until
+
+    async def acquire(self):
+        """Ждет и забирает один токен"""
+        while True:
+            delay = self.delay()
+            if delay <= 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(delay)
+
+@dataclass
+class OutgoingMessage:
+    chat_id: int
+    text: str
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    attempts: int = 0
+    future: Optional[asyncio.Future] = None
+    bulk: bool = False
+    # Время цикла событий, раньше которого отложенное сообщение не отправляется
+    not_before: float = 0.0
+    # Номер постановки: отложенное сообщение сохраняет место среди сообщений своего приоритета
+    sequence: int = 0
+
+class MessageQueue:
+    """Очередь исходящих сообщений с ограничением частоты и повторами
+
+    Ответы пользователям и массовые уведомления идут через одну очередь
+    с приоритетом: ответ не ждет рассылки, стоящей перед ним. Сообщение в чат,
+    исчерпавший лимит или ожидающий повтора после ошибки, откладывается
+    и возвращается в очередь позже, не занимая обработчик.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        global_rate: float = SEND_GLOBAL_RATE,
+        chat_rate: float = SEND_CHAT_RATE,
+        chat_burst: float = SEND_CHAT_BURST,
+        concurrency: int = SEND_CONCURRENCY,
+        max_size: int = SEND_QUEUE_SIZE,
+        max_attempts: int = SEND_MAX_ATTEMPTS
+    ):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        # Свободные места для массовых сообщений в очереди
+        self._bulk_slots: Optional[asyncio.Semaphore] = None
+        # Порядок постановки внутри одного приоритета
+        self._sequence = itertools.count()
+        # Отложенные сообщения, которые вернутся в очередь по таймеру
+        self._deferred = 0
+        # Результаты, которых ждут отправители с wait=True
+        self._waiting: Set[asyncio.Future] = set()
+        self._workers: List[asyncio.Task] = []
+        self.dead_letters: Deque[OutgoingMessage] = deque(maxlen=DEAD_LETTER_LIMIT)
+        self.sent = 0
+        self.failed = 0
+
+    async def start(self):
+        """Запускает обработчики очереди"""
+        self._queue = asyncio.PriorityQueue()
+        self._bulk_slots = asyncio.Semaphore(self.max_size)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._workers.append(asyncio.create_task(self._report()))
+
+    async def stop(self, timeout: float = 10):
+        """Дожидается отправки очереди и останавливает обработчики"""
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("В очереди остались неотправленные сообщения: %s", self.depth)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # Таймеры отложенных сообщений сверяются с очередью и больше ничего не вернут
+        self._queue = None
+        self._deferred = 0
+        for future in list(self._waiting):
+            if not future.done():
+                future.set_exception(MessageQueueStoppedError("Очередь сообщений остановлена"))
+        self._waiting.clear()
+
+    async def send(
+        self, chat_id: int, text: str, wait: bool = True, bulk: bool = False, **kwargs
+    ) -> Optional[Any]:
+        """Ставит сообщение в очередь; при wait=True дожидается отправки
+
+        bulk=True - массовое уведомление: уступает ответам пользователям и ждет
+        места, если в очереди уже max_size массовых сообщений.
+        """
+        if self._queue is None:
+            # Очередь не запущена: отправляем напрямую
+            return await self.bot.send_message(chat_id, text, **kwargs)
+        message = OutgoingMessage(chat_id, text, kwargs, bulk=bulk, sequence=next(self._sequence))
+        if wait:
+            message.future = asyncio.get_running_loop().create_future()
+            self._waiting.add(message.future)
+            message.future.add_done_callback(self._waiting.discard)
+        if bulk:
+            await self._bulk_slots.acquire()
+        self._put(self._queue, message)
+        return await message.future if wait else None
+
+    async def broadcast(self, chat_ids: Iterable[int], text: str, **kwargs) -> int:
+        """Ставит в очередь рассылку без ожидания доставки"""
+        count = 0
+        for chat_id in chat_ids:
+            await self.send(chat_id, text, wait=False, bulk=True, **kwargs)
+            count += 1
+        return count
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _put(self, queue: asyncio.PriorityQueue, message: OutgoingMessage):
+        priority = PRIORITY_BULK if message.bulk else PRIORITY_INTERACTIVE
+        queue.put_nowait((priority, message.sequence, message))
+
+    def _defer(self, message: OutgoingMessage, delay: float):
+        """Возвращает сообщение в очередь через delay секунд"""
+        loop = asyncio.get_running_loop()
+        message.not_before = loop.time() + delay
+        self._deferred += 1
+        loop.call_at(message.not_before, self._requeue, self._queue, message)
+
+    def _requeue(self, queue: asyncio.PriorityQueue, message: OutgoingMessage):
+        if queue is not self._queue:
+            # Очередь остановлена, ожидающий результат уже получил ошибку
+            return
+        self._deferred -= 1
+        self._put(queue, message)
+        # Прошлое получение сообщения из очереди завершено: join учитывает новую постановку
+        queue.task_done()
+
+    async def _worker(self):
+        while True:
+            _, _, message = await self._queue.get()
+            try:
+                delay = await self._deliver(message)
+            except Exception as e:
+                self._dead_letter(message, e)
+                delay = None
+            if delay is not None:
+                self._defer(message, delay)
+                continue
+            if message.bulk:
+                self._bulk_slots.release()
+            self._queue.task_done()
+
+    async def _deliver(self, message: OutgoingMessage) -> Optional[float]:
+        """Одна попытка отправки; возвращает, через сколько секунд повторить, или None"""
+        chat_bucket = self._chat_bucket(message.chat_id)
+        if not chat_bucket.try_acquire():
+            return chat_bucket.delay()
+        # Общий лимит бота одинаков для всех чатов, его ожидание не задерживает другие чаты
+        await self._global_bucket.acquire()
+        message.attempts += 1
+        try:
+            result = await self.bot.send_message(message.chat_id, message.text, **message.kwargs)
+        except TelegramRetryAfter as e:
+            # Ограничение действует на весь бот, а не только на этот чат
+            self._global_bucket.pause(e.retry_after)
+            error = e
+        except (TelegramNetworkError, TelegramServerError) as e:
+            chat_bucket.pause(min(2 ** message.attempts, 60))
+            error = e
+        except (TelegramForbiddenError, TelegramBadRequest, TelegramAPIError) as e:
+            # Бот заблокирован или запрос некорректен: повтор не поможет
+            self._dead_letter(message, e)
+            return None
+        else:
+            self.sent += 1
+            outbox_messages.labels("sent").inc()
+            if message.future and not message.future.done():
+                message.future.set_result(result)
+            return None
+
+        if message.attempts >= self.max_attempts:
+            self._dead_letter(message, error)
+            return None
+        outbox_messages.labels("retried").inc()
+        return max(chat_bucket.delay(), self._global_bucket.delay())
+
+    def _dead_letter(self, message: OutgoingMessage, error: Exception):
+        self.failed += 1
+        outbox_messages.labels("failed").inc()
+        self.dead_letters.append(message)
+        logging.warning(
+            "Сообщение для чата %s не доставлено после %s попыток: %s",
+            message.chat_id, message.attempts, error
+        )
+        if message.future and not message.future.done():
+            message.future.set_exception(error)
+
+    @property
+    def depth(self) -> int:
+        """Количество сообщений, ожидающих отправки, включая отложенные"""
+        return self._queue.qsize() + self._deferred if self._queue is not None else 0
+
+    async def _report(self):
+        """Периодически пишет в лог скорость отправки и чистит пустые корзины"""
+        last_sent = self.sent
+        while True:
+            await asyncio.sleep(SEND_REPORT_INTERVAL)
+            for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.idle]:
+                del self._chat_buckets[chat_id]
+            if self.sent != last_sent or self.depth:
+                logging.info(
+                    "Исходящие сообщения: %.1f/с, в очереди %s, не доставлено %s",
+                    (self.sent - last_sent) / SEND_REPORT_INTERVAL, self.depth, self.failed
+                )
+            last_sent = self.sent
@@ -0,0 +1,195 @@
+import os
+import time
+import uuid
+import logging
+from decimal import Decimal
+from typing import Awaitable, Callable, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from metrics import Counter, Histogram
+from storage import storage
+from wireguard import create_client_config
+
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "15"))
+YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+
+yookassa_request_seconds = Histogram(
+    "vpn_bot_yookassa_request_seconds", "Время запросов к API ЮKassa", ["method"]
+)
+yookassa_request_errors = Counter(
+    "vpn_bot_yookassa_request_errors_total", "Неудачные запросы к API ЮKassa", ["method"]
+)
+payments_activated = Counter("vpn_bot_payments_activated_total", "Активированные оплаты")
+
+PaymentCallback = Callable[[int, int], Awaitable[None]]
+
+# Вызывается после активации подписки по оплате: (user_id, months)
+payment_activated_key = web.AppKey("payment_activated", Optional[PaymentCallback])
+
+class YooKassaError(Exception):
+    """Ошибка API ЮKassa"""
+
+class YooKassaClient:
+    """Асинхронный клиент API ЮKassa с общим пулом HTTP-соединений"""
+
+    def __init__(
+        self,
+        shop_id: Optional[str],
+        secret_key: Optional[str],
+        api_url: str = YOOKASSA_API_URL,
+        timeout: float = YOOKASSA_TIMEOUT
+    ):
+        self.shop_id = shop_id
+        self.secret_key = secret_key
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.shop_id or "", self.secret_key or ""),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        started = time.perf_counter()
+        try:
+            async with self._get_session().request(method, f"{self.api_url}{path}", **kwargs) as response:
+                data = await response.json(content_type=None)
+                if response.status >= 400:
+                    raise YooKassaError(f"{response.status}: {data.get('description', data)}")
+                return data
+        except Exception:
+            yookassa_request_errors.labels(method).inc()
+            raise
+        finally:
+            yookassa_request_seconds.labels(method).observe(time.perf_counter() - started)
+
+    async def create_payment(
+        self,
+        amount: Decimal,
+        description: str,
+        return_url: str,
+        metadata: dict,
+        idempotence_key: Optional[str] = None
+    ) -> dict:
+        """Создает платеж с подтверждением через redirect"""
+        return await self._request(
+            "POST",
+            "/payments",
+            json={
+                "amount": {
+                    "value": str(amount),
+                    "currency": "RUB"
+                },
+                "confirmation": {
+                    "type": "redirect",
+                    "return_url": return_url
+                },
+                "capture": True,
+                "description": description,
+                "metadata": metadata
+            },
+            headers={"Idempotence-Key": idempotence_key or str(uuid.uuid4())}
+        )
+
+    async def get_payment(self, payment_id: str) -> dict:
+        """Получает актуальное состояние платежа"""
+        return await self._request("GET", f"/payments/{payment_id}")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+yookassa = YooKassaClient(os.getenv("YOOKASSA_SHOP_ID"), os.getenv("YOOKASSA_SECRET_KEY"))
+
+async def create_subscription_payment(
+    user_id: int,
+    months: int,
+    price: Decimal,
+    return_url: str
+) -> str:
+    """Создает платеж за подписку и возвращает ссылку на оплату"""
+    payment = await yookassa.create_payment(
+        amount=price,
+        description=f"VPN подписка на {months} мес.",
+        return_url=return_url,
+        metadata={
+            "user_id": user_id,
+            "months": months
+        }
+    )
+    await storage.add_payment(payment["id"], user_id, months, str(price))
+    return payment["confirmation"]["confirmation_url"]
+
+async def activate_payment(payment_id: str) -> Optional[Tuple[int, int]]:
+    """Активирует подписку по оплаченному платежу; возвращает (user_id, months)"""
+    # Тело уведомления не подписано, поэтому состояние платежа берем из API
+    payment = await yookassa.get_payment(payment_id)
+    if payment.get("status") != "succeeded":
+        return None
+
+    metadata = payment.get("metadata") or {}
+    user_id = int(metadata["user_id"])
+    months = int(metadata["months"])
+    amount = payment["amount"]["value"]
+
+    # Повторные уведомления по тому же payment_id ничего не меняют
+    if not await storage.claim_payment(payment_id, user_id, months, amount):
+        return None
+
+    try:
+        # Конфигурация выдается до подписки: если все серверы заполнены, платеж
+        # остается в pending и ЮKassa повторит уведомление, а срок оплаченной
+        # подписки не начнет идти без доступа к VPN. До применения платежа
+        # конфигурация не попадает на сервер: пиры берутся только по активным подпискам
+        if not await storage.get_wireguard_config(user_id):
+            private_key, public_key, client_ip = await create_client_config(user_id)
+            await storage.save_wireguard_config(user_id, private_key, public_key, client_ip)
+
+        # Уже примененный платеж (повтор после сбоя) не продлевает подписку второй раз
+        await storage.apply_payment(payment_id, user_id, months)
+    except Exception:
+        await storage.set_payment_status(payment_id, "pending")
+        raise
+
+    await storage.set_payment_status(payment_id, "succeeded")
+    payments_activated.inc()
+    return user_id, months
+
+async def handle_yookassa_webhook(request: web.Request) -> web.Response:
+    """Принимает HTTP-уведомления ЮKassa о платежах"""
+    try:
+        payload = await request.json()
+    except ValueError:
+        return web.Response(status=400, text="invalid json")
+
+    if payload.get("event") != "payment.succeeded":
+        return web.Response(text="ignored")
+
+    payment_id = (payload.get("object") or {}).get("id")
+    if not payment_id:
+        return web.Response(status=400, text="missing payment id")
+
+    # Исключение вернет 500, и ЮKassa повторит уведомление позже
+    activated = await activate_payment(payment_id)
+
+    on_activated = request.app.get(payment_activated_key)
+    if activated and on_activated:
+        try:
+            await on_activated(*activated)
+        except Exception:
+            logging.exception("Не удалось уведомить пользователя об оплате %s", payment_id)
+
+    return web.Response(text="ok")
+
+def setup_payment_routes(app: web.Application, on_activated: Optional[PaymentCallback] = None):
+    """Регистрирует обработчик уведомлений ЮKassa в приложении aiohttp"""
+    app.router.add_post(YOOKASSA_WEBHOOK_PATH, handle_yookassa_webhook)
+    app[payment_activated_key] = on_activated
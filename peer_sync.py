@@ -0,0 +1,190 @@
+import os
+import time
+import shlex
+import asyncio
+import logging
+from typing import Collection, Dict, List, Optional, Sequence, Tuple
+
+from metrics import Counter, Histogram
+from storage import storage
+
+WG_INTERFACE = os.getenv("WG_INTERFACE", "wg0")
+# Команда wg; можно подменить, например, на "sudo wg" или тестовый скрипт
+WG_COMMAND = shlex.split(os.getenv("WG_COMMAND", "wg"))
+WG_PEER_SYNC = os.getenv("WG_PEER_SYNC", "").lower() in ("1", "true", "yes")
+# Сколько ждать после изменения, чтобы собрать всплеск активаций в одно применение
+PEER_SYNC_DEBOUNCE = float(os.getenv("PEER_SYNC_DEBOUNCE", "2"))
+# Полная сверка на случай ручных изменений на сервере
+PEER_SYNC_INTERVAL = float(os.getenv("PEER_SYNC_INTERVAL", "600"))
+# Пиров в одном вызове wg set, чтобы не упереться в длину командной строки
+PEER_SYNC_CHUNK_SIZE = 1000
+
+peer_sync_seconds = Histogram(
+    "vpn_bot_peer_sync_seconds", "Время синхронизации пиров WireGuard", ["server"]
+)
+peers_added = Counter(
+    "vpn_bot_peer_sync_added_total", "Пиры, добавленные или обновленные синхронизацией", ["server"]
+)
+peers_removed = Counter("vpn_bot_peer_sync_removed_total", "Пиры, удаленные синхронизацией", ["server"])
+
+class WireGuardCommandError(Exception):
+    """Команда wg завершилась с ошибкой"""
+
+def parse_dump(dump: str) -> Dict[str, str]:
+    """Разбирает вывод wg show <iface> dump в словарь public_key -> allowed_ips"""
+    peers = {}
+    # Первая строка описывает сам интерфейс
+    for line in dump.splitlines()[1:]:
+        fields = line.split("\t")
+        if len(fields) >= 4:
+            peers[fields[0]] = fields[3]
+    return peers
+
+def parse_transfer(dump: str) -> Dict[str, Tuple[int, int]]:
+    """Разбирает вывод wg show <iface> dump в словарь public_key -> (rx, tx) в байтах"""
+    transfer = {}
+    for line in dump.splitlines()[1:]:
+        fields = line.split("\t")
+        if len(fields) >= 7:
+            transfer[fields[0]] = (int(fields[5]), int(fields[6]))
+    return transfer
+
+def diff_peers(
+    desired: Dict[str, str], current: Dict[str, str], managed: Optional[Collection[str]] = None
+) -> Tuple[Dict[str, str], List[str]]:
+    """Пиры для добавления или обновления и ключи для удаления (только из managed, если он задан)"""
+    upsert = {
+        public_key: allowed_ips
+        for public_key, allowed_ips in desired.items()
+        if current.get(public_key) != allowed_ips
+    }
+    remove = [
+        public_key for public_key in current
+        if public_key not in desired and (managed is None or public_key in managed)
+    ]
+    return upsert, remove
+
+class PeerSync:
+    """Приводит пиров интерфейса WireGuard к набору активных подписок"""
+
+    def __init__(
+        self,
+        server_id: int,
+        name: Optional[str] = None,
+        interface: str = WG_INTERFACE,
+        wg_command: Sequence[str] = WG_COMMAND,
+        debounce: float = PEER_SYNC_DEBOUNCE,
+        interval: float = PEER_SYNC_INTERVAL
+    ):
+        self.server_id = server_id
+        # Имя сервера в метках метрик
+        self.name = name or str(server_id)
+        self.interface = interface
+        self.wg_command = list(wg_command)
+        self.debounce = debounce
+        self.interval = interval
+        self._requested = asyncio.Event()
+        self._lock = asyncio.Lock()
+        # Неудачные обращения к wg подряд: по ним реестр судит о доступности сервера
+        self.failures = 0
+
+    async def _wg(self, *args: str) -> str:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self.wg_command, *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            self.failures += 1
+            raise WireGuardCommandError(f"{' '.join(args)}: {e}") from e
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            self.failures += 1
+            raise WireGuardCommandError(
+                f"{' '.join(args)}: {stderr.decode('utf-8', 'replace').strip()}"
+            )
+        self.failures = 0
+        return stdout.decode("utf-8")
+
+    async def dump(self) -> str:
+        """Вывод wg show <iface> dump: пиры, их адреса и счетчики трафика"""
+        return await self._wg("show", self.interface, "dump")
+
+    async def current_peers(self) -> Dict[str, str]:
+        """Пиры, настроенные на интерфейсе сейчас"""
+        return parse_dump(await self.dump())
+
+    async def desired_peers(self) -> Dict[str, str]:
+        """Пиры, которые должны быть на интерфейсе по данным базы"""
+        return {
+            public_key: f"{client_ip}/32"
+            for public_key, client_ip in await storage.get_active_peers(self.server_id)
+        }
+
+    async def apply(self, upsert: Dict[str, str], remove: List[str]):
+        """Применяет изменения пачками команд wg set"""
+        args = [
+            arg
+            for public_key, allowed_ips in upsert.items()
+            for arg in ("peer", public_key, "allowed-ips", allowed_ips)
+        ] + [
+            arg
+            for public_key in remove
+            for arg in ("peer", public_key, "remove")
+        ]
+        # На каждого пира приходится 3-4 аргумента, начинающихся с "peer"
+        chunk = []
+        peers_in_chunk = 0
+        for arg in args:
+            if arg == "peer":
+                if peers_in_chunk == PEER_SYNC_CHUNK_SIZE:
+                    await self._wg("set", self.interface, *chunk)
+                    chunk, peers_in_chunk = [], 0
+                peers_in_chunk += 1
+            chunk.append(arg)
+        if chunk:
+            await self._wg("set", self.interface, *chunk)
+
+    async def sync(self) -> Tuple[int, int]:
+        """Сверяет интерфейс с базой и применяет только разницу"""
+        async with self._lock:
+            started = time.perf_counter()
+            desired, current = await asyncio.gather(self.desired_peers(), self.current_peers())
+            # Пиров, добавленных вручную (межсерверные каналы, устройства
+            # администратора), бот не выдавал и не трогает
+            stale = [public_key for public_key in current if public_key not in desired]
+            managed = await storage.get_issued_public_keys(stale) if stale else set()
+            upsert, remove = diff_peers(desired, current, managed)
+            if upsert or remove:
+                await self.apply(upsert, remove)
+
+            duration = time.perf_counter() - started
+            peer_sync_seconds.labels(self.name).observe(duration)
+            peers_added.labels(self.name).inc(len(upsert))
+            peers_removed.labels(self.name).inc(len(remove))
+            if upsert or remove:
+                logging.info(
+                    "Синхронизация пиров %s: добавлено %s, удалено %s за %.3f с",
+                    self.interface, len(upsert), len(remove), duration
+                )
+            return len(upsert), len(remove)
+
+    def request_sync(self, *args):
+        """Запрашивает синхронизацию; частые запросы объединяются"""
+        self._requested.set()
+
+    async def run(self):
+        """Фоновая задача синхронизации"""
+        while True:
+            try:
+                await asyncio.wait_for(self._requested.wait(), self.interval)
+                # Ждем, пока утихнет всплеск изменений
+                await asyncio.sleep(self.debounce)
+            except asyncio.TimeoutError:
+                pass
+            self._requested.clear()
+            try:
+                await self.sync()
+            except Exception:
+                logging.exception("Не удалось синхронизировать пиров WireGuard")
@@ -0,0 +1,22 @@
+import os
+from decimal import Decimal
+
+# Константы для цен и скидок
+PRICE_MONTH = Decimal(os.getenv("PRICE_MONTH", "399"))
+DISCOUNT_3_MONTHS = Decimal(os.getenv("DISCOUNT_3_MONTHS", "5"))
+DISCOUNT_6_MONTHS = Decimal(os.getenv("DISCOUNT_6_MONTHS", "10"))
+DISCOUNT_12_MONTHS = Decimal(os.getenv("DISCOUNT_12_MONTHS", "20"))
+
+def calculate_price(months: int) -> Decimal:
+    """Рассчитывает цену с учетом скидки"""
+    base_price = PRICE_MONTH * months
+    if months >= 12:
+        discount = DISCOUNT_12_MONTHS
+    elif months >= 6:
+        discount = DISCOUNT_6_MONTHS
+    elif months >= 3:
+        discount = DISCOUNT_3_MONTHS
+    else:
+        discount = Decimal(0)
+    
+    return base_price * (1 - discount / 100)
@@ -0,0 +1,126 @@
+import os
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from events import add_listener
+from metrics import Gauge, Histogram
+from storage import storage
+
+# Какой период вперед держать в памяти; дальние сроки подгружаются позже
+EXPIRY_HORIZON = timedelta(hours=int(os.getenv("EXPIRY_HORIZON_HOURS", "24")))
+EXPIRY_RETRY_DELAY = 60
+
+expiry_lag_seconds = Histogram(
+    "vpn_bot_expiry_lag_seconds", "Задержка отключения подписки после end_date",
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600)
+)
+expiry_queue_depth = Gauge("vpn_bot_expiry_scheduled", "Подписки в расписании отключения")
+
+ExpiredCallback = Callable[[List[Tuple[int, int]]], Awaitable[None]]
+
+class ExpiryScheduler:
+    """Отключает подписки в момент истечения по куче ближайших сроков"""
+
+    def __init__(self, on_expired: Optional[ExpiredCallback] = None, horizon: timedelta = EXPIRY_HORIZON):
+        self.on_expired = on_expired
+        self.horizon = horizon
+        # (end_date, subscription_id, user_id); устаревшие записи не удаляются
+        # из кучи, а пропускаются при извлечении по словарю _deadlines
+        self._heap: List[Tuple[datetime, int, int]] = []
+        self._deadlines: Dict[int, datetime] = {}
+        self._horizon_end = datetime.min
+        self._wakeup = asyncio.Event()
+
+    async def load(self):
+        """Загружает из базы сроки подписок, истекающих в пределах горизонта"""
+        self._horizon_end = datetime.now() + self.horizon
+        self._heap.clear()
+        self._deadlines.clear()
+        for subscription_id, user_id, end_date in await storage.get_subscription_deadlines(self._horizon_end):
+            self._push(subscription_id, user_id, datetime.fromisoformat(end_date))
+
+    def _push(self, subscription_id: int, user_id: int, end_date: datetime):
+        self._deadlines[subscription_id] = end_date
+        heapq.heappush(self._heap, (end_date, subscription_id, user_id))
+
+    def schedule(self, subscription_id: int, user_id: int, end_date: datetime):
+        """Добавляет или переносит срок подписки"""
+        if end_date > self._horizon_end:
+            # Срок за горизонтом: подгрузится при следующей загрузке
+            self._deadlines.pop(subscription_id, None)
+            return
+        head = self._heap[0][0] if self._heap else None
+        self._push(subscription_id, user_id, end_date)
+        if head is None or end_date < head:
+            self._wakeup.set()
+
+    def schedule_many(self, subscriptions: List[Tuple[int, int, datetime]]):
+        """Переносит сроки пачки подписок после массового продления"""
+        for subscription_id, user_id, end_date in subscriptions:
+            self.schedule(subscription_id, user_id, end_date)
+
+    def cancel(self, subscriptions: List[Tuple[int, int]]):
+        """Убирает отключенные подписки из расписания"""
+        for subscription_id, _ in subscriptions:
+            self._deadlines.pop(subscription_id, None)
+
+    @property
+    def scheduled(self) -> int:
+        """Количество подписок в расписании"""
+        return len(self._deadlines)
+
+    def _pop_due(self, now: datetime) -> List[int]:
+        """Извлекает из кучи подписки, срок которых наступил"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            end_date, subscription_id, _ = heapq.heappop(self._heap)
+            if self._deadlines.get(subscription_id) == end_date:
+                del self._deadlines[subscription_id]
+                due.append(subscription_id)
+                expiry_lag_seconds.observe((now - end_date).total_seconds())
+        return due
+
+    async def _sleep_until(self, deadline: datetime):
+        self._wakeup.clear()
+        delay = (deadline - datetime.now()).total_seconds()
+        if delay <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        """Фоновая задача: спит до ближайшего срока и отключает подписки пачкой"""
+        await self.load()
+        while True:
+            now = datetime.now()
+            if now >= self._horizon_end:
+                await self.load()
+
+            due = self._pop_due(now)
+            if due:
+                try:
+                    expired = await storage.deactivate_subscriptions(due)
+                    if expired and self.on_expired:
+                        await self.on_expired(expired)
+                except Exception:
+                    logging.exception("Не удалось отключить истекшие подписки")
+                    # Перечитываем сроки из базы: неотключенные подписки вернутся в кучу
+                    await asyncio.sleep(EXPIRY_RETRY_DELAY)
+                    await self.load()
+                    continue
+
+            next_deadline = self._heap[0][0] if self._heap else self._horizon_end
+            await self._sleep_until(min(next_deadline, self._horizon_end))
+
+expiry_scheduler = ExpiryScheduler()
+expiry_queue_depth.set_function(lambda: expiry_scheduler.scheduled)
+
+# Сроки обновляются при создании, продлении и отключении подписок
+add_listener("subscription_changed", expiry_scheduler.schedule)
+add_listener("subscriptions_extended", expiry_scheduler.schedule_many)
+add_listener("subscriptions_deactivated", expiry_scheduler.cancel)
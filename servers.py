@@ -0,0 +1,281 @@
+import os
+import json
+import shlex
+import asyncio
+import hashlib
+import logging
+import ipaddress
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from events import add_listener
+from ip_pool import WG_CLIENT_CIDR, WG_SERVER_IP, AddressPool
+from metrics import Gauge, add_collector
+from peer_sync import WG_COMMAND, WG_INTERFACE, PeerSync
+from storage import storage
+
+# JSON-файл со списком серверов; без него используется один сервер из переменных WG_*
+WG_SERVERS_FILE = os.getenv("WG_SERVERS_FILE", "")
+# Емкость сервера по умолчанию; 0 - все адреса подсети
+WG_SERVER_CAPACITY = int(os.getenv("WG_SERVER_CAPACITY", "0"))
+# Серверы, загрузка которых отличается от минимальной не больше чем на эту долю,
+# считаются равноценными, и среди них клиент размещается по хэшу
+SERVER_LOAD_TOLERANCE = float(os.getenv("SERVER_LOAD_TOLERANCE", "0.05"))
+# После стольких неудачных вызовов wg подряд сервер не получает новых клиентов
+SERVER_UNHEALTHY_AFTER = int(os.getenv("SERVER_UNHEALTHY_AFTER", "3"))
+# Как часто перечитывать реестр и пересчитывать загрузку серверов
+SERVER_REFRESH_INTERVAL = float(os.getenv("SERVER_REFRESH_INTERVAL", "60"))
+
+server_peers = Gauge("vpn_bot_server_peers", "Действующие конфигурации на сервере", ["server"])
+server_capacity = Gauge("vpn_bot_server_capacity", "Емкость сервера", ["server"])
+server_healthy = Gauge("vpn_bot_server_healthy", "Сервер доступен и принимает клиентов", ["server"])
+addresses_available = Gauge(
+    "vpn_bot_addresses_available", "Свободные IP-адреса клиентов", ["server"]
+)
+
+class NoServerAvailableError(Exception):
+    """Нет включенного доступного сервера со свободными местами"""
+
+@dataclass
+class Server:
+    id: int
+    name: str
+    endpoint: Optional[str]
+    public_key: Optional[str]
+    client_cidr: str
+    server_ip: Optional[str]
+    dns: Optional[str]
+    capacity: int
+    is_enabled: bool
+    pool: AddressPool = field(repr=False)
+    sync: PeerSync = field(repr=False)
+    # Действующие конфигурации; между пересчетами увеличивается при размещении
+    load: int = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.sync.failures < SERVER_UNHEALTHY_AFTER
+
+    @property
+    def load_ratio(self) -> float:
+        return self.load / self.capacity if self.capacity > 0 else 1.0
+
+    @property
+    def accepts_clients(self) -> bool:
+        """Сервер можно выбрать для нового клиента"""
+        return self.is_enabled and self.healthy and self.load < self.capacity
+
+def _default_capacity(cidr: str) -> int:
+    # Адрес сети, адрес сервера и широковещательный адрес не выдаются
+    return WG_SERVER_CAPACITY or ipaddress.ip_network(cidr).num_addresses - 3
+
+def load_server_settings(path: str = WG_SERVERS_FILE) -> List[dict]:
+    """Читает список серверов из файла или собирает сервер по умолчанию из переменных окружения"""
+    if not path:
+        return [{
+            "name": "default",
+            "endpoint": os.getenv("WG_SERVER_ENDPOINT"),
+            "public_key": os.getenv("WG_SERVER_PUBLIC_KEY"),
+            "client_cidr": WG_CLIENT_CIDR,
+            "server_ip": WG_SERVER_IP,
+            "dns": os.getenv("WG_DNS"),
+            "capacity": _default_capacity(WG_CLIENT_CIDR),
+            "wg_interface": WG_INTERFACE,
+            "wg_command": os.getenv("WG_COMMAND"),
+        }]
+
+    with open(path, encoding="utf-8") as f:
+        servers = json.load(f)
+    settings = []
+    for server in servers:
+        if not server.get("name") or not server.get("client_cidr"):
+            raise ValueError(f"{path}: у сервера должны быть name и client_cidr")
+        settings.append({
+            "dns": os.getenv("WG_DNS"),
+            "wg_interface": WG_INTERFACE,
+            **server,
+            "capacity": int(server.get("capacity") or _default_capacity(server["client_cidr"])),
+        })
+    return settings
+
+def placement_score(user_id: int, server_name: str) -> int:
+    """Вес пары пользователь-сервер для выбора по наибольшему хэшу (rendezvous hashing)"""
+    digest = hashlib.blake2b(f"{server_name}:{user_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+def check_overlaps(rows: List[dict]):
+    """Подсети серверов не должны пересекаться: адрес однозначно указывает на сервер"""
+    networks = [(row["name"], ipaddress.ip_network(row["client_cidr"])) for row in rows]
+    for index, (name, network) in enumerate(networks):
+        for other_name, other in networks[index + 1:]:
+            if network.overlaps(other):
+                raise ValueError(f"Подсети серверов {name} и {other_name} пересекаются")
+
+class ServerRegistry:
+    """Серверы WireGuard, их пулы адресов, синхронизация пиров и размещение клиентов"""
+
+    def __init__(self, settings_path: str = WG_SERVERS_FILE):
+        self.settings_path = settings_path
+        self.servers: Dict[int, Server] = {}
+        # Вызывается со списком пользователей, чьи конфигурации перевыпущены на другом сервере
+        self.on_reissued: Optional[Callable[[List[int]], Awaitable[None]]] = None
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        self._sync_tasks: Dict[int, asyncio.Task] = {}
+
+    def _build(self, row: dict) -> Server:
+        existing = self.servers.get(row["id"])
+        wg_command = shlex.split(row["wg_command"]) if row["wg_command"] else WG_COMMAND
+        if existing is not None and existing.client_cidr == row["client_cidr"] \
+                and existing.server_ip == row["server_ip"]:
+            pool, sync = existing.pool, existing.sync
+        else:
+            pool = AddressPool(row["client_cidr"], row["server_ip"])
+            sync = existing.sync if existing is not None else PeerSync(row["id"])
+        sync.name = row["name"]
+        sync.interface = row["wg_interface"] or WG_INTERFACE
+        sync.wg_command = list(wg_command)
+        return Server(
+            id=row["id"],
+            name=row["name"],
+            endpoint=row["endpoint"],
+            public_key=row["public_key"],
+            client_cidr=row["client_cidr"],
+            server_ip=row["server_ip"],
+            dns=row["dns"],
+            capacity=row["capacity"],
+            is_enabled=bool(row["is_enabled"]),
+            pool=pool,
+            sync=sync,
+            load=existing.load if existing is not None else 0,
+        )
+
+    async def reload(self):
+        """Переносит настройки серверов в базу и перечитывает реестр"""
+        for settings in load_server_settings(self.settings_path):
+            await storage.upsert_server(settings)
+        rows = await storage.get_servers()
+        check_overlaps(rows)
+        # Конфигурации, выданные до появления реестра, остаются на первом сервере
+        if rows and await storage.assign_unplaced_to_server(rows[0]["id"]):
+            logging.info("Существующие конфигурации привязаны к серверу %s", rows[0]["name"])
+        self.servers = {row["id"]: self._build(row) for row in rows}
+        await self.refresh_load()
+
+    async def load(self):
+        """Загружает реестр при первом обращении"""
+        async with self._lock:
+            if not self._loaded:
+                await self.reload()
+                self._loaded = True
+
+    async def refresh_load(self):
+        """Пересчитывает загрузку серверов по базе"""
+        counts = await storage.count_configs_by_server()
+        for server in self.servers.values():
+            server.load = counts.get(server.id, 0)
+
+    def get(self, server_id: int) -> Optional[Server]:
+        return self.servers.get(server_id)
+
+    def find(self, name: str) -> Optional[Server]:
+        for server in self.servers.values():
+            if server.name == name:
+                return server
+        return None
+
+    async def choose(self, user_id: int, exclude: Optional[int] = None) -> Server:
+        """Выбирает сервер для новой конфигурации пользователя и резервирует в нем место"""
+        await self.load()
+        if exclude is None:
+            # Пользователь остается на своем сервере, пока тот принимает клиентов
+            current = self.servers.get(await storage.get_user_server_id(user_id))
+            if current is not None and current.accepts_clients:
+                current.load += 1
+                return current
+
+        candidates = [
+            server for server in self.servers.values()
+            if server.accepts_clients and server.id != exclude
+        ]
+        if not candidates:
+            raise NoServerAvailableError("Нет доступных серверов WireGuard со свободными местами")
+        lowest = min(server.load_ratio for server in candidates)
+        # Среди почти одинаково загруженных серверов выбор зависит только от пользователя,
+        # поэтому одновременные активации не сваливаются на один сервер
+        band = [server for server in candidates if server.load_ratio <= lowest + SERVER_LOAD_TOLERANCE]
+        server = max(band, key=lambda server: placement_score(user_id, server.name))
+        server.load += 1
+        return server
+
+    def excess_load(self, server: Server) -> int:
+        """Сколько клиентов нужно перенести, чтобы загрузка сервера сравнялась со средней"""
+        servers = [
+            other for other in self.servers.values()
+            if other.is_enabled and other.healthy
+        ]
+        capacity = sum(other.capacity for other in servers)
+        if not capacity:
+            return 0
+        average = sum(other.load for other in servers) / capacity
+        if not server.is_enabled:
+            # Выведенный из работы сервер освобождается полностью
+            return server.load
+        return max(0, server.load - int(average * server.capacity))
+
+    async def set_enabled(self, server: Server, is_enabled: bool):
+        """Включает сервер или выводит его из размещения новых клиентов"""
+        await storage.set_server_enabled(server.id, is_enabled)
+        server.is_enabled = is_enabled
+
+    def release_addresses(self, addresses: List[str]):
+        """Возвращает освобожденные адреса в пулы их серверов"""
+        for server in self.servers.values():
+            server.pool.release(addresses)
+
+    def peer_syncs(self) -> List[PeerSync]:
+        return [server.sync for server in self.servers.values()]
+
+    def request_sync(self, *args):
+        """Запрашивает синхронизацию пиров на всех серверах"""
+        for server in self.servers.values():
+            server.sync.request_sync()
+
+    def _start_peer_syncs(self):
+        for server in self.servers.values():
+            if server.id not in self._sync_tasks:
+                server.sync.request_sync()
+                self._sync_tasks[server.id] = asyncio.create_task(server.sync.run())
+
+    async def run(self, peer_sync: bool = False):
+        """Фоновая задача: перечитывает реестр и при необходимости синхронизирует пиров"""
+        while True:
+            try:
+                if self._loaded:
+                    await self.reload()
+                else:
+                    await self.load()
+                if peer_sync:
+                    self._start_peer_syncs()
+            except Exception:
+                logging.exception("Не удалось обновить реестр серверов WireGuard")
+            await asyncio.sleep(SERVER_REFRESH_INTERVAL)
+
+server_registry = ServerRegistry()
+
+# Адреса освобождаются в базе вместе с арендой; пулы серверов узнают об этом по событию
+add_listener("addresses_released", server_registry.release_addresses)
+# Новые, отключенные и перевыпущенные конфигурации меняют набор пиров
+add_listener("config_saved", server_registry.request_sync)
+add_listener("subscriptions_deactivated", server_registry.request_sync)
+add_listener("subscriptions_extended", server_registry.request_sync)
+add_listener("configs_deactivated", server_registry.request_sync)
+
+async def _collect_metrics():
+    for server in server_registry.servers.values():
+        server_peers.labels(server.name).set(server.load)
+        server_capacity.labels(server.name).set(server.capacity)
+        server_healthy.labels(server.name).set(int(server.is_enabled and server.healthy))
+        addresses_available.labels(server.name).set(server.pool.available)
+
+add_collector(_collect_metrics)
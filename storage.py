@@ -0,0 +1,1115 @@
+import os
+import time
+import heapq
+import datetime
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import database
+from database import (
+    BULK_CHUNK_SIZE, PAYMENT_CLAIM_TIMEOUT, STATS_COLUMNS, TRAFFIC_DAILY, TRAFFIC_HOURLY, TRAFFIC_RAW,
+    BulkProgressCallback, StorageConflictError
+)
+from events import notify
+from metrics import Gauge, add_collector
+
+# Хранилище данных бота: sqlite - файл DATABASE_NAME, memory - данные в памяти процесса
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+
+active_subscriptions = Gauge("vpn_bot_active_subscriptions", "Активные подписки")
+
+class Storage(ABC):
+    """Операции с данными бота; реализации обязаны вести себя одинаково"""
+
+    is_open = False
+
+    @abstractmethod
+    async def open(self):
+        """Подготавливает хранилище к работе"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def close(self):
+        """Освобождает ресурсы хранилища при остановке"""
+        raise NotImplementedError
+
+    # Пользователи
+
+    @abstractmethod
+    async def add_user(self, user_id: int, username: str) -> bool:
+        """Добавляет пользователя; False, если он уже есть"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_users(self, users: List[Tuple[int, str]]) -> int:
+        """Добавляет пользователей (user_id, username), пропуская существующих"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_user(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count_users(self) -> int:
+        raise NotImplementedError
+
+    # Подписки
+
+    @abstractmethod
+    async def add_subscription(
+        self,
+        user_id: int,
+        subscription_type: str,
+        duration_months: int,
+        payment_id: str,
+        is_trial: bool = False
+    ) -> bool:
+        """Добавляет подписку; False, если у пользователя уже есть активный тестовый период"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_subscriptions(self, subscriptions: List[tuple]) -> int:
+        """Импортирует подписки без уведомлений
+
+        Строка: (user_id, start_date, end_date, subscription_type, payment_id, is_trial, is_active).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_active_subscription(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_expired_subscriptions(self) -> List[Tuple[int, str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def deactivate_subscriptions(self, subscription_ids: List[int]) -> List[Tuple[int, int]]:
+        """Отключает подписки и возвращает пары (id, user_id)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def deactivate_subscription(self, subscription_id: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def extend_subscription(self, subscription_id: int, months: int) -> bool:
+        """Продлевает подписку без оплаты; учитывается в статистике как extended"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def apply_payment(self, payment_id: str, user_id: int, months: int) -> bool:
+        """Продлевает активную подписку или создает новую по оплате; False, если платеж уже применен"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count_subscriptions_for_bulk(
+        self,
+        trial_only: bool = False,
+        user_ids: Optional[List[int]] = None
+    ) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def extend_subscriptions_bulk(
+        self,
+        days: int,
+        trial_only: bool = False,
+        user_ids: Optional[List[int]] = None,
+        on_progress: Optional[BulkProgressCallback] = None
+    ) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def deactivate_subscriptions_bulk(
+        self,
+        trial_only: bool = False,
+        user_ids: Optional[List[int]] = None,
+        on_progress: Optional[BulkProgressCallback] = None
+    ) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_subscription_deadlines(self, until: datetime.datetime) -> List[Tuple[int, int, str]]:
+        """Возвращает (id, user_id, end_date) активных подписок, истекающих до until"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_active_subscriptions_page(
+        self,
+        after: Optional[Tuple[str, int]] = None,
+        before: Optional[Tuple[str, int]] = None,
+        limit: int = 10
+    ) -> List[dict]:
+        """Страница активных подписок по возрастанию (end_date, id)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_active_subscriptions(self, batch_size: int = 1000) -> AsyncIterator[tuple]:
+        """Построчно выдает активные подписки для выгрузки"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count_active_subscriptions(self) -> int:
+        raise NotImplementedError
+
+    # Статистика подписок
+
+    @abstractmethod
+    async def get_subscription_stats(self, since: str) -> List[dict]:
+        """Дневная статистика по тарифам начиная с дня since (YYYY-MM-DD)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def rebuild_subscription_stats(self, batch_size: int = 1000) -> int:
+        """Пересчитывает дневную статистику за все время и возвращает число строк"""
+        raise NotImplementedError
+
+    # Конфигурации WireGuard
+
+    @abstractmethod
+    async def save_wireguard_config(
+        self,
+        user_id: int,
+        private_key: str,
+        public_key: str,
+        client_ip: Optional[str] = None
+    ) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_wireguard_configs(self, configs: List[Tuple[int, str, str, Optional[str]]]) -> int:
+        """Импортирует конфигурации (user_id, private_key, public_key, client_ip)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_wireguard_config(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_active_peers(self, server_id: int) -> List[Tuple[str, str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_public_key_owners(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_issued_public_keys(self, public_keys: List[str]) -> Set[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_user_server_id(self, user_id: int) -> Optional[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_server_configs(self, server_id: int, after_id: int, limit: int) -> List[Tuple[int, int]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def deactivate_wireguard_configs(self, config_ids: List[int]) -> List[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count_configs_by_server(self) -> Dict[int, int]:
+        raise NotImplementedError
+
+    # Пул готовых клиентов и аренда адресов
+
+    @abstractmethod
+    async def add_client_identities(
+        self,
+        identities: List[Tuple[str, str, str]],
+        server_id: int,
+        claimed_by: Optional[int] = None
+    ) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def claim_client_identity(self, user_id: int, server_id: int) -> Optional[Tuple[str, str, str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count_free_client_identities(self, server_id: Optional[int] = None) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_ip_lease(self, address: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_ip_leases(self) -> List[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def release_ip_leases(self, addresses: List[str]) -> int:
+        raise NotImplementedError
+
+    # Платежи и кэш файлов Telegram
+
+    @abstractmethod
+    async def add_payment(self, payment_id: str, user_id: int, months: int, amount: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def claim_payment(self, payment_id: str, user_id: int, months: int, amount: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_payment_status(self, payment_id: str, status: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_telegram_file_id(self, config_id: int, kind: str, content_hash: str) -> Optional[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_telegram_file_id(self, config_id: int, kind: str, content_hash: str, file_id: str) -> bool:
+        raise NotImplementedError
+
+    # Трафик
+
+    @abstractmethod
+    async def record_traffic(self, bucket: int, usage: Dict[int, Tuple[int, int]]) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def rollup_traffic(self, now: int, retention: Dict[int, int]) -> Dict[int, int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_traffic_usage(self, user_id: int, since: int) -> Tuple[int, int]:
+        raise NotImplementedError
+
+    # Серверы WireGuard
+
+    @abstractmethod
+    async def get_servers(self) -> List[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upsert_server(self, server: dict) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_server_enabled(self, server_id: int, is_enabled: bool) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def assign_unplaced_to_server(self, server_id: int) -> int:
+        raise NotImplementedError
+
+# Операции хранилища: все методы Storage, кроме открытия и закрытия
+OPERATIONS = tuple(
+    name for name, value in vars(Storage).items()
+    if callable(value) and not name.startswith("_") and name not in ("open", "close")
+)
+
+class SqliteStorage(Storage):
+    """Хранилище в файле SQLite; операции реализованы в database.py"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+
+    async def open(self):
+        await database.init_db(self.path)
+        self.is_open = True
+
+    async def close(self):
+        await database.close_db()
+        self.is_open = False
+
+# Операции SQLite - функции database.py с теми же именами и сигнатурами
+for _name in OPERATIONS:
+    setattr(SqliteStorage, _name, staticmethod(getattr(database, _name)))
+del _name
+# ABCMeta собирает абстрактные методы при создании класса, поэтому пересчитываем их
+# после setattr (abc.update_abstractmethods появился только в Python 3.10)
+SqliteStorage.__abstractmethods__ = frozenset(
+    name for name in SqliteStorage.__abstractmethods__
+    if getattr(getattr(SqliteStorage, name), "__isabstractmethod__", False)
+)
+
+def _timestamp(value: datetime.datetime) -> str:
+    """Дата в том виде, в каком ее сохраняет sqlite3"""
+    return value.isoformat(" ")
+
+def _sql_now() -> str:
+    """Аналог datetime('now') в SQLite: текущее время UTC с точностью до секунды"""
+    return datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+def _shift(value: str, months: int = 0, days: int = 0) -> str:
+    """Аналог datetime(value, '+N months', '+N days') в SQLite"""
+    moment = datetime.datetime.fromisoformat(value)
+    if months:
+        year, month = divmod(moment.month - 1 + months, 12)
+        year += moment.year
+        # Как и SQLite, переносим лишние дни на следующий месяц: 31.01 + 1 месяц = 03.03
+        day = moment.day
+        moment = moment.replace(year=year, month=month + 1, day=1) + datetime.timedelta(days=day - 1)
+    moment += datetime.timedelta(days=days)
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+class MemoryStorage(Storage):
+    """Хранилище в памяти процесса с той же семантикой, что у SQLite
+
+    Подходит для тестов и нагрузочных замеров; данные теряются при перезапуске.
+    Методы не уступают управление циклу событий, поэтому каждый из них атомарен.
+    """
+
+    def __init__(self):
+        self._users: Dict[int, dict] = {}
+        self._subscriptions: Dict[int, dict] = {}
+        self._user_subscriptions: Dict[int, List[int]] = {}
+        self._configs: Dict[int, dict] = {}
+        self._user_configs: Dict[int, List[int]] = {}
+        # Действующие конфигурации по адресу клиента
+        self._active_configs_by_ip: Dict[str, Set[int]] = {}
+        self._identities: Dict[int, dict] = {}
+        self._identity_by_ip: Dict[str, int] = {}
+        self._identity_keys: Set[str] = set()
+        # Свободные записи пула по серверам: куча id, выдаются по возрастанию
+        self._free_identities: Dict[Optional[int], List[int]] = {}
+        self._leases: Set[str] = set()
+        self._payments: Dict[str, dict] = {}
+        self._telegram_files: Dict[Tuple[int, str], Tuple[str, str]] = {}
+        # user_id -> (resolution, bucket) -> [rx, tx]
+        self._traffic: Dict[int, Dict[Tuple[int, int], List[int]]] = {}
+        self._rollups: Dict[int, int] = {}
+        self._servers: Dict[int, dict] = {}
+        # (day, plan) -> счетчики дневной статистики
+        self._stats: Dict[Tuple[str, str], Dict[str, int]] = {}
+        self._ids: Dict[str, int] = {}
+
+    def _next_id(self, table: str) -> int:
+        self._ids[table] = self._ids.get(table, 0) + 1
+        return self._ids[table]
+
+    async def open(self):
+        self.is_open = True
+
+    async def close(self):
+        self.is_open = False
+
+    # Пользователи
+
+    async def add_user(self, user_id: int, username: str) -> bool:
+        if user_id in self._users:
+            return False
+        self._users[user_id] = {
+            "user_id": user_id,
+            "username": username,
+            "registered_at": _sql_now(),
+            "is_active": 1
+        }
+        return True
+
+    async def add_users(self, users: List[Tuple[int, str]]) -> int:
+        added = 0
+        for user_id, username in users:
+            added += await self.add_user(user_id, username)
+        return added
+
+    async def get_user(self, user_id: int) -> Optional[dict]:
+        user = self._users.get(user_id)
+        return dict(user) if user else None
+
+    async def count_users(self) -> int:
+        return len(self._users)
+
+    # Подписки
+
+    def _insert_subscription(
+        self,
+        user_id: int,
+        start_date: str,
+        end_date: str,
+        subscription_type: str,
+        payment_id: str,
+        is_trial: bool,
+        is_active: bool = True
+    ) -> int:
+        subscription_id = self._next_id("subscriptions")
+        self._subscriptions[subscription_id] = {
+            "id": subscription_id,
+            "user_id": user_id,
+            "start_date": start_date,
+            "end_date": end_date,
+            "subscription_type": subscription_type,
+            "payment_id": payment_id,
+            "is_trial": int(bool(is_trial)),
+            "is_active": int(bool(is_active))
+        }
+        self._user_subscriptions.setdefault(user_id, []).append(subscription_id)
+        return subscription_id
+
+    async def add_subscription(
+        self,
+        user_id: int,
+        subscription_type: str,
+        duration_months: int,
+        payment_id: str,
+        is_trial: bool = False
+    ) -> bool:
+        if is_trial and self._has_active_trial(user_id):
+            return False
+        start_date = datetime.datetime.now()
+        end_date = start_date + datetime.timedelta(days=30 * duration_months)
+        subscription_id = self._insert_subscription(
+            user_id, _timestamp(start_date), _timestamp(end_date), subscription_type, payment_id, is_trial
+        )
+        day = start_date.date().isoformat()
+        self._add_stats(day, subscription_type, "started")
+        if not is_trial:
+            self._record_conversion(day, subscription_type, user_id)
+        notify("subscription_changed", subscription_id, user_id, end_date)
+        return True
+
+    async def add_subscriptions(self, subscriptions: List[tuple]) -> int:
+        trials = [row[0] for row in subscriptions if row[5] and row[6]]
+        if len(set(trials)) != len(trials) or any(self._has_active_trial(user_id) for user_id in trials):
+            raise StorageConflictError("У пользователя может быть только один активный тестовый период")
+        count = 0
+        for user_id, start_date, end_date, subscription_type, payment_id, is_trial, is_active in subscriptions:
+            self._insert_subscription(
+                user_id, _timestamp(start_date), _timestamp(end_date),
+                subscription_type, payment_id, is_trial, is_active
+            )
+            count += 1
+        return count
+
+    def _has_active_trial(self, user_id: int) -> bool:
+        return any(
+            self._subscriptions[subscription_id]["is_trial"] and self._subscriptions[subscription_id]["is_active"]
+            for subscription_id in self._user_subscriptions.get(user_id, ())
+        )
+
+    def _has_active_subscription(self, user_id: int, now: str) -> bool:
+        return any(
+            self._subscriptions[subscription_id]["is_active"]
+            and self._subscriptions[subscription_id]["end_date"] > now
+            for subscription_id in self._user_subscriptions.get(user_id, ())
+        )
+
+    async def get_active_subscription(self, user_id: int) -> Optional[dict]:
+        now = _sql_now()
+        active = [
+            self._subscriptions[subscription_id]
+            for subscription_id in self._user_subscriptions.get(user_id, ())
+            if self._subscriptions[subscription_id]["is_active"]
+            and self._subscriptions[subscription_id]["end_date"] > now
+        ]
+        if not active:
+            return None
+        return dict(max(active, key=lambda sub: sub["end_date"]))
+
+    def _active_subscriptions(self) -> List[dict]:
+        return [sub for sub in self._subscriptions.values() if sub["is_active"]]
+
+    async def get_expired_subscriptions(self) -> List[Tuple[int, str]]:
+        now = _sql_now()
+        return [
+            (sub["user_id"], sub["subscription_type"])
+            for sub in self._active_subscriptions() if sub["end_date"] < now
+        ]
+
+    def _release_addresses(self, addresses: List[str]):
+        """Отключает конфигурации с этими адресами и удаляет аренду и записи пула"""
+        for address in addresses:
+            for config_id in self._active_configs_by_ip.pop(address, ()):
+                self._configs[config_id]["is_active"] = 0
+                for kind in [key[1] for key in self._telegram_files if key[0] == config_id]:
+                    del self._telegram_files[(config_id, kind)]
+            self._leases.discard(address)
+            identity_id = self._identity_by_ip.get(address)
+            if identity_id is not None and self._identities[identity_id]["claimed_by"] is not None:
+                identity = self._identities.pop(identity_id)
+                del self._identity_by_ip[address]
+                self._identity_keys.discard(identity["public_key"])
+
+    def _release_user_addresses(self, user_ids: List[int]) -> List[str]:
+        """Освобождает IP-адреса пользователей, у которых не осталось активных подписок"""
+        now = _sql_now()
+        addresses = [
+            self._configs[config_id]["client_ip"]
+            for user_id in user_ids if not self._has_active_subscription(user_id, now)
+            for config_id in self._user_configs.get(user_id, ())
+            if self._configs[config_id]["is_active"] and self._configs[config_id]["client_ip"] is not None
+        ]
+        self._release_addresses(addresses)
+        return addresses
+
+    async def deactivate_subscriptions(self, subscription_ids: List[int]) -> List[Tuple[int, int]]:
+        deactivated = []
+        for subscription_id in subscription_ids:
+            sub = self._subscriptions.get(subscription_id)
+            if sub is not None and sub["is_active"]:
+                sub["is_active"] = 0
+                deactivated.append((subscription_id, sub["user_id"]))
+        self._record_by_plan("churned", [
+            self._subscriptions[subscription_id]["subscription_type"] for subscription_id, _ in deactivated
+        ])
+        released = self._release_user_addresses(list({user_id for _, user_id in deactivated}))
+        if deactivated:
+            notify("subscriptions_deactivated", deactivated)
+        if released:
+            notify("addresses_released", released)
+        return deactivated
+
+    async def deactivate_subscription(self, subscription_id: int) -> bool:
+        await self.deactivate_subscriptions([subscription_id])
+        return True
+
+    async def extend_subscription(self, subscription_id: int, months: int) -> bool:
+        sub = self._subscriptions.get(subscription_id)
+        if sub is not None:
+            sub["end_date"] = _shift(sub["end_date"], months=months)
+            self._record_by_plan("extended", [sub["subscription_type"]])
+            notify(
+                "subscription_changed",
+                subscription_id, sub["user_id"], datetime.datetime.fromisoformat(sub["end_date"])
+            )
+        return True
+
+    async def apply_payment(self, payment_id: str, user_id: int, months: int) -> bool:
+        payment = self._payments.get(payment_id)
+        if payment is not None and payment["applied_at"] is not None:
+            return False
+        now = datetime.datetime.now()
+        day, plan = now.date().isoformat(), f"{months}_months"
+        self._record_conversion(day, plan, user_id)
+        sub = await self.get_active_subscription(user_id)
+        if sub:
+            subscription_id = sub["id"]
+            stored = self._subscriptions[subscription_id]
+            stored["end_date"] = _shift(stored["end_date"], months=months)
+            end_date = datetime.datetime.fromisoformat(stored["end_date"])
+            self._add_stats(day, plan, "renewals")
+        else:
+            end_date = now + datetime.timedelta(days=30 * months)
+            subscription_id = self._insert_subscription(
+                user_id, _timestamp(now), _timestamp(end_date), plan, payment_id, False
+            )
+            self._add_stats(day, plan, "started")
+        if payment is not None:
+            payment["applied_at"] = time.time()
+        notify("subscription_changed", subscription_id, user_id, end_date)
+        return True
+
+    def _bulk_targets(self, trial_only: bool, user_ids: Optional[List[int]]) -> List[dict]:
+        """Активные подписки, отобранные для массовой операции, по возрастанию id"""
+        if user_ids is None:
+            subs = self._active_subscriptions()
+        else:
+            subs = [
+                self._subscriptions[subscription_id]
+                for user_id in set(user_ids)
+                for subscription_id in self._user_subscriptions.get(user_id, ())
+                if self._subscriptions[subscription_id]["is_active"]
+            ]
+        if trial_only:
+            subs = [sub for sub in subs if sub["is_trial"]]
+        return sorted(subs, key=lambda sub: sub["id"])
+
+    async def count_subscriptions_for_bulk(
+        self,
+        trial_only: bool = False,
+        user_ids: Optional[List[int]] = None
+    ) -> int:
+        return len(self._bulk_targets(trial_only, user_ids))
+
+    async def extend_subscriptions_bulk(
+        self,
+        days: int,
+        trial_only: bool = False,
+        user_ids: Optional[List[int]] = None,
+        on_progress: Optional[BulkProgressCallback] = None
+    ) -> int:
+        targets = self._bulk_targets(trial_only, user_ids)
+        updated = []
+        for start in range(0, len(targets), BULK_CHUNK_SIZE):
+            chunk = targets[start:start + BULK_CHUNK_SIZE]
+            for sub in chunk:
+                sub["end_date"] = _shift(sub["end_date"], days=days)
+                updated.append(
+                    (sub["id"], sub["user_id"], datetime.datetime.fromisoformat(sub["end_date"]))
+                )
+            self._record_by_plan("extended", [sub["subscription_type"] for sub in chunk])
+            if on_progress:
+                await on_progress(len(updated), len(targets))
+        if updated:
+            notify("subscriptions_extended", updated)
+        return len(updated)
+
+    async def deactivate_subscriptions_bulk(
+        self,
+        trial_only: bool = False,
+        user_ids: Optional[List[int]] = None,
+        on_progress: Optional[BulkProgressCallback] = None
+    ) -> int:
+        targets = self._bulk_targets(trial_only, user_ids)
+        updated = []
+        released = []
+        for start in range(0, len(targets), BULK_CHUNK_SIZE):
+            chunk = targets[start:start + BULK_CHUNK_SIZE]
+            for sub in chunk:
+                sub["is_active"] = 0
+                updated.append((sub["id"], sub["user_id"]))
+            self._record_by_plan("churned", [sub["subscription_type"] for sub in chunk])
+            released.extend(self._release_user_addresses(list({sub["user_id"] for sub in chunk})))
+            if on_progress:
+                await on_progress(len(updated), len(targets))
+        if updated:
+            notify("subscriptions_deactivated", updated)
+        if released:
+            notify("addresses_released", released)
+        return len(updated)
+
+    async def get_subscription_deadlines(self, until: datetime.datetime) -> List[Tuple[int, int, str]]:
+        until = _timestamp(until)
+        return [
+            (sub["id"], sub["user_id"], sub["end_date"])
+            for sub in sorted(self._active_subscriptions(), key=lambda sub: sub["end_date"])
+            if sub["end_date"] <= until
+        ]
+
+    def _sorted_active_subscriptions(self) -> List[dict]:
+        return sorted(self._active_subscriptions(), key=lambda sub: (sub["end_date"], sub["id"]))
+
+    def _username(self, user_id: int) -> Optional[str]:
+        user = self._users.get(user_id)
+        return user["username"] if user else None
+
+    async def get_active_subscriptions_page(
+        self,
+        after: Optional[Tuple[str, int]] = None,
+        before: Optional[Tuple[str, int]] = None,
+        limit: int = 10
+    ) -> List[dict]:
+        subs = self._sorted_active_subscriptions()
+        if before is not None:
+            page = [sub for sub in subs if (sub["end_date"], sub["id"]) < tuple(before)][-limit:]
+        else:
+            key = tuple(after or ("", 0))
+            page = [sub for sub in subs if (sub["end_date"], sub["id"]) > key][:limit]
+        return [
+            {
+                "id": sub["id"],
+                "user_id": sub["user_id"],
+                "username": self._username(sub["user_id"]),
+                "subscription_type": sub["subscription_type"],
+                "is_trial": sub["is_trial"],
+                "end_date": sub["end_date"]
+            }
+            for sub in page
+        ]
+
+    async def iter_active_subscriptions(self, batch_size: int = 1000) -> AsyncIterator[tuple]:
+        for sub in self._sorted_active_subscriptions():
+            yield (
+                sub["id"], sub["user_id"], self._username(sub["user_id"]), sub["subscription_type"],
+                sub["is_trial"], sub["start_date"], sub["end_date"], sub["payment_id"]
+            )
+
+    async def count_active_subscriptions(self) -> int:
+        return len(self._active_subscriptions())
+
+    # Статистика подписок
+
+    def _add_stats(self, day: str, plan: str, column: str, count: int = 1):
+        row = self._stats.setdefault((day, plan), dict.fromkeys(STATS_COLUMNS, 0))
+        row[column] += count
+
+    def _record_conversion(self, day: str, plan: str, user_id: int):
+        had_trial = any(
+            self._subscriptions[subscription_id]["is_trial"]
+            for subscription_id in self._user_subscriptions.get(user_id, ())
+        )
+        paid_before = any(
+            payment["user_id"] == user_id and payment["applied_at"] is not None
+            for payment in self._payments.values()
+        )
+        if had_trial and not paid_before:
+            self._add_stats(day, plan, "conversions")
+
+    def _record_by_plan(self, column: str, plans: List[str]):
+        day = datetime.date.today().isoformat()
+        for plan in plans:
+            self._add_stats(day, plan, column)
+
+    async def get_subscription_stats(self, since: str) -> List[dict]:
+        return [
+            {"day": day, "plan": plan, **row}
+            for (day, plan), row in sorted(self._stats.items())
+            if day >= since
+        ]
+
+    async def rebuild_subscription_stats(self, batch_size: int = 1000) -> int:
+        # Продления администратором есть только в сводке и переносятся из нее
+        extended = {key: row["extended"] for key, row in self._stats.items() if row["extended"]}
+        self._stats = {}
+        for (day, plan), count in extended.items():
+            self._add_stats(day, plan, "extended", count)
+        now = _timestamp(datetime.datetime.now())
+        for sub in self._subscriptions.values():
+            self._add_stats(sub["start_date"][:10], sub["subscription_type"], "started")
+            if not sub["is_active"]:
+                self._add_stats(min(sub["end_date"], now)[:10], sub["subscription_type"], "churned")
+
+        purchases: Dict[Tuple[str, str], int] = {}
+        first_payments: Dict[int, Tuple[float, str]] = {}
+        for payment in self._payments.values():
+            if payment["applied_at"] is None:
+                continue
+            day = datetime.date.fromtimestamp(payment["applied_at"]).isoformat()
+            plan = f"{payment['months']}_months"
+            purchases[(day, plan)] = purchases.get((day, plan), 0) + 1
+            first = first_payments.get(payment["user_id"])
+            if first is None or payment["applied_at"] < first[0]:
+                first_payments[payment["user_id"]] = (payment["applied_at"], plan)
+        for (day, plan), count in purchases.items():
+            started = self._stats.get((day, plan), {}).get("started", 0)
+            if count > started:
+                self._add_stats(day, plan, "renewals", count - started)
+
+        trial_users = {sub["user_id"] for sub in self._subscriptions.values() if sub["is_trial"]}
+        for user_id, (applied_at, plan) in first_payments.items():
+            if user_id in trial_users:
+                self._add_stats(datetime.date.fromtimestamp(applied_at).isoformat(), plan, "conversions")
+        return len(self._stats)
+
+    # Конфигурации WireGuard
+
+    def _insert_config(
+        self,
+        user_id: int,
+        private_key: str,
+        public_key: str,
+        client_ip: Optional[str]
+    ) -> int:
+        config_id = self._next_id("wireguard_configs")
+        identity_id = self._identity_by_ip.get(client_ip)
+        self._configs[config_id] = {
+            "id": config_id,
+            "user_id": user_id,
+            "private_key": private_key,
+            "public_key": public_key,
+            "client_ip": client_ip,
+            "created_at": _sql_now(),
+            "is_active": 1,
+            "server_id": self._identities[identity_id]["server_id"] if identity_id is not None else None
+        }
+        self._user_configs.setdefault(user_id, []).append(config_id)
+        if client_ip is not None:
+            self._active_configs_by_ip.setdefault(client_ip, set()).add(config_id)
+        return config_id
+
+    async def save_wireguard_config(
+        self,
+        user_id: int,
+        private_key: str,
+        public_key: str,
+        client_ip: Optional[str] = None
+    ) -> bool:
+        self._insert_config(user_id, private_key, public_key, client_ip)
+        notify("config_saved", user_id)
+        return True
+
+    async def add_wireguard_configs(self, configs: List[Tuple[int, str, str, Optional[str]]]) -> int:
+        count = 0
+        for config in configs:
+            self._insert_config(*config)
+            count += 1
+        return count
+
+    async def get_wireguard_config(self, user_id: int) -> Optional[dict]:
+        for config_id in reversed(self._user_configs.get(user_id, ())):
+            config = self._configs[config_id]
+            if config["is_active"]:
+                return {
+                    key: config.get(key)
+                    for key in (
+                        "id", "user_id", "private_key", "public_key",
+                        "client_ip", "server_id", "created_at", "config_text"
+                    )
+                }
+        return None
+
+    def _active_configs(self) -> List[dict]:
+        return [config for config in self._configs.values() if config["is_active"]]
+
+    async def get_active_peers(self, server_id: int) -> List[Tuple[str, str]]:
+        now = _sql_now()
+        return [
+            (config["public_key"], config["client_ip"])
+            for config in self._active_configs()
+            if config["server_id"] == server_id and config["client_ip"] is not None
+            and self._has_active_subscription(config["user_id"], now)
+        ]
+
+    async def get_public_key_owners(self) -> Dict[str, int]:
+        return {config["public_key"]: config["user_id"] for config in self._active_configs()}
+
+    async def get_issued_public_keys(self, public_keys: List[str]) -> Set[str]:
+        wanted = set(public_keys)
+        return {config["public_key"] for config in self._configs.values() if config["public_key"] in wanted}
+
+    async def get_user_server_id(self, user_id: int) -> Optional[int]:
+        config_ids = self._user_configs.get(user_id)
+        return self._configs[config_ids[-1]]["server_id"] if config_ids else None
+
+    async def get_server_configs(self, server_id: int, after_id: int, limit: int) -> List[Tuple[int, int]]:
+        configs = sorted(
+            (config["id"], config["user_id"])
+            for config in self._active_configs()
+            if config["server_id"] == server_id and config["id"] > after_id
+        )
+        return configs[:limit]
+
+    async def deactivate_wireguard_configs(self, config_ids: List[int]) -> List[str]:
+        addresses = [
+            self._configs[config_id]["client_ip"]
+            for config_id in config_ids
+            if config_id in self._configs and self._configs[config_id]["is_active"]
+            and self._configs[config_id]["client_ip"] is not None
+        ]
+        self._release_addresses(addresses)
+        for config_id in config_ids:
+            if config_id in self._configs:
+                self._configs[config_id]["is_active"] = 0
+        if addresses:
+            notify("addresses_released", addresses)
+        if config_ids:
+            notify("configs_deactivated", config_ids)
+        return addresses
+
+    async def count_configs_by_server(self) -> Dict[int, int]:
+        counts: Dict[int, int] = {}
+        for config in self._active_configs():
+            counts[config["server_id"]] = counts.get(config["server_id"], 0) + 1
+        return counts
+
+    # Пул готовых клиентов и аренда адресов
+
+    async def add_client_identities(
+        self,
+        identities: List[Tuple[str, str, str]],
+        server_id: int,
+        claimed_by: Optional[int] = None
+    ) -> int:
+        # Ограничения уникальности проверяются до изменений, как откат транзакции в SQLite
+        keys = [identity[1] for identity in identities]
+        addresses = [identity[2] for identity in identities]
+        if (
+            len(set(keys)) != len(keys) or len(set(addresses)) != len(addresses)
+            or self._identity_keys.intersection(keys)
+            or any(address in self._identity_by_ip for address in addresses)
+        ):
+            raise StorageConflictError("Ключ или адрес уже есть в пуле клиентов")
+
+        claimed_at = _timestamp(datetime.datetime.now()) if claimed_by is not None else None
+        for private_key, public_key, client_ip in identities:
+            identity_id = self._next_id("client_identities")
+            self._identities[identity_id] = {
+                "private_key": private_key,
+                "public_key": public_key,
+                "client_ip": client_ip,
+                "server_id": server_id,
+                "claimed_by": claimed_by,
+                "claimed_at": claimed_at
+            }
+            self._identity_by_ip[client_ip] = identity_id
+            self._identity_keys.add(public_key)
+            if claimed_by is None:
+                heapq.heappush(self._free_identities.setdefault(server_id, []), identity_id)
+        return len(identities)
+
+    async def claim_client_identity(self, user_id: int, server_id: int) -> Optional[Tuple[str, str, str]]:
+        free = self._free_identities.get(server_id)
+        if not free:
+            return None
+        identity = self._identities[heapq.heappop(free)]
+        identity["claimed_by"] = user_id
+        identity["claimed_at"] = _sql_now()
+        return identity["private_key"], identity["public_key"], identity["client_ip"]
+
+    async def count_free_client_identities(self, server_id: Optional[int] = None) -> int:
+        if server_id is None:
+            return sum(len(free) for free in self._free_identities.values())
+        return len(self._free_identities.get(server_id, ()))
+
+    async def add_ip_lease(self, address: str) -> bool:
+        if address in self._leases:
+            return False
+        self._leases.add(address)
+        return True
+
+    async def get_ip_leases(self) -> List[str]:
+        return list(self._leases)
+
+    async def release_ip_leases(self, addresses: List[str]) -> int:
+        if not addresses:
+            return 0
+        self._leases.difference_update(addresses)
+        notify("addresses_released", addresses)
+        return len(addresses)
+
+    # Платежи и кэш файлов Telegram
+
+    async def add_payment(self, payment_id: str, user_id: int, months: int, amount: str) -> bool:
+        if payment_id not in self._payments:
+            self._payments[payment_id] = {
+                "user_id": user_id,
+                "months": months,
+                "amount": amount,
+                "status": "pending",
+                "updated_at": time.time(),
+                "applied_at": None
+            }
+        return True
+
+    async def claim_payment(self, payment_id: str, user_id: int, months: int, amount: str) -> bool:
+        payment = self._payments.get(payment_id)
+        if payment is None:
+            await self.add_payment(payment_id, user_id, months, amount)
+            payment = self._payments[payment_id]
+        elif not (
+            payment["status"] == "pending"
+            or (payment["status"] == "processing"
+                and payment["updated_at"] < time.time() - PAYMENT_CLAIM_TIMEOUT)
+        ):
+            return False
+        payment["status"] = "processing"
+        payment["updated_at"] = time.time()
+        return True
+
+    async def set_payment_status(self, payment_id: str, status: str) -> bool:
+        payment = self._payments.get(payment_id)
+        if payment is not None:
+            payment["status"] = status
+            payment["updated_at"] = time.time()
+        return True
+
+    async def get_telegram_file_id(self, config_id: int, kind: str, content_hash: str) -> Optional[str]:
+        cached = self._telegram_files.get((config_id, kind))
+        return cached[1] if cached and cached[0] == content_hash else None
+
+    async def save_telegram_file_id(self, config_id: int, kind: str, content_hash: str, file_id: str) -> bool:
+        self._telegram_files[(config_id, kind)] = (content_hash, file_id)
+        return True
+
+    # Трафик
+
+    def _add_traffic(self, user_id: int, resolution: int, bucket: int, rx: int, tx: int):
+        totals = self._traffic.setdefault(user_id, {}).setdefault((resolution, bucket), [0, 0])
+        totals[0] += rx
+        totals[1] += tx
+
+    async def record_traffic(self, bucket: int, usage: Dict[int, Tuple[int, int]]) -> int:
+        for user_id, (rx, tx) in usage.items():
+            self._add_traffic(user_id, TRAFFIC_RAW, bucket - bucket % TRAFFIC_RAW, rx, tx)
+        return len(usage)
+
+    async def rollup_traffic(self, now: int, retention: Dict[int, int]) -> Dict[int, int]:
+        for source, target in ((TRAFFIC_RAW, TRAFFIC_HOURLY), (TRAFFIC_HOURLY, TRAFFIC_DAILY)):
+            start = self._rollups.get(target, 0)
+            end = now - now % target
+            if end <= start:
+                continue
+            for user_id, buckets in self._traffic.items():
+                for (resolution, bucket), (rx, tx) in list(buckets.items()):
+                    if resolution == source and start <= bucket < end:
+                        self._add_traffic(user_id, target, bucket - bucket % target, rx, tx)
+            self._rollups[target] = end
+
+        deleted = {}
+        for resolution, keep in retention.items():
+            deleted[resolution] = 0
+            for buckets in self._traffic.values():
+                expired = [
+                    key for key in buckets
+                    if key[0] == resolution and key[1] < now - keep
+                ]
+                for key in expired:
+                    del buckets[key]
+                deleted[resolution] += len(expired)
+        return deleted
+
+    async def get_traffic_usage(self, user_id: int, since: int) -> Tuple[int, int]:
+        hourly_end = self._rollups.get(TRAFFIC_HOURLY, 0)
+        daily_end = self._rollups.get(TRAFFIC_DAILY, 0)
+        rx = tx = 0
+        for (resolution, bucket), (bucket_rx, bucket_tx) in self._traffic.get(user_id, {}).items():
+            if bucket + resolution <= since:
+                continue
+            if (
+                (resolution == TRAFFIC_DAILY and bucket < daily_end)
+                or (resolution == TRAFFIC_HOURLY and daily_end <= bucket < hourly_end)
+                or (resolution == TRAFFIC_RAW and bucket >= hourly_end)
+            ):
+                rx += bucket_rx
+                tx += bucket_tx
+        return rx, tx
+
+    # Серверы WireGuard
+
+    async def get_servers(self) -> List[dict]:
+        return [dict(self._servers[server_id]) for server_id in sorted(self._servers)]
+
+    async def upsert_server(self, server: dict) -> int:
+        existing = next(
+            (row for row in self._servers.values() if row["name"] == server["name"]), None
+        )
+        if any(
+            row["client_cidr"] == server.get("client_cidr") and row is not existing
+            for row in self._servers.values()
+        ):
+            raise StorageConflictError(f"Подсеть {server.get('client_cidr')} уже занята другим сервером")
+        if existing is None:
+            existing = {"id": self._next_id("servers"), "is_enabled": 1}
+            self._servers[existing["id"]] = existing
+        for column in database.SERVER_COLUMNS:
+            if column not in ("id", "is_enabled"):
+                existing[column] = server.get(column)
+        return existing["id"]
+
+    async def set_server_enabled(self, server_id: int, is_enabled: bool) -> bool:
+        server = self._servers.get(server_id)
+        if server is None:
+            return False
+        server["is_enabled"] = int(bool(is_enabled))
+        return True
+
+    async def assign_unplaced_to_server(self, server_id: int) -> int:
+        count = 0
+        for record in list(self._configs.values()) + list(self._identities.values()):
+            if record["server_id"] is None:
+                record["server_id"] = server_id
+                count += 1
+        unplaced = self._free_identities.pop(None, [])
+        if unplaced:
+            free = self._free_identities.setdefault(server_id, [])
+            free.extend(unplaced)
+            heapq.heapify(free)
+        return count
+
+STORAGE_BACKENDS = {
+    "sqlite": SqliteStorage,
+    "memory": MemoryStorage,
+}
+
+def create_storage(backend: str = STORAGE_BACKEND) -> Storage:
+    """Создает хранилище по имени реализации"""
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(
+            f"Неизвестное хранилище {backend}: ожидается одно из {', '.join(STORAGE_BACKENDS)}"
+        )
+    return STORAGE_BACKENDS[backend]()
+
+storage = create_storage()
+
+async def _collect_metrics():
+    if storage.is_open:
+        active_subscriptions.set(await storage.count_active_subscriptions())
+
+add_collector(_collect_metrics)
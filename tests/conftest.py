@@ -0,0 +1,29 @@
+import os
+import sys
+import asyncio
+import inspect
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+@pytest.fixture
+def event_loop():
+    """Отдельный цикл событий на тест: пул соединений и очереди привязаны к циклу"""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """Выполняет тесты-корутины в цикле фикстуры event_loop"""
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    loop = pyfuncitem.funcargs.get("event_loop")
+    if loop is None:
+        asyncio.run(pyfuncitem.obj(**arguments))
+    else:
+        loop.run_until_complete(pyfuncitem.obj(**arguments))
+    return True
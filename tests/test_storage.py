@@ -0,0 +1,359 @@
+"""Соответствие реализаций хранилища общему контракту.
+
+Каждый тест получает пустое хранилище и выполняется для всех реализаций;
+у SQLite у каждого теста свой файл базы:
+
+    python -m pytest tests
+"""
+import sqlite3
+import datetime
+from typing import List, Tuple
+
+import pytest
+
+from database import MIGRATIONS, TRAFFIC_DAILY, TRAFFIC_HOURLY, TRAFFIC_RAW
+from events import add_listener
+from storage import STORAGE_BACKENDS, SqliteStorage, Storage, StorageConflictError
+
+EVENTS = (
+    "subscription_changed", "subscriptions_deactivated", "subscriptions_extended",
+    "addresses_released", "config_saved", "configs_deactivated"
+)
+
+# События, полученные во время текущего теста: (событие, аргументы)
+events: List[Tuple[str, tuple]] = []
+
+for _event in EVENTS:
+    add_listener(_event, lambda *args, event=_event: events.append((event, args)))
+
+def emitted(event: str) -> List[tuple]:
+    return [args for name, args in events if name == event]
+
+@pytest.fixture(params=sorted(STORAGE_BACKENDS))
+def storage(request, event_loop, tmp_path) -> Storage:
+    backend = STORAGE_BACKENDS[request.param]
+    storage = backend(str(tmp_path / "bot.db")) if request.param == "sqlite" else backend()
+    event_loop.run_until_complete(storage.open())
+    events.clear()
+    yield storage
+    event_loop.run_until_complete(storage.close())
+
+def test_interface(storage: Storage):
+    assert not type(storage).__abstractmethods__
+
+async def test_users(storage: Storage):
+    assert await storage.add_user(1, "alice") is True
+    assert await storage.add_user(1, "alice") is False, "повторный пользователь"
+    assert await storage.add_users([(1, "alice"), (2, "bob"), (3, None)]) == 2
+    user = await storage.get_user(2)
+    assert (user["user_id"], user["username"], user["is_active"]) == (2, "bob", 1)
+    assert await storage.get_user(4) is None
+    assert await storage.count_users() == 3
+
+async def test_subscriptions(storage: Storage):
+    await storage.add_user(1, "alice")
+    await storage.add_subscription(1, "1_months", 1, "pay-1")
+    sub = await storage.get_active_subscription(1)
+    assert (
+        (sub["user_id"], sub["subscription_type"], sub["payment_id"], sub["is_trial"], sub["is_active"])
+        == (1, "1_months", "pay-1", 0, 1)
+    )
+    assert len(emitted("subscription_changed")) == 1, "уведомление о новой подписке"
+
+    end_date = datetime.datetime.fromisoformat(sub["end_date"])
+    await storage.extend_subscription(sub["id"], 2)
+    extended = await storage.get_active_subscription(1)
+    assert emitted("subscription_changed")[-1][2] == datetime.datetime.fromisoformat(extended["end_date"])
+    assert datetime.datetime.fromisoformat(extended["end_date"]) > end_date + datetime.timedelta(days=58)
+
+    assert await storage.deactivate_subscriptions([sub["id"], 999]) == [(sub["id"], 1)]
+    assert await storage.deactivate_subscriptions([sub["id"]]) == [], "повторное отключение"
+    assert await storage.get_active_subscription(1) is None
+    assert emitted("subscriptions_deactivated") == [([(sub["id"], 1)],)]
+
+    now = datetime.datetime.now()
+    await storage.add_subscriptions([
+        (2, now - datetime.timedelta(days=40), now - datetime.timedelta(days=10), "trial", "trial", True, True),
+        (3, now, now + datetime.timedelta(hours=2), "1_months", "pay-3", False, True),
+        (4, now, now + datetime.timedelta(days=90), "3_months", "pay-4", False, True),
+    ])
+    assert await storage.count_active_subscriptions() == 3
+    assert await storage.get_expired_subscriptions() == [(2, "trial")]
+    deadlines = await storage.get_subscription_deadlines(now + datetime.timedelta(days=1))
+    assert [user_id for _, user_id, _ in deadlines] == [2, 3], "сроки до горизонта"
+
+    changed = len(emitted("subscription_changed"))
+    assert await storage.add_subscription(2, "trial", 1, "trial", is_trial=True) is False, "второй тестовый период"
+    assert len(emitted("subscription_changed")) == changed, "без уведомления об отклоненной подписке"
+    assert await storage.add_subscription(2, "1_months", 1, "pay-2") is True, "платная при тестовом периоде"
+    await storage.deactivate_subscriptions([deadlines[0][0]])
+    assert await storage.add_subscription(2, "trial", 1, "trial", is_trial=True) is True, "тестовый после отключения"
+    with pytest.raises(StorageConflictError):
+        await storage.add_subscriptions([(2, now, now + datetime.timedelta(days=3), "trial", "trial", True, True)])
+
+async def test_bulk(storage: Storage):
+    now = datetime.datetime.now()
+    end = now + datetime.timedelta(days=10)
+    await storage.add_subscriptions([
+        (user_id, now, end, "trial" if user_id % 2 else "1_months", "x", bool(user_id % 2), True)
+        for user_id in range(1, 11)
+    ])
+    assert await storage.count_subscriptions_for_bulk() == 10
+    assert await storage.count_subscriptions_for_bulk(trial_only=True) == 5
+    assert await storage.count_subscriptions_for_bulk(user_ids=[1, 2, 42]) == 2
+
+    progress = []
+
+    async def on_progress(done: int, total: int):
+        progress.append((done, total))
+
+    assert await storage.extend_subscriptions_bulk(5, trial_only=True, on_progress=on_progress) == 5
+    assert progress[-1] == (5, 5)
+    extended = emitted("subscriptions_extended")
+    assert len(extended) == 1, "одно уведомление о продлении"
+    assert sorted(user_id for _, user_id, _ in extended[0][0]) == [1, 3, 5, 7, 9]
+    sub = await storage.get_active_subscription(1)
+    assert (
+        datetime.datetime.fromisoformat(sub["end_date"])
+        == end.replace(microsecond=0) + datetime.timedelta(days=5)
+    )
+
+    assert await storage.deactivate_subscriptions_bulk(user_ids=[2, 3]) == 2
+    assert await storage.count_active_subscriptions() == 8
+    assert sorted(emitted("subscriptions_deactivated")[0][0]) == [(2, 2), (3, 3)]
+
+async def test_pagination(storage: Storage):
+    now = datetime.datetime.now()
+    await storage.add_users([(user_id, f"user{user_id}") for user_id in range(1, 26)])
+    # Одинаковые сроки у соседних подписок проверяют упорядочивание по id
+    await storage.add_subscriptions([
+        (user_id, now, now + datetime.timedelta(days=user_id // 2), "1_months", "x", False, True)
+        for user_id in range(1, 26)
+    ])
+    pages = []
+    after = None
+    while True:
+        page = await storage.get_active_subscriptions_page(after=after, limit=10)
+        if not page:
+            break
+        pages.append(page)
+        after = (page[-1]["end_date"], page[-1]["id"])
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert pages[0][0]["username"] == "user1"
+
+    previous = await storage.get_active_subscriptions_page(
+        before=(pages[2][0]["end_date"], pages[2][0]["id"]), limit=10
+    )
+    assert previous == pages[1], "страница назад"
+
+    exported = [row async for row in storage.iter_active_subscriptions(batch_size=7)]
+    assert [row[0] for row in exported] == [row["id"] for page in pages for row in page], "порядок выгрузки"
+    assert len(exported[0]) == 8, "столбцы выгрузки"
+
+async def test_identities(storage: Storage):
+    server_a = await storage.upsert_server({"name": "a", "client_cidr": "10.1.0.0/24", "capacity": 10})
+    server_b = await storage.upsert_server({"name": "b", "client_cidr": "10.2.0.0/24", "capacity": 10})
+    await storage.add_client_identities([("pa1", "ka1", "10.1.0.2"), ("pa2", "ka2", "10.1.0.3")], server_a)
+    await storage.add_client_identities([("pb1", "kb1", "10.2.0.2")], server_b)
+    await storage.add_client_identities([("pa3", "ka3", "10.1.0.4")], server_a, claimed_by=7)
+    assert await storage.count_free_client_identities() == 3
+    assert await storage.count_free_client_identities(server_a) == 2
+
+    with pytest.raises(StorageConflictError):
+        await storage.add_client_identities([("px", "ka1", "10.1.0.9")], server_a)
+    assert await storage.count_free_client_identities(server_a) == 2, "пул не изменился после ошибки"
+
+    assert await storage.claim_client_identity(1, server_a) == ("pa1", "ka1", "10.1.0.2")
+    assert await storage.claim_client_identity(2, server_a) == ("pa2", "ka2", "10.1.0.3")
+    assert await storage.claim_client_identity(3, server_a) is None, "пул сервера исчерпан"
+    assert await storage.count_free_client_identities(server_b) == 1, "чужой пул не затронут"
+
+    assert await storage.add_ip_lease("10.1.0.2") is True
+    assert await storage.add_ip_lease("10.1.0.2") is False, "повторная аренда"
+    await storage.add_ip_lease("10.1.0.3")
+    assert await storage.release_ip_leases(["10.1.0.3"]) == 1
+    assert await storage.get_ip_leases() == ["10.1.0.2"]
+    assert emitted("addresses_released") == [(["10.1.0.3"],)]
+
+async def test_configs(storage: Storage):
+    server = await storage.upsert_server({"name": "a", "client_cidr": "10.1.0.0/24", "capacity": 10})
+    await storage.add_client_identities([("p1", "k1", "10.1.0.2"), ("p2", "k2", "10.1.0.3")], server)
+    for user_id in (1, 2):
+        await storage.add_user(user_id, None)
+        await storage.add_subscription(user_id, "1_months", 1, f"pay-{user_id}")
+        private_key, public_key, client_ip = await storage.claim_client_identity(user_id, server)
+        await storage.add_ip_lease(client_ip)
+        await storage.save_wireguard_config(user_id, private_key, public_key, client_ip)
+    assert emitted("config_saved") == [(1,), (2,)]
+
+    config = await storage.get_wireguard_config(1)
+    assert (
+        (config["private_key"], config["public_key"], config["client_ip"], config["server_id"])
+        == ("p1", "k1", "10.1.0.2", server)
+    )
+    assert await storage.get_user_server_id(1) == server, "сервер из записи пула"
+    assert sorted(await storage.get_active_peers(server)) == [("k1", "10.1.0.2"), ("k2", "10.1.0.3")]
+    assert await storage.get_public_key_owners() == {"k1": 1, "k2": 2}
+    assert await storage.count_configs_by_server() == {server: 2}
+    assert await storage.get_server_configs(server, 0, 1) == [(config["id"], 1)]
+
+    await storage.save_telegram_file_id(config["id"], "qr", "hash-1", "file-1")
+    assert await storage.get_telegram_file_id(config["id"], "qr", "hash-1") == "file-1"
+    assert await storage.get_telegram_file_id(config["id"], "qr", "hash-2") is None, "file_id другой версии"
+
+    # Отключение подписки освобождает адрес и отключает конфигурацию
+    sub = await storage.get_active_subscription(1)
+    await storage.deactivate_subscriptions([sub["id"]])
+    assert emitted("addresses_released") == [(["10.1.0.2"],)]
+    assert await storage.get_wireguard_config(1) is None
+    assert await storage.get_telegram_file_id(config["id"], "qr", "hash-1") is None, "file_id отключенной"
+    assert await storage.get_ip_leases() == ["10.1.0.3"]
+    assert await storage.get_issued_public_keys(["k1", "manual"]) == {"k1"}, "выданные ботом ключи"
+
+    config = await storage.get_wireguard_config(2)
+    assert await storage.deactivate_wireguard_configs([config["id"]]) == ["10.1.0.3"], "перевыпуск"
+    assert emitted("configs_deactivated") == [([config["id"]],)]
+    assert await storage.count_configs_by_server() == {}
+    assert await storage.count_free_client_identities() == 0, "записи пула удалены"
+
+async def test_payments(storage: Storage):
+    assert await storage.add_payment("p1", 1, 1, "399") is True
+    assert await storage.claim_payment("p1", 1, 1, "399") is True, "взятие в обработку"
+    assert await storage.claim_payment("p1", 1, 1, "399") is False, "повторная обработка"
+    await storage.set_payment_status("p1", "pending")
+    assert await storage.claim_payment("p1", 1, 1, "399") is True, "обработка после сбоя"
+    await storage.set_payment_status("p1", "succeeded")
+    assert await storage.claim_payment("p1", 1, 1, "399") is False, "обработанный платеж"
+    assert await storage.claim_payment("p2", 2, 3, "1137") is True, "платеж без записи"
+
+async def test_traffic(storage: Storage):
+    day = 20000 * TRAFFIC_DAILY
+    for offset in range(0, 2 * TRAFFIC_DAILY, TRAFFIC_RAW):
+        await storage.record_traffic(day + offset, {1: (10, 1), 2: (5, 0)})
+    await storage.record_traffic(day + 5, {1: (10, 1)})
+    samples = 2 * TRAFFIC_DAILY // TRAFFIC_RAW
+    expected = (10 * samples + 10, samples + 1)
+    assert await storage.get_traffic_usage(1, day) == expected
+
+    now = day + 2 * TRAFFIC_DAILY + 10
+    deleted = await storage.rollup_traffic(now, {TRAFFIC_RAW: TRAFFIC_DAILY, TRAFFIC_HOURLY: 3 * TRAFFIC_DAILY})
+    assert deleted[TRAFFIC_RAW] > 0, "удалены устаревшие сырые интервалы"
+    assert await storage.get_traffic_usage(1, day) == expected, "трафик после свертки"
+    assert await storage.get_traffic_usage(1, day + TRAFFIC_DAILY) == (10 * samples // 2, samples // 2)
+    assert await storage.rollup_traffic(now, {}) == {}, "повторная свертка"
+    assert await storage.get_traffic_usage(1, day) == expected, "свертка идемпотентна"
+    assert await storage.get_traffic_usage(3, day) == (0, 0)
+    # Часовые интервалы хранятся меньше суточных
+    await storage.rollup_traffic(
+        now + 5 * TRAFFIC_DAILY, {TRAFFIC_HOURLY: TRAFFIC_DAILY, TRAFFIC_DAILY: 30 * TRAFFIC_DAILY}
+    )
+    assert await storage.get_traffic_usage(2, day) == (5 * samples, 0), "суточные интервалы"
+
+async def test_servers(storage: Storage):
+    server_id = await storage.upsert_server(
+        {"name": "a", "endpoint": "1.1.1.1:51820", "client_cidr": "10.1.0.0/24", "capacity": 10}
+    )
+    await storage.set_server_enabled(server_id, False)
+    assert await storage.upsert_server(
+        {"name": "a", "endpoint": "2.2.2.2:51820", "client_cidr": "10.1.0.0/24", "capacity": 20}
+    ) == server_id, "обновление сохраняет id"
+    servers = await storage.get_servers()
+    assert (
+        [(server["name"], server["endpoint"], server["capacity"], server["is_enabled"]) for server in servers]
+        == [("a", "2.2.2.2:51820", 20, 0)]
+    )
+    assert await storage.set_server_enabled(999, True) is False, "неизвестный сервер"
+    with pytest.raises(StorageConflictError):
+        await storage.upsert_server({"name": "b", "client_cidr": "10.1.0.0/24", "capacity": 10})
+
+    await storage.add_client_identities([("p", "k", "10.9.0.2")], None)
+    await storage.add_wireguard_configs([(1, "p", "k", "10.9.0.2"), (2, "p2", "k2", None)])
+    assert await storage.assign_unplaced_to_server(server_id) == 3
+    assert await storage.count_free_client_identities(server_id) == 1, "пул перенесен на сервер"
+    assert await storage.count_configs_by_server() == {server_id: 2}, "конфигурации перенесены"
+
+async def test_stats(storage: Storage):
+    today = datetime.date.today().isoformat()
+    await storage.add_subscription(1, "trial", 1, "trial", is_trial=True)
+    trial = await storage.get_active_subscription(1)
+    await storage.deactivate_subscriptions([trial["id"]])
+    # Оплаты в порядке payments.activate_payment: взятие в обработку, применение, статус
+    for payment_id, user_id, months in (("p1", 1, 1), ("p2", 2, 3), ("p3", 1, 1)):
+        await storage.claim_payment(payment_id, user_id, months, "399")
+        assert await storage.apply_payment(payment_id, user_id, months) is True, payment_id
+        await storage.set_payment_status(payment_id, "succeeded")
+    sub = await storage.get_active_subscription(1)
+    assert datetime.datetime.fromisoformat(sub["end_date"]) > datetime.datetime.now() + datetime.timedelta(days=58)
+
+    # Повтор после сбоя на выдаче конфигурации: подписка и статистика не меняются
+    await storage.set_payment_status("p3", "pending")
+    assert await storage.claim_payment("p3", 1, 1, "399") is True, "повторное взятие платежа"
+    assert await storage.apply_payment("p3", 1, 1) is False, "повторное применение"
+    assert (await storage.get_active_subscription(1))["end_date"] == sub["end_date"], "срок после повтора"
+    # Продления администратором учитываются отдельно от оплаченных
+    await storage.extend_subscription(sub["id"], 1)
+    assert await storage.extend_subscriptions_bulk(3, user_ids=[2]) == 1
+
+    expected = [
+        {"day": today, "plan": "1_months", "started": 1, "renewals": 1, "conversions": 1, "churned": 0, "extended": 1},
+        {"day": today, "plan": "3_months", "started": 1, "renewals": 0, "conversions": 0, "churned": 0, "extended": 1},
+        {"day": today, "plan": "trial", "started": 1, "renewals": 0, "conversions": 0, "churned": 1, "extended": 0},
+    ]
+    assert await storage.get_subscription_stats(today) == expected, "статистика по событиям"
+    tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+    assert await storage.get_subscription_stats(tomorrow) == []
+    assert await storage.rebuild_subscription_stats(batch_size=1) == 3
+    assert await storage.get_subscription_stats(today) == expected, "пересчет совпадает с событиями"
+
+def seed_legacy_database(path: str):
+    """База в схеме до версионных миграций: базовые таблицы с данными"""
+    now = datetime.datetime.now()
+    db = sqlite3.connect(path)
+    with db:
+        for statement in MIGRATIONS[0][2]:
+            db.execute(statement)
+        db.execute("INSERT INTO users (user_id, username) VALUES (1, 'alice')")
+        db.execute(
+            """
+            INSERT INTO subscriptions (user_id, start_date, end_date, subscription_type, payment_id)
+            VALUES (1, ?, ?, '1_months', 'pay-1')
+            """,
+            (now, now + datetime.timedelta(days=30))
+        )
+        db.execute(
+            """
+            INSERT INTO wireguard_configs (user_id, private_key, public_key, config_text)
+            VALUES (1, 'p1', 'k1', 'PrivateKey = p1
+Address = 10.0.0.7/32
+')
+            """
+        )
+        # Адрес без маски миграция не распознает, конфигурация остается с текстом
+        db.execute("INSERT INTO users (user_id, username) VALUES (2, 'bob')")
+        db.execute(
+            """
+            INSERT INTO wireguard_configs (user_id, private_key, public_key, config_text)
+            VALUES (2, 'p2', 'k2', 'PrivateKey = p2
+Address = 10.0.0.8
+')
+            """
+        )
+    db.close()
+
+async def test_sqlite_upgrade(event_loop, tmp_path):
+    path = str(tmp_path / "legacy.db")
+    seed_legacy_database(path)
+    storage = SqliteStorage(path)
+    # Открытие применяет все миграции к базе в старой схеме
+    await storage.open()
+    try:
+        sub = await storage.get_active_subscription(1)
+        assert (sub["user_id"], sub["subscription_type"]) == (1, "1_months")
+        config = await storage.get_wireguard_config(1)
+        assert (config["private_key"], config["client_ip"]) == ("p1", "10.0.0.7"), "адрес из текста конфигурации"
+        assert config["config_text"] is None, "текст конфигурации с адресом не хранится"
+        assert await storage.get_ip_leases() == ["10.0.0.7"], "аренда адреса старой конфигурации"
+        config = await storage.get_wireguard_config(2)
+        assert (config["client_ip"], config["config_text"]) == (None, "PrivateKey = p2\nAddress = 10.0.0.8\n")
+    finally:
+        await storage.close()
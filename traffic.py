@@ -0,0 +1,125 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from database import TRAFFIC_DAILY, TRAFFIC_HOURLY, TRAFFIC_RAW
+from events import add_listener
+from metrics import Gauge, Histogram
+from peer_sync import PeerSync, parse_transfer
+from servers import server_registry
+from storage import storage
+
+WG_TRAFFIC_ACCOUNTING = os.getenv("WG_TRAFFIC_ACCOUNTING", "").lower() in ("1", "true", "yes")
+TRAFFIC_COLLECT_INTERVAL = float(os.getenv("TRAFFIC_COLLECT_INTERVAL", "60"))
+TRAFFIC_ROLLUP_INTERVAL = float(os.getenv("TRAFFIC_ROLLUP_INTERVAL", "900"))
+
+# Сколько хранить записи каждого разрешения, в секундах
+TRAFFIC_RETENTION = {
+    TRAFFIC_RAW: int(os.getenv("TRAFFIC_RAW_RETENTION_HOURS", "48")) * 3600,
+    TRAFFIC_HOURLY: int(os.getenv("TRAFFIC_HOURLY_RETENTION_DAYS", "60")) * 86400,
+    TRAFFIC_DAILY: int(os.getenv("TRAFFIC_DAILY_RETENTION_DAYS", "730")) * 86400,
+}
+
+traffic_collect_seconds = Histogram("vpn_bot_traffic_collect_seconds", "Время сбора счетчиков трафика")
+traffic_peers = Gauge("vpn_bot_traffic_peers", "Пиры в последнем выводе wg show dump всех серверов")
+
+def transfer_delta(current: Tuple[int, int], previous: Tuple[int, int]) -> Tuple[int, int]:
+    """Прирост счетчиков (rx, tx); после сброса счетчика прирост равен новому значению"""
+    rx, tx = current
+    previous_rx, previous_tx = previous
+    return (
+        rx - previous_rx if rx >= previous_rx else rx,
+        tx - previous_tx if tx >= previous_tx else tx,
+    )
+
+class TrafficCollector:
+    """Периодически снимает счетчики трафика пиров и сохраняет прирост по пользователям"""
+
+    def __init__(
+        self,
+        sources: Callable[[], List[PeerSync]] = server_registry.peer_syncs,
+        interval: float = TRAFFIC_COLLECT_INTERVAL,
+        rollup_interval: float = TRAFFIC_ROLLUP_INTERVAL
+    ):
+        self.sources = sources
+        self.interval = interval
+        self.rollup_interval = rollup_interval
+        # Счетчики предыдущего снимка каждого сервера: public_key -> (rx, tx)
+        self._previous: Dict[int, Dict[str, Tuple[int, int]]] = {}
+        self._owners: Dict[str, int] = {}
+        self._owners_stale = True
+        self._last_rollup = 0.0
+
+    def invalidate_owners(self, *args):
+        """Перечитать соответствие ключей пользователям при следующем сборе"""
+        self._owners_stale = True
+
+    async def collect(self, now: Optional[float] = None) -> int:
+        """Снимает счетчики и записывает прирост; возвращает число пользователей с трафиком"""
+        now = time.time() if now is None else now
+        with traffic_collect_seconds.time():
+            sources = self.sources()
+            dumps = await asyncio.gather(*(source.dump() for source in sources), return_exceptions=True)
+            if self._owners_stale:
+                self._owners = await storage.get_public_key_owners()
+                self._owners_stale = False
+
+            usage: Dict[int, Tuple[int, int]] = {}
+            peers = 0
+            for source, dump in zip(sources, dumps):
+                if isinstance(dump, Exception):
+                    # Недоступный сервер сохраняет прежний снимок и досчитается позже
+                    logging.warning("Не удалось снять счетчики трафика %s: %s", source.interface, dump)
+                    continue
+                counters = parse_transfer(dump)
+                previous_counters = self._previous.get(source.server_id, {})
+                for public_key, current in counters.items():
+                    previous = previous_counters.get(public_key)
+                    # Первый снимок пира служит точкой отсчета
+                    if previous is None or previous == current:
+                        continue
+                    user_id = self._owners.get(public_key)
+                    if user_id is None:
+                        continue
+                    rx, tx = transfer_delta(current, previous)
+                    total_rx, total_tx = usage.get(user_id, (0, 0))
+                    usage[user_id] = (total_rx + rx, total_tx + tx)
+
+                # Удаленные с интерфейса пиры выпадают из снимка сами
+                self._previous[source.server_id] = counters
+                peers += len(counters)
+            traffic_peers.set(peers)
+            await storage.record_traffic(int(now), usage)
+        return len(usage)
+
+    async def rollup(self, now: Optional[float] = None) -> Dict[int, int]:
+        """Сворачивает завершенные интервалы и применяет сроки хранения"""
+        return await storage.rollup_traffic(int(time.time() if now is None else now), TRAFFIC_RETENTION)
+
+    async def run(self):
+        """Фоновая задача сбора трафика"""
+        while True:
+            try:
+                await self.collect()
+                if time.monotonic() - self._last_rollup >= self.rollup_interval:
+                    await self.rollup()
+                    self._last_rollup = time.monotonic()
+            except Exception:
+                logging.exception("Не удалось собрать статистику трафика")
+            await asyncio.sleep(self.interval)
+
+def format_traffic(size: int) -> str:
+    """Размер в байтах в удобном для чтения виде"""
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
+
+traffic_collector = TrafficCollector()
+
+# Новые и отключенные конфигурации меняют соответствие ключей пользователям
+add_listener("config_saved", traffic_collector.invalidate_owners)
+add_listener("subscriptions_deactivated", traffic_collector.invalidate_owners)
@@ -0,0 +1,165 @@
+import os
+import hmac
+import asyncio
+import logging
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from metrics import Counter, Gauge, collect, queue_depth
+from payments import PaymentCallback, setup_payment_routes
+
+# Общий HTTP-сервер: уведомления ЮKassa, обновления Telegram, метрики
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_MAX_CONNECTIONS", "40"))
+
+# Адрес метрик в формате Prometheus; пустое значение отключает их
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
+# Пул обработчиков обновлений
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", "5"))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "30"))
+
+updates_in_flight = Gauge("vpn_bot_updates_in_flight", "Обновления Telegram в обработке")
+updates_rejected = Counter("vpn_bot_updates_rejected_total", "Обновления Telegram, отклоненные из-за перегрузки")
+updates_handled = Counter(
+    "vpn_bot_updates_handled_total", "Обновления Telegram, обработанные пулом, по результату", ["result"]
+)
+
+class UpdateWorkerPool:
+    """Ограниченный пул конкурентных обработчиков входящих обновлений"""
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        workers: int = UPDATE_WORKERS,
+        max_queue: int = UPDATE_QUEUE_SIZE
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.accepting = False
+        self.in_flight = 0
+
+    async def start(self):
+        """Запускает обработчики"""
+        self._queue = asyncio.Queue(self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.accepting = True
+
+    async def submit(self, update: Update, timeout: float = UPDATE_ENQUEUE_TIMEOUT) -> bool:
+        """Ставит обновление в очередь; False, если пул перегружен или остановлен"""
+        if not self.accepting:
+            updates_rejected.inc()
+            return False
+        try:
+            # Очередь заполняется, когда обработчики упираются в медленную
+            # базу данных; отказ заставит Telegram повторить доставку позже
+            await asyncio.wait_for(self._queue.put(update), timeout)
+            return True
+        except asyncio.TimeoutError:
+            updates_rejected.inc()
+            return False
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            self.in_flight += 1
+            try:
+                await self.dp.feed_update(self.bot, update)
+                updates_handled.labels("processed").inc()
+            except Exception:
+                updates_handled.labels("failed").inc()
+                logging.exception("Ошибка обработки обновления %s", update.update_id)
+            finally:
+                self.in_flight -= 1
+                self._queue.task_done()
+
+    async def stop(self, timeout: float = UPDATE_DRAIN_TIMEOUT):
+        """Перестает принимать обновления и дожидается обработки принятых"""
+        self.accepting = False
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(
+                    "Не дождались обработки обновлений: в очереди %s, в работе %s",
+                    self._queue.qsize(), self.in_flight
+                )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def depth(self) -> int:
+        """Количество обновлений, ожидающих обработки"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+update_pool_key = web.AppKey("update_pool", UpdateWorkerPool)
+
+async def handle_telegram_update(request: web.Request) -> web.Response:
+    """Принимает обновление Telegram и передает его в пул обработчиков"""
+    if WEBHOOK_SECRET:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=401)
+
+    pool = request.app[update_pool_key]
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": pool.bot})
+    except ValueError:
+        return web.Response(status=400, text="invalid update")
+    if not await pool.submit(update):
+        return web.Response(status=503, text="overloaded")
+    return web.Response(text="ok")
+
+def setup_update_routes(app: web.Application, pool: UpdateWorkerPool):
+    """Регистрирует прием обновлений Telegram в приложении aiohttp"""
+    app.router.add_post(TELEGRAM_WEBHOOK_PATH, handle_telegram_update)
+    app[update_pool_key] = pool
+    queue_depth.labels("updates").set_function(lambda: pool.depth)
+    updates_in_flight.set_function(lambda: pool.in_flight)
+
+async def set_telegram_webhook(bot: Bot, dp: Dispatcher):
+    """Сообщает Telegram адрес для доставки обновлений"""
+    await bot.set_webhook(
+        url=f"{WEBHOOK_BASE_URL.rstrip('/')}{TELEGRAM_WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        max_connections=TELEGRAM_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Отдает метрики в текстовом формате Prometheus"""
+    return web.Response(text=await collect(), content_type="text/plain", charset="utf-8")
+
+def create_app(on_payment_activated: Optional[PaymentCallback] = None) -> web.Application:
+    """Создает общее HTTP-приложение бота"""
+    app = web.Application()
+    setup_payment_routes(app, on_activated=on_payment_activated)
+    if METRICS_PATH:
+        app.router.add_get(METRICS_PATH, handle_metrics)
+    return app
+
+async def start_app(app: web.Application, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> web.AppRunner:
+    """Запускает HTTP-сервер"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -1,16 +1,119 @@
 import os
+import asyncio
+import functools
+import logging
 import subprocess
-from typing import Tuple
-import base64
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Tuple
+import io
+import hashlib
 import json
 from pathlib import Path
 
-def generate_keypair() -> Tuple[str, str]:
-    """Генерирует пару ключей WireGuard"""
+import segno
+from wireguard_tools import WireguardKey
+
+from cache import TTLCache
+from metrics import Counter, Gauge, Histogram, add_collector
+
+from servers import NoServerAvailableError, Server, server_registry
+from storage import storage
+
+# Генерировать ключи утилитой wg вместо встроенной реализации Curve25519
+WG_USE_WG_BINARY = os.getenv("WG_USE_WG_BINARY", "").lower() in ("1", "true", "yes")
+WG_KEYGEN_WORKERS = int(os.getenv("WG_KEYGEN_WORKERS", "0")) or None
+KEYGEN_CHUNK_SIZE = 256
+
+# Пул заранее подготовленных клиентов: пополняется до верхней отметки,
+# как только число свободных записей опускается ниже нижней
+WG_POOL_HIGH_WATER = int(os.getenv("WG_POOL_HIGH_WATER", "100"))
+WG_POOL_LOW_WATER = int(os.getenv("WG_POOL_LOW_WATER", str(WG_POOL_HIGH_WATER // 2)))
+WG_POOL_REFILL_INTERVAL = int(os.getenv("WG_POOL_REFILL_INTERVAL", "300"))
+
+# Конфигураций, перевыпускаемых за один шаг перебалансировки
+REBALANCE_BATCH_SIZE = int(os.getenv("REBALANCE_BATCH_SIZE", "100"))
+
+_refill_requested = asyncio.Event()
+
+# Кэш PNG с QR-кодами по хэшу текста конфигурации
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", "1000"))
+QR_CACHE_TTL = 3600
+QR_SCALE = 8
+
+qr_cache = TTLCache(QR_CACHE_SIZE, QR_CACHE_TTL)
+
+# Шаблонов конфигураций в LRU-кэше: по одному на набор настроек сервера
+CONFIG_TEMPLATE_CACHE_SIZE = int(os.getenv("CONFIG_TEMPLATE_CACHE_SIZE", "64"))
+
+# Метки полей клиента в разметке generate_config; нулевой байт не встречается в настройках
+_PRIVATE_KEY_FIELD = "\0private_key\0"
+_CLIENT_IP_FIELD = "\0client_ip\0"
+
+_keygen_executor: Optional[ProcessPoolExecutor] = None
+
+keygen_seconds = Histogram(
+    "vpn_bot_keygen_seconds", "Время генерации ключей WireGuard", ["operation"]
+)
+keys_generated = Counter("vpn_bot_keys_generated_total", "Сгенерировано пар ключей WireGuard")
+identity_pool_free = Gauge("vpn_bot_identity_pool_free", "Свободные записи в пуле клиентов WireGuard")
+qr_render_seconds = Histogram("vpn_bot_qr_render_seconds", "Время отрисовки QR-кодов")
+
+def _generate_keypair_wg() -> Tuple[str, str]:
+    """Генерирует пару ключей утилитами wg genkey / wg pubkey"""
     private_key = subprocess.check_output(["wg", "genkey"]).decode("utf-8").strip()
     public_key = subprocess.check_output(["wg", "pubkey"], input=private_key.encode()).decode("utf-8").strip()
     return private_key, public_key
 
+def generate_keypair(use_wg_binary: bool = WG_USE_WG_BINARY) -> Tuple[str, str]:
+    """Генерирует пару ключей WireGuard"""
+    if use_wg_binary:
+        return _generate_keypair_wg()
+    # Тот же формат, что у wg genkey: base64 от ограниченного (clamped)
+    # 32-байтного скаляра Curve25519
+    private_key = WireguardKey.generate()
+    return str(private_key), str(private_key.public_key())
+
+def _generate_keypair_chunk(count: int, use_wg_binary: bool) -> List[Tuple[str, str]]:
+    """Генерирует несколько пар ключей в рабочем процессе"""
+    return [generate_keypair(use_wg_binary) for _ in range(count)]
+
+def _get_keygen_executor() -> ProcessPoolExecutor:
+    """Возвращает пул процессов для генерации ключей"""
+    global _keygen_executor
+    if _keygen_executor is None:
+        _keygen_executor = ProcessPoolExecutor(max_workers=WG_KEYGEN_WORKERS)
+    return _keygen_executor
+
+def shutdown_keygen_executor():
+    """Останавливает пул процессов генерации ключей"""
+    global _keygen_executor
+    if _keygen_executor is not None:
+        _keygen_executor.shutdown(wait=False, cancel_futures=True)
+        _keygen_executor = None
+
+async def generate_keypairs(
+    count: int,
+    use_wg_binary: bool = WG_USE_WG_BINARY
+) -> List[Tuple[str, str]]:
+    """Генерирует пачку пар ключей для массовой выдачи конфигураций"""
+    loop = asyncio.get_running_loop()
+    executor = _get_keygen_executor()
+    chunks = [
+        loop.run_in_executor(
+            executor,
+            _generate_keypair_chunk,
+            min(KEYGEN_CHUNK_SIZE, count - offset),
+            use_wg_binary
+        )
+        for offset in range(0, count, KEYGEN_CHUNK_SIZE)
+    ]
+    keypairs = []
+    with keygen_seconds.labels("batch").time():
+        for chunk in await asyncio.gather(*chunks):
+            keypairs.extend(chunk)
+    keys_generated.inc(len(keypairs))
+    return keypairs
+
 def generate_config(
     private_key: str,
     server_public_key: str,
@@ -31,41 +134,191 @@ Endpoint = {server_endpoint}
 PersistentKeepalive = 25"""
     return config
 
-def generate_qr_config(config: str) -> str:
-    """Генерирует QR-код конфигурации для мобильных устройств"""
-    config_bytes = config.encode('utf-8')
-    config_base64 = base64.b64encode(config_bytes).decode('utf-8')
-    return f"wireguard://{config_base64}"
-
-def get_next_ip(last_ip: str = "10.0.0.0") -> str:
-    """Получает следующий доступный IP-адрес"""
-    ip_parts = list(map(int, last_ip.split('.')))
-    ip_parts[3] += 1
-    if ip_parts[3] > 254:
-        ip_parts[3] = 0
-        ip_parts[2] += 1
-    return '.'.join(map(str, ip_parts))
-
-async def create_client_config(user_id: int) -> Tuple[str, str, str]:
-    """Создает конфигурацию для нового клиента"""
-    private_key, public_key = generate_keypair()
-    
-    # В реальном приложении эти значения должны браться из конфигурации
-    server_public_key = os.getenv("WG_SERVER_PUBLIC_KEY")
-    server_endpoint = os.getenv("WG_SERVER_ENDPOINT")
-    dns_servers = os.getenv("WG_DNS")
-    
-    # В реальном приложении IP должен выбираться из пула доступных адресов
-    client_ip = get_next_ip()
-    
-    config = generate_config(
-        private_key=private_key,
-        server_public_key=server_public_key,
-        server_endpoint=server_endpoint,
-        client_ip=client_ip,
-        dns_servers=dns_servers
+@functools.lru_cache(maxsize=CONFIG_TEMPLATE_CACHE_SIZE)
+def compile_config_template(
+    server_public_key: Optional[str],
+    server_endpoint: Optional[str],
+    dns_servers: Optional[str]
+) -> Tuple[str, str, str]:
+    """Разбивает разметку generate_config на неизменные части вокруг ключа и адреса клиента"""
+    layout = generate_config(
+        _PRIVATE_KEY_FIELD, server_public_key, server_endpoint, _CLIENT_IP_FIELD, dns_servers
     )
-    
-    qr_config = generate_qr_config(config)
-    
-    return private_key, public_key, config, qr_config 
\ No newline at end of file
+    head, key_found, rest = layout.partition(_PRIVATE_KEY_FIELD)
+    middle, ip_found, tail = rest.partition(_CLIENT_IP_FIELD)
+    if not (key_found and ip_found):
+        raise ValueError("Разметка generate_config должна содержать ключ клиента, а после него адрес")
+    return head, middle, tail
+
+def render_config(server: Server, private_key: str, client_ip: str) -> str:
+    """Собирает конфигурацию клиента по шаблону сервера"""
+    # Шаблон выбирается по настройкам: после их смены текст собирается по новым
+    head, middle, tail = compile_config_template(server.public_key, server.endpoint, server.dns)
+    return "".join((head, private_key, middle, client_ip, tail))
+
+async def get_config_text(config: dict) -> str:
+    """Текст конфигурации по записи storage.get_wireguard_config"""
+    if config["client_ip"] is None:
+        # Адрес старой конфигурации не удалось извлечь при миграции: отдаем сохраненный текст
+        if config["config_text"] is None:
+            raise ValueError(f"У конфигурации {config['id']} нет адреса клиента, нужен перевыпуск")
+        return config["config_text"]
+    await server_registry.load()
+    server = server_registry.get(config["server_id"])
+    if server is None:
+        raise NoServerAvailableError(f"Сервер конфигурации {config['id']} не найден")
+    return render_config(server, config["private_key"], config["client_ip"])
+
+def render_qr_png(config: str) -> bytes:
+    """Рисует PNG с QR-кодом текста конфигурации"""
+    # Мобильные приложения WireGuard сканируют сам текст конфигурации;
+    # уровень коррекции L дает самый компактный код
+    qr = segno.make(config, error="l", micro=False)
+    buffer = io.BytesIO()
+    qr.save(buffer, kind="png", scale=QR_SCALE, border=4)
+    return buffer.getvalue()
+
+async def get_qr_png(config: str) -> bytes:
+    """Возвращает PNG с QR-кодом, рисуя его вне цикла событий"""
+    key = hashlib.sha256(config.encode("utf-8")).hexdigest()
+    png = qr_cache.get(key, None)
+    if png is None:
+        loop = asyncio.get_running_loop()
+        with qr_render_seconds.time():
+            png = await loop.run_in_executor(None, render_qr_png, config)
+        qr_cache.set(key, png)
+    return png
+
+async def _provision_identities(
+    count: int,
+    server: Server,
+    claimed_by: Optional[int] = None
+) -> List[Tuple[str, str, str]]:
+    """Генерирует ключи, резервирует IP сервера и сохраняет записи в пул"""
+    keypairs = await generate_keypairs(count)
+    identities = []
+    try:
+        for private_key, public_key in keypairs:
+            identities.append((private_key, public_key, await server.pool.allocate()))
+        await storage.add_client_identities(identities, server.id, claimed_by)
+    except Exception:
+        # Не оставляем аренду адресов, которые так и не попали в пул
+        await storage.release_ip_leases([identity[2] for identity in identities])
+        raise
+    return identities
+
+async def refill_identity_pool(target: int = WG_POOL_HIGH_WATER) -> int:
+    """Пополняет пулы готовых клиентов включенных серверов до target записей"""
+    await server_registry.load()
+    added = 0
+    for server in server_registry.servers.values():
+        if not server.is_enabled:
+            continue
+        missing = target - await storage.count_free_client_identities(server.id)
+        if missing > 0:
+            added += len(await _provision_identities(missing, server))
+    return added
+
+def request_identity_pool_refill():
+    """Будит фоновую задачу пополнения пула"""
+    _refill_requested.set()
+
+async def run_identity_pool_refiller():
+    """Фоновая задача, поддерживающая пул готовых клиентов"""
+    while True:
+        try:
+            await server_registry.load()
+            free = [
+                await storage.count_free_client_identities(server.id)
+                for server in server_registry.servers.values() if server.is_enabled
+            ]
+            if free and min(free) < WG_POOL_LOW_WATER:
+                added = await refill_identity_pool()
+                logging.info("В пул клиентов WireGuard добавлено записей: %s", added)
+        except Exception:
+            logging.exception("Не удалось пополнить пул клиентов WireGuard")
+        
+        _refill_requested.clear()
+        try:
+            await asyncio.wait_for(_refill_requested.wait(), WG_POOL_REFILL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def claim_identity(
+    user_id: int,
+    exclude_server_id: Optional[int] = None
+) -> Tuple[Tuple[str, str, str], Server]:
+    """Выбирает сервер и закрепляет за пользователем ключи и IP из его пула"""
+    server = await server_registry.choose(user_id, exclude_server_id)
+    try:
+        identity = await storage.claim_client_identity(user_id, server.id)
+        if identity is None:
+            # Пул исчерпан: готовим запись сразу, не дожидаясь фоновой задачи
+            identity = (await _provision_identities(1, server, claimed_by=user_id))[0]
+    except BaseException:
+        # Место, зарезервированное choose, так и не занято (в том числе при отмене)
+        server.load -= 1
+        raise
+    request_identity_pool_refill()
+    return identity, server
+
+async def create_client_config(
+    user_id: int,
+    exclude_server_id: Optional[int] = None
+) -> Tuple[str, str, str]:
+    """Выдает новому клиенту ключи и IP на выбранном сервере
+
+    Возвращает (private_key, public_key, client_ip); текст конфигурации
+    собирается при отправке по шаблону сервера (get_config_text).
+    """
+    (private_key, public_key, client_ip), server = await claim_identity(user_id, exclude_server_id)
+    return private_key, public_key, client_ip
+
+async def rebalance_server(
+    server: Server,
+    count: Optional[int] = None,
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None
+) -> int:
+    """Переносит клиентов с сервера на менее загруженные, перевыпуская конфигурации пачками"""
+    await server_registry.refresh_load()
+    if count is None:
+        count = server_registry.excess_load(server)
+    moved = 0
+    after_id = 0
+    while moved < count:
+        batch = await storage.get_server_configs(
+            server.id, after_id, min(REBALANCE_BATCH_SIZE, count - moved)
+        )
+        if not batch:
+            break
+        after_id = batch[-1][0]
+
+        reissued = []
+        try:
+            for config_id, user_id in batch:
+                private_key, public_key, client_ip = await create_client_config(
+                    user_id, exclude_server_id=server.id
+                )
+                await storage.save_wireguard_config(user_id, private_key, public_key, client_ip)
+                reissued.append((config_id, user_id))
+        except NoServerAvailableError:
+            logging.warning("Перебалансировка %s остановлена: другие серверы заполнены", server.name)
+            count = moved + len(reissued)
+        finally:
+            # Старая конфигурация отключается только после выдачи новой
+            if reissued:
+                await storage.deactivate_wireguard_configs([config_id for config_id, _ in reissued])
+                server.load -= len(reissued)
+                moved += len(reissued)
+                if server_registry.on_reissued is not None:
+                    await server_registry.on_reissued([user_id for _, user_id in reissued])
+
+        if on_progress is not None:
+            await on_progress(moved, count)
+    return moved
+
+async def _collect_metrics():
+    if storage.is_open:
+        identity_pool_free.set(await storage.count_free_client_identities())
+
+add_collector(_collect_metrics)
\ No newline at end of file